@@ -19,35 +19,175 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-try:
-    from yaml import CLoader as yaml_loader
-except ImportError:
-    from yaml import Loader as yaml_loader
-try:
-    import cPickle as pickle
-except ImportError:
-    import pickle
-
+import heapq
 import logging
 import os.path
 import re
 import shlex
-import copy
 import sys
+import time
+from collections import OrderedDict
 
 import twisted.internet.reactor as reactor
 import twisted.internet.defer as defer
 import twisted.python.failure as failure
 from twisted.internet.task import deferLater
-import yaml
 
 import yadtshell
 from yadtshell.commandline import (confirm_transaction_by_user,
                                    EXIT_CODE_CANCELED_BY_USER)
+from yadtshell.channel import ChannelPool
+from yadtshell.command_batch import CommandBatcher
+from yadtshell.durations import get_duration_store
+from yadtshell.journal import ActionJournal, action_keys, checksum_of
+from yadtshell.plan_format import load as load_plan
+from yadtshell.probe_policy import ProbePolicy, ProbeStatistics
+from yadtshell.scheduling import SCHEDULE_QUEUE, create_priorities
 
 YADT_MINION_EXIT_CODE_HOST_LOCKED = 150
 YADT_MINION_EXIT_CODE_SERVICE_IGNORED = 151
 
+BATCHED_SERVICE_COMMANDS = [yadtshell.settings.START, yadtshell.settings.STOP, yadtshell.settings.STATUS]
+CHANNEL_COMMANDS = BATCHED_SERVICE_COMMANDS + [yadtshell.constants.PROBE]
+
+
+class PreconditionQueue(object):
+
+    """A queue of tasks, handing out the first task whose preconditions are
+    met without evaluating the preconditions of all tasks again.
+
+    Each task keeps the number of its unmet preconditions, which are indexed
+    by (uri, attr, target_value). When an attribute of a component changes,
+    only the preconditions on this attribute are evaluated again, and tasks
+    whose count drops to zero are moved to a heap of ready tasks, ordered
+    by their priority and their position in the queue.
+
+    With a GroupLimiter, a ready task demanding units of groups (as given
+    by `demand_fun`) is handed out only when the limiter has room for it,
+    and releases its units when it is done.
+    """
+
+    def __init__(self, tasks, components, priorities=None, limiter=None, demand_fun=None):
+        self.components = components
+        self.tasks = OrderedDict(enumerate(tasks))
+        self.limiter = limiter
+        self.demands = {}
+        if limiter and demand_fun:
+            for position, task in self.tasks.iteritems():
+                demand = demand_fun(task.action)
+                if demand:
+                    self.demands[position] = demand
+        priorities = priorities or {}
+        self.sort_keys = dict((position, (-priorities.get(id(task.action), 0), position))
+                              for position, task in self.tasks.iteritems())
+        self.unmet_count = {}
+        self.preconditions = {}
+        self.met = {}
+        self.ready = []
+        for position, task in self.tasks.iteritems():
+            self.unmet_count[position] = 0
+            if isinstance(task.action, yadtshell.actions.ActionPlan):
+                continue
+            for precondition in task.action.preconditions:
+                key = (precondition.uri, precondition.attr, precondition.target_value)
+                if key not in self.met:
+                    self.met[key] = precondition.is_reached(components)
+                    self.preconditions.setdefault(
+                        (precondition.uri, precondition.attr), {})[precondition.target_value] = []
+                self.preconditions[(precondition.uri, precondition.attr)][
+                    precondition.target_value].append(position)
+                if not self.met[key]:
+                    self.unmet_count[position] += 1
+        self.ready = [self.sort_keys[position]
+                      for position, count in self.unmet_count.iteritems() if count == 0]
+        heapq.heapify(self.ready)
+        self.listening = False
+        if self.preconditions:
+            yadtshell.components.add_attribute_listener(self.attribute_changed)
+            self.listening = True
+
+    def attribute_changed(self, component, attr):
+        target_values = self.preconditions.get((getattr(component, 'uri', None), attr))
+        if not target_values or self.components.get(component.uri) is not component:
+            return
+        value = getattr(component, attr, None)
+        became_ready = False
+        for target_value, positions in target_values.iteritems():
+            key = (component.uri, attr, target_value)
+            is_met = value == target_value
+            if is_met == self.met[key]:
+                continue
+            self.met[key] = is_met
+            for position in positions:
+                if position not in self.tasks:
+                    continue
+                if is_met:
+                    self.unmet_count[position] -= 1
+                    if self.unmet_count[position] == 0:
+                        heapq.heappush(self.ready, self.sort_keys[position])
+                        became_ready = True
+                else:
+                    self.unmet_count[position] += 1
+        if became_ready:
+            yadtshell.defer.notify_state_change()
+
+    def next_ready(self):
+        """Removes and returns the first pending task whose preconditions
+        are met, or TASK_BLOCKED if such tasks wait for the limiter, or None.
+        """
+        not_pending = []
+        blocked = []
+        task = None
+        while self.ready:
+            _, position = heapq.heappop(self.ready)
+            if position not in self.tasks or self.unmet_count[position]:
+                # taken already or a precondition is unmet again
+                continue
+            candidate = self.tasks[position]
+            if (not isinstance(candidate.action, yadtshell.actions.ActionPlan) and
+                    candidate.action.state != yadtshell.actions.State.PENDING):
+                not_pending.append(position)
+                continue
+            demand = self.demands.get(position)
+            if demand:
+                if not self.limiter.acquire(demand):
+                    blocked.append(position)
+                    continue
+                candidate = yadtshell.defer.AccountedTask(
+                    candidate, lambda result, demand=demand: self.release(result, demand))
+            del self.tasks[position]
+            task = candidate
+            break
+        for position in not_pending + blocked:
+            heapq.heappush(self.ready, self.sort_keys[position])
+        if not self.tasks:
+            self.close()
+        if task is None and blocked:
+            return yadtshell.defer.TASK_BLOCKED
+        return task
+
+    def release(self, result, demand):
+        self.limiter.release(demand)
+        return result
+
+    def close(self, result=None):
+        if self.listening:
+            yadtshell.components.remove_attribute_listener(self.attribute_changed)
+            self.listening = False
+        return result
+
+    def __len__(self):
+        return len(self.tasks)
+
+    def __iter__(self):
+        return self.tasks.itervalues()
+
+    def __eq__(self, other):
+        return list(self) == list(other)
+
+    def __ne__(self, other):
+        return not self == other
+
 
 class ActionManager(object):
 
@@ -61,6 +201,18 @@ class ActionManager(object):
     def __init__(self):
         self.logger = logging.getLogger('actionmanager')
         self.finish_fun = self.log_host_finished
+        self.probe_statistics = ProbeStatistics()
+        self.command_batcher = None
+        self.command_channels = None
+        self.priorities = None
+        self.durations = None
+        self.expected_durations = {}
+        self.running_actions = 0
+        self.pi = None
+        self.journal = None
+        self.journal_keys = {}
+        self.update_limiter = None
+        self.update_group_by = yadtshell.constants.UPDATE_GROUP_BY_DEFAULT
         self.logger.info('log file: "{0}"'.format(yadtshell.settings.log_file))
 
     def get_state_info(self, action):
@@ -104,7 +256,7 @@ class ActionManager(object):
                 [{'uri': component.uri, 'state': component.state}], tracking_id=yadtshell.settings.tracking_id)
             self.logger.debug("storing new state for %s: %s" %
                               (component.uri, component.state))
-            self.orig_components[component.uri].state = component.state
+            self.state_changes.setdefault(component.uri, {})['state'] = component.state
             return
         if isinstance(component, yadtshell.components.Service) or isinstance(
                 component, yadtshell.components.ReadonlyService):
@@ -126,8 +278,80 @@ class ActionManager(object):
 
     def mark_action_as_finished(self, ignored, action):
         action.state = yadtshell.actions.State.FINISHED
+        self.running_actions -= 1
+        self.expected_durations.pop(id(action), None)
+        self.update_eta()
         return ignored
 
+    def estimate_durations(self, plan):
+        self.durations = get_duration_store()
+        self.expected_durations = {}
+        for action in plan.list_actions:
+            expected = self.durations.expected_for_action(action, components=self.components)
+            if expected is not None:
+                self.expected_durations[id(action)] = expected
+
+    def update_eta(self):
+        if self.pi and self.expected_durations:
+            self.pi.set_eta(sum(self.expected_durations.values()) / max(1, self.running_actions))
+
+    def record_duration(self, result, action, component, started):
+        if self.durations:
+            self.durations.record(action.cmd, action.uri, type(component).__name__, time.time() - started)
+        return result
+
+    def journal_action(self, action, state):
+        key = self.journal_keys.get(id(action))
+        if self.journal and key:
+            self.journal.record(key, state)
+
+    def journal_result(self, result, action):
+        if isinstance(result, failure.Failure):
+            self.journal_action(action, yadtshell.actions.State.PENDING)
+        else:
+            self.journal_action(action, yadtshell.actions.State.FINISHED)
+        return result
+
+    def restore_finished_action(self, action):
+        action.state = yadtshell.actions.State.FINISHED
+        if action.attr:
+            setattr(self.components[action.uri], action.attr, action.target_value)
+
+    def resume_plan(self, ignored, plan, journal_states):
+        """Skips the actions which the interrupted run of `plan` finished,
+        and probes the components of the actions which were running, to
+        find out whether they reached their target state.
+        """
+        deferreds = []
+        for action in plan.list_actions:
+            state = journal_states.get(self.journal_keys.get(id(action)))
+            if state == yadtshell.actions.State.FINISHED:
+                self.logger.info('skipping finished %s' % action.name)
+                self.restore_finished_action(action)
+            elif state == yadtshell.actions.State.RUNNING:
+                deferreds.append(self.reprobe(action))
+        return defer.DeferredList(deferreds)
+
+    def reprobe(self, action):
+        component = self.components[action.uri]
+        deferred = None
+        if action.attr == 'state' and not self.dryrun:
+            deferred = self.probe(component)
+        if not deferred:
+            self.logger.info('%s was interrupted, executing it again' % action.name)
+            return defer.succeed(None)
+
+        def check_target_state(ignored):
+            if component.state == action.target_value:
+                self.logger.info('%s was interrupted after reaching %s, skipping it' %
+                                 (action.name, action.target_value))
+                self.restore_finished_action(action)
+                self.journal_action(action, yadtshell.actions.State.FINISHED)
+            else:
+                self.logger.info('%s was interrupted, executing it again' % action.name)
+        deferred.addBoth(check_target_state)
+        return deferred
+
     def handle_action(self, protocol=None, plan=None, path=None):
         action = plan
         self.logger.debug('executing action %s' % action)
@@ -165,6 +389,10 @@ class ActionManager(object):
             # reactor.callLater(1, deferred.callback, None)
             # return deferred
 
+        self.journal_action(action, yadtshell.actions.State.RUNNING)
+        started = time.time()
+        self.running_actions += 1
+        self.update_eta()
         if cmd == yadtshell.constants.PROBE:
             deferred = self.probe(component)
             deferred.addCallback(self.set_probed_state, component)
@@ -189,6 +417,8 @@ class ActionManager(object):
         deferred.addErrback(
             self.handle_ignored_or_locked, cmd, component, target_state)
         deferred.addCallback(self.handle_output, cmd, component, target_state)
+        deferred.addCallback(self.record_duration, action, component, started)
+        deferred.addBoth(self.journal_result, action)
         deferred.addBoth(self.mark_action_as_finished, action)
         deferred.addErrback(yadtshell.twisted.report_error, self.logger.error)
         return deferred
@@ -210,32 +440,35 @@ class ActionManager(object):
                                  (cmd, component.uri, component.host_uri))
         return failure
 
-    def handle_output(self, ignored, cmd, component, target_state=None, tries=0):
+    def handle_output(self, ignored, cmd, component, target_state=None, tries=0, delays=None):
         if target_state:
             if component.state == target_state:
                 self.pi.update((cmd, component), '0')
                 self.logger.debug(
                     'successfully %sed %s' % (cmd, component.uri))
+                if tries:
+                    self.probe_statistics.record(component.uri, target_state, tries, sum(delays[:tries]))
             elif target_state in [yadtshell.settings.UPTODATE, 'rebooted']:
                 component.state = target_state
                 self.logger.debug('successfully %sed %s' % (target_state, component.uri))
             else:
-                max_tries = getattr(component, 'status_max_tries', 1)
+                if delays is None:
+                    delays = ProbePolicy.of(component).delays()
+                max_tries = len(delays)
                 if tries < max_tries:
-                    delay = 0
                     if tries > 0:
                         self.logger.info('    %s %s, try %i of %i' %
                                          (cmd, component.uri, tries, max_tries - 1))
-                        delay = 1
                     self.pi.update((cmd, component))
                     deferred = self.probe(
-                        component, delay=delay, target_state=target_state)
+                        component, delay=delays[tries], target_state=target_state)
                     deferred.addCallback(
-                        self.handle_output, cmd, component, target_state, tries + 1)
+                        self.handle_output, cmd, component, target_state, tries + 1, delays)
                     error_function = self.logger.error if tries + 1 == max_tries else self.logger.warning
                     deferred.addErrback(
                         yadtshell.twisted.report_error, error_function)
                     return deferred
+                self.probe_statistics.record(component.uri, target_state, tries, sum(delays), reached=False)
                 self.pi.update((cmd, component), 't')
                 raise yadtshell.actions.ActionException(
                     '%s could not reach target state %s, is still %s' % (
@@ -292,6 +525,16 @@ class ActionManager(object):
         p.target_state = target_state
         p.state = yadtshell.settings.UNKNOWN
 
+        if (self.command_channels and cmd in CHANNEL_COMMANDS and
+                self.command_channels.add(component, cmdline, p)):
+            self.logger.debug('cmd: %s (via channel)' % cmdline)
+            return p.deferred
+        if (self.command_batcher and cmd in BATCHED_SERVICE_COMMANDS and
+                isinstance(component, yadtshell.components.Service) and
+                self.command_batcher.add(component, cmdline, p)):
+            self.logger.debug('cmd: %s (batched)' % cmdline)
+            return p.deferred
+
         cmdline = shlex.split(cmdline)
         self.logger.debug('cmd: %s' % cmdline)
         reactor.spawnProcess(p, cmdline[0], cmdline, None)
@@ -302,6 +545,8 @@ class ActionManager(object):
             '    ${BOLD}%(uri)s finished successfully${NORMAL}' % vars(action)))
 
     def next_with_preconditions(self, queue):
+        if isinstance(queue, PreconditionQueue):
+            return queue.next_ready()
         for task in queue:
             action = task.action
             if not isinstance(action, yadtshell.actions.ActionPlan):
@@ -313,11 +558,29 @@ class ActionManager(object):
             return task
         return None
 
+    def update_demand(self, plan):
+        """Returns the number of host updates per group of a chunk of
+        actions, chunks of chunks are not limited themselves.
+        """
+        if not isinstance(plan, yadtshell.actions.ActionPlan):
+            return None
+        demand = {}
+        for action in plan.actions:
+            if isinstance(action, yadtshell.actions.ActionPlan):
+                return None
+            if (action.cmd == yadtshell.settings.UPDATE and action.uri.startswith('host://') and
+                    action.state != yadtshell.actions.State.FINISHED):
+                group = yadtshell.util.determine_host_group(action.uri, self.update_group_by)
+                demand[group] = demand.get(group, 0) + 1
+        return demand
+
     def calc_nr_workers(self, plan):
         if not self.parallel:
             return 1
         if self.parallel == 'max':
             return len(plan.actions)
+        if self.parallel == yadtshell.constants.ADAPTIVE_WORKERS:
+            return yadtshell.constants.ADAPTIVE_WORKERS
         try:
             return int(self.parallel)
         except Exception:
@@ -340,7 +603,9 @@ class ActionManager(object):
             plan_name = '/' + '/'.join(this_path)
             return yadtshell.defer.DeferredPool(plan_name, queue)
 
-        if not len(plan.actions):
+        actions = [plan_or_action for plan_or_action in plan.actions
+                   if getattr(plan_or_action, 'state', None) != yadtshell.actions.State.FINISHED]
+        if not actions:
             deferred = defer.Deferred()
             reactor.callLater(0, deferred.callback, None)
             return deferred
@@ -350,18 +615,27 @@ class ActionManager(object):
         this_path = path + [plan.name]
         plan_name = '/' + '/'.join(this_path)
 
-        for action in plan.actions:
+        for action in actions:
             queue.append(yadtshell.ActionManager.Task(
                 fun=self.handle, action=action, path=this_path))
-        plan.nr_workers = min(plan.nr_workers, len(queue))
+        queue = PreconditionQueue(queue, self.components, self.priorities,
+                                  self.update_limiter, self.update_demand)
+        concurrency = None
+        if plan.nr_workers == yadtshell.constants.ADAPTIVE_WORKERS:
+            concurrency = yadtshell.defer.AdaptiveConcurrency(len(queue), plan.nr_errors_tolerated)
+            nr_workers = len(queue)
+        else:
+            plan.nr_workers = nr_workers = min(plan.nr_workers, len(queue))
         self.logger.debug('%s : %s' % (plan_name, plan.meta_info()))
 
         pool = yadtshell.defer.DeferredPool(
             plan_name,
             queue,
-            nr_workers=plan.nr_workers,
+            nr_workers=nr_workers,
             next_task_fun=self.next_with_preconditions,
-            nr_errors_tolerated=plan.nr_errors_tolerated)
+            nr_errors_tolerated=plan.nr_errors_tolerated,
+            concurrency=concurrency)
+        pool.addBoth(queue.close)
         pool.addCallback(self.report_plan_finished, plan, plan_name)
         return pool
 
@@ -371,13 +645,26 @@ class ActionManager(object):
                dryrun=False,
                parallel=None,
                forcedyes=False,
+               resume=False,
                **kwargs):
         if not parallel:
             parallel = 1
         self.parallel = parallel
         self.dryrun = dryrun
-        self.components = yadtshell.util.restore_current_state()
-        self.orig_components = copy.deepcopy(self.components)
+        if yadtshell.settings.TARGET_SETTINGS.get('batch_service_commands', False):
+            self.command_batcher = CommandBatcher()
+        if yadtshell.settings.TARGET_SETTINGS.get('remote_channel', False):
+            self.command_channels = ChannelPool()
+        max_updates_per_group = yadtshell.settings.TARGET_SETTINGS.get(
+            'update_max_parallel_per_group', yadtshell.constants.UPDATE_MAX_PARALLEL_PER_GROUP_DEFAULT)
+        if max_updates_per_group:
+            self.update_limiter = yadtshell.defer.GroupLimiter(max_updates_per_group)
+            self.update_group_by = yadtshell.settings.TARGET_SETTINGS.get(
+                'update_group_by', yadtshell.constants.UPDATE_GROUP_BY_DEFAULT)
+        # a plan is resumed with the state it was planned with, which may be old
+        self.components = yadtshell.util.restore_current_state(must_be_fresh=not resume)
+        # states observed while running, persisted instead of all components
+        self.state_changes = {}
         action_plan_file = os.path.join(
             yadtshell.settings.OUT_DIR, flavor + '-action.plan')
         self.logger.debug('using action plan %s' % action_plan_file)
@@ -385,7 +672,7 @@ class ActionManager(object):
         action_plan = None
         try:
             f = open(action_plan_file)
-            action_plan = yaml.load(f, Loader=yaml_loader)
+            action_plan = load_plan(f)
             f.close()
         except IOError, e:
             self.logger.warning(str(e))
@@ -407,6 +694,13 @@ class ActionManager(object):
             host.state = yadtshell.settings.UNKNOWN
             host.probed = yadtshell.settings.UNKNOWN
 
+        self.journal_keys = action_keys(action_plan)
+        self.journal = ActionJournal(os.path.join(
+            yadtshell.settings.OUT_DIR, flavor + '-action.journal'), checksum_of(action_plan_file))
+        journal_states = self.journal.replay() if resume else {}
+        if resume and not journal_states:
+            self.logger.info('no progress recorded for %s, executing the whole plan' % action_plan_file)
+
         if dryrun:
             log_plan_fun = self.logger.info
         else:
@@ -424,12 +718,16 @@ class ActionManager(object):
                     os.remove(action_plan_file)
                 except Exception:
                     pass
-            f = open(
-                os.path.join(yadtshell.settings.OUT_DIR, 'current_state.components'), "w")
-            pickle.dump(self.orig_components, f, pickle.HIGHEST_PROTOCOL)
-            f.close()
+                self.journal.remove()
+            if self.state_changes:
+                yadtshell.util.store_current_state_changes(self.state_changes)
             return result
 
+        def hint_resume(reason):
+            if not self.dryrun:
+                self.logger.info('use "yadtshell resume %s" to continue with the unfinished actions' % flavor)
+            return reason
+
         def finish_progress_indicator(result, pi):
             if pi:
                 pi.finish()
@@ -446,11 +744,22 @@ class ActionManager(object):
                     yadtshell.twisted.stop_and_return(EXIT_CODE_CANCELED_BY_USER)
                     return defer.succeed(None)
 
+        if not dryrun:
+            self.journal.open(truncate=not journal_states)
         self.pi = yadtshell.twisted.ProgressIndicator()
         deferred = None
+        if not dryrun:
+            self.estimate_durations(action_plan)
+        self.priorities = create_priorities(action_plan, yadtshell.settings.TARGET_SETTINGS.get(
+            'schedule', SCHEDULE_QUEUE), self.durations, self.components)
         if not dryrun and "lock" not in flavor:
             deferred = yadtshell.util.start_ssh_multiplexed()
         try:
+            if resume:
+                if deferred:
+                    deferred.addCallback(self.resume_plan, action_plan, journal_states)
+                else:
+                    deferred = self.resume_plan(None, action_plan, journal_states)
             if deferred:
                 deferred.addCallback(self.handle_cb, action_plan)
             else:
@@ -461,8 +770,13 @@ class ActionManager(object):
 
         deferred.addErrback(yadtshell.twisted.report_error, self.logger.error)
         deferred.addCallback(remove_plan_file)
+        deferred.addErrback(hint_resume)
+        deferred.addBoth(self.journal.close)
+        deferred.addBoth(self.probe_statistics.log)
         deferred.addBoth(finish_progress_indicator, self.pi)
 
+        if self.command_channels:
+            deferred.addBoth(self.command_channels.close)
         if not dryrun and "lock" not in flavor:
             deferred.addBoth(yadtshell.util.stop_ssh_multiplexed)
 
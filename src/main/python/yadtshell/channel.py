@@ -0,0 +1,158 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Long-lived ssh sessions executing the remote commands of a host.
+
+Each channel runs a small command server in a shell on the host, which
+reads one request per line, consisting of a request id and a remote command
+line, runs the command in the background and prints the request id and the
+exit code when the command has finished. This saves the ssh process and the
+remote shell startup of each single command. The ready and exit code
+markers are printed to stderr, where the commands do not write to, so the
+output of a command cannot garble them. The output of the commands, both
+stdout and stderr, is printed to stdout and logged by the channel.
+
+When a channel cannot be established, its commands and all further commands
+of its host are spawned as processes of their own, as without channels.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import re
+import shlex
+from collections import OrderedDict
+
+from twisted.internet import protocol, reactor
+
+import yadtshell.settings
+from yadtshell.command_batch import finish_protocol, spawn, split_remote_call
+
+
+logger = logging.getLogger('channel')
+
+READY_MARKER = 'yadt-channel-ready'
+EXIT_CODE_MARKER = 'yadt-channel-exit'
+EXIT_CODE_PATTERN = re.compile(r'^%s (\d+) (\d+)$' % EXIT_CODE_MARKER)
+SERVER_SCRIPT = ('echo %s >&2; '
+                 'while read -r id cmd; do '
+                 '( (eval "$cmd") </dev/null 2>&1; echo "%s $id $?" >&2) & '
+                 'done; '
+                 'wait') % (READY_MARKER, EXIT_CODE_MARKER)
+
+
+class CommandChannel(protocol.ProcessProtocol):
+
+    def __init__(self, host, closed_fun):
+        self.host = host
+        self.closed_fun = closed_fun
+        self.logger = logging.getLogger(host)
+        self.out_buffer = ''
+        self.err_buffer = ''
+        self.ready = False
+        self.closed = False
+        self.next_request_id = 0
+        self.pending = OrderedDict()
+
+    def execute(self, cmdline, remote_command, process_protocol):
+        request_id = self.next_request_id
+        self.next_request_id += 1
+        self.pending[request_id] = (cmdline, process_protocol)
+        self.transport.write('%i %s\n' % (request_id, remote_command))
+
+    def outReceived(self, data):
+        lines = (self.out_buffer + data).split('\n')
+        self.out_buffer = lines.pop()
+        for line in lines:
+            self.logger.debug('%s: %s' % (self.host, line))
+
+    def errReceived(self, data):
+        lines = (self.err_buffer + data).split('\n')
+        self.err_buffer = lines.pop()
+        for line in lines:
+            self.control_line_received(line)
+
+    def control_line_received(self, line):
+        if line == READY_MARKER:
+            self.ready = True
+            return
+        match = EXIT_CODE_PATTERN.match(line)
+        if not match:
+            # e.g. warnings of ssh
+            self.logger.warning('%s channel stderr: %s' % (self.host, line))
+            return
+        request = self.pending.pop(int(match.group(1)), None)
+        if request:
+            finish_protocol(request[1], int(match.group(2)))
+
+    def processEnded(self, reason):
+        self.closed = True
+        requests = self.pending.values()
+        self.pending.clear()
+        if self.ready:
+            exit_code = reason.value.exitCode or 255
+            for _, process_protocol in requests:
+                finish_protocol(process_protocol, exit_code)
+        else:
+            logger.info('no channel to %s, spawning its commands one by one' % self.host)
+            for cmdline, process_protocol in requests:
+                spawn(cmdline, process_protocol)
+        self.closed_fun(self)
+
+    def close(self):
+        if not self.closed:
+            self.transport.closeStdin()
+
+
+class ChannelPool(object):
+
+    def __init__(self):
+        self.channels = {}
+        self.unavailable = set()
+
+    def add(self, component, cmdline, process_protocol):
+        """Executes the remote `cmdline` of `component` over the channel of
+        its host. Returns False if `cmdline` needs to be spawned on its own.
+        """
+        host, remote_command = split_remote_call(component, cmdline)
+        if not host or host in self.unavailable or '\n' in remote_command:
+            return False
+        channel = self.channels.get(host)
+        if channel is None:
+            channel = self.open(host)
+        channel.execute(cmdline, remote_command, process_protocol)
+        return True
+
+    def open(self, host):
+        logger.debug('opening channel to %s' % host)
+        channel = CommandChannel(host, self.channel_closed)
+        cmdline = shlex.split(yadtshell.settings.SSH) + [host, SERVER_SCRIPT]
+        reactor.spawnProcess(channel, cmdline[0], cmdline, None)
+        self.channels[host] = channel
+        return channel
+
+    def channel_closed(self, channel):
+        if not channel.ready:
+            self.unavailable.add(channel.host)
+        if self.channels.get(channel.host) is channel:
+            del self.channels[channel.host]
+
+    def close(self, result=None):
+        for channel in self.channels.values():
+            channel.close()
+        return result
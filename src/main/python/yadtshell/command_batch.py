@@ -0,0 +1,152 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Batching of the remote commands of services on the same host.
+
+Commands issued for the same host within a short window are merged into a
+single ssh invocation, running a script which executes them in parallel.
+When all commands finished, the script prints the output, the error output
+and the exit code of each command, every line marked with the index of its
+command. These are passed to the protocols of the single commands as if
+each command had been spawned on its own, so their output is only logged
+when the whole batch finished.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import re
+import shlex
+
+import twisted.internet.reactor as reactor
+import twisted.python.failure as failure
+from twisted.internet.error import ProcessDone, ProcessTerminated
+
+import yadtshell.settings
+import yadtshell.twisted
+
+
+logger = logging.getLogger('command_batch')
+
+BATCH_WINDOW_SECONDS = 0.05
+MARKER = 'yadt-batch'
+OUTPUT_PATTERN = re.compile(r'^%s-(out|err|exit) (\d+) (.*)$' % MARKER, re.MULTILINE)
+COMMAND_LINE = '( (%(command)s) >"$d/%(index)i.out" 2>"$d/%(index)i.err"; echo $? >"$d/%(index)i.exit" ) &'
+REPORT_LINE = ('for i in %(indices)s; do for kind in out err exit; do '
+               'awk -v p="%(marker)s-$kind $i" \'{ print p " " $0 }\' "$d/$i.$kind"; done; done')
+
+
+def create_batch_script(remote_commands):
+    """Returns a shell script running `remote_commands` in parallel. When
+    all of them finished, it prints each line of their output, error output
+    and exit code as `yadt-batch-KIND INDEX LINE`.
+    """
+    lines = ['d=$(mktemp -d)']
+    for index, remote_command in enumerate(remote_commands):
+        lines.append(COMMAND_LINE % {'command': remote_command, 'index': index})
+    lines.append('wait')
+    lines.append(REPORT_LINE % {'indices': ' '.join(str(index) for index in range(len(remote_commands))),
+                                'marker': MARKER})
+    lines.append('rm -rf "$d"')
+    return '\n'.join(lines)
+
+
+def split_remote_call(component, cmdline):
+    """Returns the host and the remote command line of `cmdline`, as created
+    by `Component.remote_call`, or (None, None) if it is no remote call.
+    """
+    host = getattr(component, 'fqdn', None) or getattr(component, 'host', None)
+    prefix = '%s %s ' % (yadtshell.settings.SSH, host)
+    if not host or not cmdline.startswith(prefix):
+        return None, None
+    # ssh joins its arguments to the remote command line
+    return host, ' '.join(shlex.split(cmdline[len(prefix):]))
+
+
+def finish_protocol(process_protocol, exit_code):
+    """Finishes `process_protocol` as if its process exited with `exit_code`."""
+    if exit_code == 0:
+        reason = ProcessDone(0)
+    else:
+        reason = ProcessTerminated(exitCode=exit_code)
+    process_protocol.finish(failure.Failure(reason))
+
+
+def spawn(cmdline, process_protocol):
+    cmdline = shlex.split(cmdline)
+    reactor.spawnProcess(process_protocol, cmdline[0], cmdline, None)
+
+
+def parse_batch_output(output):
+    """Returns a dict mapping the index of each command of a batch to a dict
+    with its output and error output and, if it finished, its exit code.
+    """
+    results = {}
+    for kind, index, line in OUTPUT_PATTERN.findall(output):
+        result = results.setdefault(int(index), {'out': '', 'err': ''})
+        if kind == 'exit':
+            result['exit'] = int(line)
+        else:
+            result[kind] += line + '\n'
+    return results
+
+
+class CommandBatcher(object):
+
+    def __init__(self, window=BATCH_WINDOW_SECONDS):
+        self.window = window
+        self.pending = {}
+
+    def add(self, component, cmdline, protocol):
+        """Adds the remote `cmdline` of `component` to the next batch of its
+        host. Returns False if `cmdline` is not a remote call, so it needs to
+        be spawned on its own.
+        """
+        host, remote_command = split_remote_call(component, cmdline)
+        if not host:
+            return False
+        if host not in self.pending:
+            self.pending[host] = []
+            reactor.callLater(self.window, self.flush, host)
+        self.pending[host].append((cmdline, remote_command, protocol))
+        return True
+
+    def flush(self, host):
+        batch = self.pending.pop(host, [])
+        if len(batch) == 1:
+            spawn(batch[0][0], batch[0][2])
+            return
+        logger.debug('running %i commands on %s at once' % (len(batch), host))
+        script = create_batch_script([entry[1] for entry in batch])
+        # the output is logged by the protocols of the single commands
+        batch_protocol = yadtshell.twisted.YadtProcessProtocol(
+            host, 'batch of %i commands' % len(batch), out_log_level=logging.NOTSET, log_prefix=host)
+        batch_protocol.deferred.addBoth(self.finish, batch_protocol, [entry[2] for entry in batch])
+        cmdline = shlex.split(yadtshell.settings.SSH) + [host, script]
+        reactor.spawnProcess(batch_protocol, cmdline[0], cmdline, None)
+
+    def finish(self, result, batch_protocol, protocols):
+        results = parse_batch_output(batch_protocol.data)
+        batch_exit_code = getattr(batch_protocol, 'exitcode', None) or 1
+        for index, protocol in enumerate(protocols):
+            result = results.get(index, {})
+            if result.get('out'):
+                protocol.outReceived(result['out'])
+            if result.get('err'):
+                protocol.errReceived(result['err'])
+            finish_protocol(protocol, result.get('exit', batch_exit_code))
@@ -36,6 +36,19 @@ import yadtshell
 
 logger = logging.getLogger('components')
 
+# functions called with (component, attribute name) whenever an attribute
+# of a component is set, see add_attribute_listener()
+_attribute_listeners = []
+
+
+def add_attribute_listener(listener):
+    _attribute_listeners.append(listener)
+
+
+def remove_attribute_listener(listener):
+    if listener in _attribute_listeners:
+        _attribute_listeners.remove(listener)
+
 
 class Component(object):
 
@@ -67,6 +80,12 @@ class Component(object):
         self.needs = set()
         self.needed_by = set()
 
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if _attribute_listeners:
+            for listener in _attribute_listeners[:]:
+                listener(self, name)
+
     def is_touched_also(self, other):
         return True
 
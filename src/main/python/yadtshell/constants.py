@@ -34,8 +34,25 @@ UNIGNORE = 'unignore'
 
 STANDALONE_SERVICE_RANK = 49152
 
+# nr_workers of plans whose parallelism adapts to their succeeding actions
+ADAPTIVE_WORKERS = 'adaptive'
+# nr_workers of a wave computed from the recorded durations of its actions
+WORKERS_BY_DURATIONS = 'auto'
+
 SSH_POLL_DELAY = 5
 SSH_POLL_MAX_SECONDS_DEFAULT = 120
 
+STATUS_MAX_PARALLEL_DEFAULT = 100
+STATUS_MAX_PARALLEL_PER_GROUP_DEFAULT = 0
+STATUS_GROUP_BY_DEFAULT = 'loc'
+
+UPDATE_MAX_PARALLEL_PER_GROUP_DEFAULT = 0
+UPDATE_GROUP_BY_DEFAULT = 'loc'
+
+STATUS_DUMP_FILES = 'files'
+STATUS_DUMP_GZIP = 'gzip'
+STATUS_DUMP_ARCHIVE = 'archive'
+STATUS_DUMP_DEFAULT = STATUS_DUMP_FILES
+
 TEN_MINUTES_IN_SECONDS = 60 * 10
 MAX_ALLOWED_AGE_OF_STATE_IN_SECONDS = TEN_MINUTES_IN_SECONDS
@@ -16,19 +16,120 @@
 
 from __future__ import absolute_import
 
+import bisect
+import itertools
 import logging
 import twisted.internet.defer as defer
 import twisted.internet.reactor as reactor
+from twisted.python.failure import Failure
 
 import yadtshell.actions
 import yadtshell.twisted
 
 
+# waiting workers are woken up by notify_state_change(), this is just a
+# fallback for state changes which are not notified
+IDLE_WORKER_POLL_SECONDS = 10
+
+_waiting_workers = []
+
+# returned by the next_task_fun of a DeferredPool when its remaining tasks
+# wait for a GroupLimiter, so its workers wait instead of giving up
+TASK_BLOCKED = object()
+
+
+def notify_state_change():
+    """Wakes up all workers waiting for a task, because a task finished
+    or a component changed its state.
+    """
+    waiting_workers = _waiting_workers[:]
+    del _waiting_workers[:]
+    for worker in waiting_workers:
+        worker.wake_up()
+
+
 def next_in_queue(queue):
     # return queue.popleft()
     return queue.pop(0)
 
 
+class AdaptiveConcurrency(object):
+
+    """Limits the number of running tasks of a DeferredPool, starting with a
+    single canary task. Each succeeded task allows one more running task,
+    which doubles the limit with each round of tasks. Each failed task halves
+    the limit, and the limit does not exceed the number of errors which are
+    still tolerated by more than one, so the running tasks cannot use up
+    more than the error budget.
+    """
+
+    def __init__(self, max_limit, nr_errors_tolerated=0):
+        self.max_limit = max(1, max_limit)
+        self.nr_errors_tolerated = int(nr_errors_tolerated)
+        self.error_count = 0
+        self.limit = 1
+        self.logger = logging.getLogger('adaptive_concurrency')
+
+    def task_done(self, succeeded):
+        if succeeded:
+            limit = self.limit + 1
+        else:
+            self.error_count += 1
+            limit = self.limit // 2
+        limit = max(1, min(limit, self.max_limit, self.nr_errors_tolerated - self.error_count + 1))
+        if limit != self.limit:
+            self.logger.debug('running up to %i tasks in parallel' % limit)
+        self.limit = limit
+
+
+class GroupLimiter(object):
+
+    """Limits the number of running units per group. A task demands units
+    of one or more groups, and starts only when all of its groups have room
+    for them. A group without running units admits any demand, so tasks
+    demanding more units than the limit still start.
+    """
+
+    def __init__(self, max_running_per_group):
+        self.max_running_per_group = int(max_running_per_group)
+        self.running_per_group = {}
+        self.logger = logging.getLogger('group_limiter')
+
+    def acquire(self, demand):
+        """Starts the units of `demand`, a dict mapping groups to their
+        number of units, and returns True, or False if a group has no room.
+        """
+        for group, units in demand.iteritems():
+            running = self.running_per_group.get(group, 0)
+            if running and running + units > self.max_running_per_group:
+                return False
+        for group, units in demand.iteritems():
+            self.running_per_group[group] = self.running_per_group.get(group, 0) + units
+        self.logger.debug('running per group: %s' % self.running_per_group)
+        return True
+
+    def release(self, demand):
+        for group, units in demand.iteritems():
+            self.running_per_group[group] -= units
+        notify_state_change()
+
+
+class AccountedTask(object):
+
+    """A task of a DeferredPool, calling `done_fun` with its result."""
+
+    def __init__(self, task, done_fun):
+        self.task = task
+        self.action = task.action
+        self.path = task.path
+        self.done_fun = done_fun
+
+    def fun(self, plan, path):
+        deferred = self.task.fun(plan=plan, path=path)
+        deferred.addBoth(self.done_fun)
+        return deferred
+
+
 class DeferredPool(defer.Deferred):
 
     class Worker(object):
@@ -41,6 +142,7 @@ class DeferredPool(defer.Deferred):
             self.stopped = False
             self.idle = True
             self.task = None
+            self.poll_call = None
 
         def run(self, lastResult=None):
             if self.stopped:
@@ -50,7 +152,7 @@ class DeferredPool(defer.Deferred):
             self.task = task
             if not task:
                 self.idle = True
-                reactor.callLater(1, self.run)
+                self.wait()
                 return None
             self.idle = False
             self.logger.debug('starting %s(..)' % task.fun.__name__)
@@ -58,9 +160,29 @@ class DeferredPool(defer.Deferred):
             d = task.fun(plan=task.action, path=task.path)
             d.addErrback(self.handle_error_fun)
             d.addErrback(yadtshell.twisted.report_error, self.logger.error)
-            d.addBoth(self.run)
+            d.addBoth(self.task_finished)
             return d
 
+        def task_finished(self, lastResult=None):
+            result = self.run(lastResult)
+            # this worker is woken up, too, if it did not find a task
+            notify_state_change()
+            return result
+
+        def wait(self):
+            if self not in _waiting_workers:
+                _waiting_workers.append(self)
+            if not self.poll_call or not self.poll_call.active():
+                self.poll_call = reactor.callLater(IDLE_WORKER_POLL_SECONDS, self.wake_up)
+
+        def wake_up(self):
+            if self in _waiting_workers:
+                _waiting_workers.remove(self)
+            if self.poll_call and self.poll_call.active():
+                self.poll_call.cancel()
+            self.poll_call = None
+            reactor.callLater(0, self.run)
+
         def __str__(self):
             try:
                 action = self.task.action
@@ -68,12 +190,16 @@ class DeferredPool(defer.Deferred):
                 action = "None"
             return "worker[%s], stopped: %s, idle: %s, action: %s" % (self.name, self.stopped, self.idle, action)
 
-    def __init__(self, name, queue, nr_workers=1, next_task_fun=next_in_queue, nr_errors_tolerated=0):
+    def __init__(self, name, queue, nr_workers=1, next_task_fun=next_in_queue, nr_errors_tolerated=0,
+                 concurrency=None):
         defer.Deferred.__init__(self)
         self.name = name
         self.next_task_fun = next_task_fun
         self.nr_errors_tolerated = int(nr_errors_tolerated)
         self.error_count = 0
+        # an optional AdaptiveConcurrency, limiting the running tasks below nr_workers
+        self.concurrency = concurrency
+        self.running = 0
         self.logger = logging.getLogger('%s' % self.name)
         self.queue = queue
         if not queue:
@@ -127,8 +253,12 @@ class DeferredPool(defer.Deferred):
                 'Queue is empty and all worker are idle, thus closing pool instance.')
             self._stop_workers()
             return None
+        if self.concurrency and self.running >= self.concurrency.limit:
+            return None
         fun = self.next_task_fun
         task = fun(self.queue)
+        if task is TASK_BLOCKED:
+            return None
         if not task:
             if self.all_workers_idle():
                 self.logger.debug(
@@ -137,12 +267,24 @@ class DeferredPool(defer.Deferred):
                     self.logger.debug("stopping %s" % worker)
                 self._stop_workers()
                 return None
+        elif self.concurrency:
+            self.running += 1
+            return AccountedTask(task, self._task_done)
         return task
 
+    def _task_done(self, result):
+        self.running -= 1
+        self.concurrency.task_done(not isinstance(result, Failure))
+        return result
+
     def _stop_workers(self):
         self.logger.debug('Stopping all workers..')
         for worker in self.workers:
             worker.stopped = True
+            if worker in _waiting_workers:
+                _waiting_workers.remove(worker)
+            if worker.poll_call and worker.poll_call.active():
+                worker.poll_call.cancel()
         if not self.called:
             self._finish()
 
@@ -151,3 +293,75 @@ class DeferredPool(defer.Deferred):
             if not worker.idle:
                 return False
         return True
+
+
+class FanOut(object):
+
+    """Limits the number of calls running concurrently, both overall and per
+    group of keys. Waiting calls are started by ascending priority, and in order
+    of submission for equal priorities. A limit of 0 means unlimited.
+    """
+
+    def __init__(self, name, max_running=0, max_running_per_group=0, group_fun=None):
+        self.name = name
+        self.max_running = int(max_running)
+        self.max_running_per_group = int(max_running_per_group)
+        self.group_fun = group_fun or (lambda key: None)
+        self.logger = logging.getLogger(name)
+        self.running = 0
+        self.running_per_group = {}
+        self.waiting = []
+        self._submission_counter = itertools.count()
+        self.draining = False
+        self.rescan = False
+
+    def submit(self, fun, args=(), key=None, priority=0):
+        deferred = defer.Deferred()
+        group = self.group_fun(key) if self.max_running_per_group else None
+        bisect.insort(self.waiting, (priority, next(self._submission_counter), group, fun, args, deferred))
+        self._start_waiting_calls()
+        return deferred
+
+    def _is_saturated(self):
+        return self.max_running and self.running >= self.max_running
+
+    def _is_group_saturated(self, group):
+        return (self.max_running_per_group and
+                self.running_per_group.get(group, 0) >= self.max_running_per_group)
+
+    def _start_waiting_calls(self):
+        # calls finishing or submitted while starting a call, e.g. synchronous
+        # ones, are picked up by the loop below instead of recursing into it
+        if self.draining:
+            self.rescan = True
+            return
+        self.draining = True
+        try:
+            index = 0
+            while index < len(self.waiting) and not self._is_saturated():
+                group = self.waiting[index][2]
+                if self._is_group_saturated(group):
+                    index += 1
+                    continue
+                _, _, group, fun, args, deferred = self.waiting.pop(index)
+                self._start(group, fun, args, deferred)
+                if self.rescan:
+                    self.rescan = False
+                    index = 0
+        finally:
+            self.draining = False
+        if self.waiting:
+            self.logger.debug('%i running, %i waiting' % (self.running, len(self.waiting)))
+
+    def _start(self, group, fun, args, deferred):
+        self.running += 1
+        self.running_per_group[group] = self.running_per_group.get(group, 0) + 1
+        call = defer.maybeDeferred(fun, *args)
+        call.addBoth(self._finished, group)
+        call.chainDeferred(deferred)
+
+    def _finished(self, result, group):
+        self.running -= 1
+        self.running_per_group[group] -= 1
+        self._start_waiting_calls()
+        return result
@@ -0,0 +1,191 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""The dependency graph of the components, as given by their `needs` and
+`needed_by` attributes.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import logging
+
+import yadtshell.components
+import yadtshell.settings
+from yadtshell.constants import STANDALONE_SERVICE_RANK
+from yadtshell.service_validation import Cycle
+
+
+logger = logging.getLogger('dependencies')
+
+
+def wire_dependencies(components):
+    """Resolves the needs of all components to the uris of the needed
+    components and makes `needs` and `needed_by` symmetric. Needed components
+    which are not known are added as MissingComponent.
+    """
+    for component in components.values():
+        resolved_needs = set()
+        for needed in getattr(component, 'needs', []):
+            needed_component = dict.get(components, needed)
+            if needed_component is None:
+                needed_component = yadtshell.components.MissingComponent(needed)
+                dict.__setitem__(components, needed, needed_component)
+            if not hasattr(needed_component, 'needed_by'):
+                needed_component.needed_by = set()
+            needed_component.needed_by.add(component.uri)
+            resolved_needs.add(needed_component.uri)
+        component.needs = resolved_needs
+
+    for component in components.values():
+        for dependent in getattr(component, 'needed_by', []):
+            dependent_component = dict.get(components, dependent)
+            if dependent_component is None:
+                logger.warning("unknown dependent key '%s'" % dependent)
+                continue
+            dependent_component.needs.add(component.uri)
+
+
+class DependencyIndex(object):
+
+    """The dependents of each component along `needs` or `needed_by`, looked
+    up once per component, for computing several closures over the same
+    components.
+    """
+
+    def __init__(self, components):
+        self.components = components
+        self._dependents = {}
+
+    def dependents(self, uri, key):
+        dependents = self._dependents.get((uri, key))
+        if dependents is None:
+            dependents = self._dependents[(uri, key)] = [
+                self.components[dependent_uri]
+                for dependent_uri in getattr(self.components[uri], key, [])]
+        return dependents
+
+    def closure(self, uris, key):
+        """Returns the uris of the components reached from `uris` along `key`,
+        including `uris`. A dependent is reached if it `is_touched_also` by
+        a reached component it depends on.
+        """
+        touched = set(uris)
+        frontier = collections.deque(touched)
+        while frontier:
+            uri = frontier.popleft()
+            component = self.components[uri]
+            for dependent in self.dependents(uri, key):
+                if dependent.uri in touched:
+                    continue
+                if dependent.is_touched_also(component):
+                    touched.add(dependent.uri)
+                    frontier.append(dependent.uri)
+        return touched
+
+
+def is_service_on_host(uri, host):
+    return uri.startswith('service://%s/' % host)
+
+
+def _raise_cycle(cycle):
+    raise EnvironmentError("""Found cycle(s) in service definition : \n%s""" %
+                           ("\t\t * %s" % Cycle(tuple(cycle))))
+
+
+def _find_cycle(edges, remaining):
+    """Returns a cycle within the `remaining` nodes, each of which has an
+    edge to another remaining node.
+    """
+    path = []
+    on_path = set()
+    uri = next(iter(remaining))
+    while uri not in on_path:
+        path.append(uri)
+        on_path.add(uri)
+        uri = next(edge for edge in edges[uri] if edge in remaining)
+    return path[path.index(uri):]
+
+
+def closure_sizes_on_same_host(components, edges_attr):
+    """Returns the number of distinct services on the same host each service
+    reaches by following `edges_attr` ('needs' or 'needed_by') transitively
+    on its host.
+
+    The closures are computed once per service in topological order, as
+    bitsets of the services of a host. Edges to other hosts are taken into
+    account for the order, so a cycle raises an EnvironmentError wherever
+    it is.
+    """
+    services = dict((component.uri, component) for component in components.values()
+                    if getattr(component, 'type', None) == yadtshell.settings.SERVICE)
+
+    edges = {}
+    reverse_edges = dict((uri, []) for uri in services)
+    for uri, service in services.iteritems():
+        edges[uri] = set(edge for edge in getattr(service, edges_attr, []) if edge in services)
+        for edge in edges[uri]:
+            reverse_edges[edge].append(uri)
+
+    bits = {}
+    bit_count_of_host = {}
+    for uri, service in services.iteritems():
+        bit_count = bit_count_of_host.get(service.host, 0)
+        bits[uri] = 1 << bit_count
+        bit_count_of_host[service.host] = bit_count + 1
+
+    pending = dict((uri, len(edges[uri])) for uri in services)
+    ready = [uri for uri, count in pending.iteritems() if count == 0]
+    closures = {}
+    while ready:
+        uri = ready.pop()
+        host = services[uri].host
+        closure = 0
+        for edge in edges[uri]:
+            if services[edge].host == host:
+                closure |= bits[edge] | closures[edge]
+        closures[uri] = closure
+        for dependent in reverse_edges[uri]:
+            pending[dependent] -= 1
+            if pending[dependent] == 0:
+                ready.append(dependent)
+
+    if len(closures) < len(services):
+        _raise_cycle(_find_cycle(edges, set(services) - set(closures)))
+
+    return dict((uri, bin(closure).count('1')) for uri, closure in closures.iteritems())
+
+
+def compute_dependency_scores(components):
+    """Sets the `dependency_score` of each service: the number of services on
+    the same host needing it, directly or transitively, minus the number of
+    services on the same host it needs, or STANDALONE_SERVICE_RANK if there
+    are none of both.
+    """
+    outbound = closure_sizes_on_same_host(components, 'needs')
+    inbound = closure_sizes_on_same_host(components, 'needed_by')
+
+    for component in components.values():
+        if not isinstance(component, yadtshell.components.Service):
+            continue
+        outbound_edges = outbound[component.uri]
+        inbound_edges = inbound[component.uri]
+        if outbound_edges == inbound_edges == 0:
+            component.dependency_score = STANDALONE_SERVICE_RANK
+        else:
+            component.dependency_score = inbound_edges - outbound_edges
@@ -0,0 +1,178 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""How long actions took in the past, to estimate how long they will take.
+
+Durations are appended to a tab separated file as one line per action:
+time, command, component uri, component class and duration in seconds.
+Each line is appended while holding a lock on a lock file next to it, so
+several yadtshell sessions can record durations at the same time. Only the
+latest samples of each (command, uri, class) are kept, the file is compacted
+to them when it grows too large and to more than twice their size. Compacting replaces the file while holding
+the same lock, so no session appends to the replaced file.
+"""
+
+from __future__ import absolute_import
+
+import collections
+import fcntl
+import logging
+import os
+import tempfile
+import time
+
+import yadtshell.settings
+
+
+logger = logging.getLogger('durations')
+
+SAMPLES_PER_KEY = 20
+MAX_FILE_SIZE = 1024 * 1024
+# bytes of a line besides command, uri and class: time, duration, tabs and newline
+LINE_OVERHEAD = 24
+
+
+def percentile(samples, p):
+    """Returns the `p` percentile (0..100) of `samples` by nearest rank."""
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(round(p / 100.0 * (len(ordered) - 1)))
+    return ordered[rank]
+
+
+def class_of(uri, components):
+    """Returns the name of the class of the component of `uri`, as used for
+    recording its durations, or None if it is unknown.
+    """
+    component = components.get(uri) if components else None
+    return type(component).__name__ if component is not None else None
+
+
+class DurationStore(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.samples = {}
+        self.samples_of_uri = {}
+        self.samples_of_class = {}
+        self.load()
+
+    def _add(self, cmd, uri, component_class, seconds):
+        for index, key in [(self.samples, (cmd, uri, component_class)),
+                           (self.samples_of_uri, (cmd, uri)),
+                           (self.samples_of_class, (cmd, component_class))]:
+            if key not in index:
+                index[key] = collections.deque(maxlen=SAMPLES_PER_KEY)
+            index[key].append(seconds)
+
+    def load(self):
+        try:
+            with open(self.filename) as f:
+                for line in f:
+                    try:
+                        _, cmd, uri, component_class, seconds = line.rstrip('\n').split('\t')
+                        self._add(cmd, uri, component_class, float(seconds))
+                    except ValueError:
+                        # a line written partially by a crashed session
+                        continue
+        except IOError:
+            pass
+
+    def compacted_size(self):
+        """Returns the estimated size of the file holding the latest samples."""
+        return sum(len(samples) * (len(cmd) + len(uri) + len(component_class) + LINE_OVERHEAD)
+                   for (cmd, uri, component_class), samples in self.samples.iteritems())
+
+    def _lock(self):
+        """Returns a file descriptor holding the exclusive lock on the file,
+        the lock is released by closing it.
+        """
+        lock_fd = os.open(self.filename + '.lock', os.O_WRONLY | os.O_CREAT, 0644)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+        except (IOError, OSError):
+            os.close(lock_fd)
+            raise
+        return lock_fd
+
+    def record(self, cmd, uri, component_class, seconds):
+        self._add(cmd, uri, component_class, seconds)
+        line = '%d\t%s\t%s\t%s\t%.3f\n' % (time.time(), cmd, uri, component_class, seconds)
+        try:
+            lock_fd = self._lock()
+            try:
+                # opened while locked, so it is not replaced by compacting
+                fd = os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0644)
+                try:
+                    os.write(fd, line)
+                    size = os.fstat(fd).st_size
+                finally:
+                    os.close(fd)
+            finally:
+                os.close(lock_fd)
+            if size > max(MAX_FILE_SIZE, 2 * self.compacted_size()):
+                self.compact()
+        except (IOError, OSError), e:
+            logger.debug('cannot record duration to %s: %s' % (self.filename, e))
+
+    def compact(self):
+        """Rewrites the file with the latest samples of each key, while
+        other sessions are locked out from appending.
+        """
+        lock_fd = self._lock()
+        try:
+            self.samples, self.samples_of_uri, self.samples_of_class = {}, {}, {}
+            self.load()
+            fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename) or '.',
+                                                 prefix='.durations')
+            now = time.time()
+            with os.fdopen(fd, 'w') as f:
+                for (cmd, uri, component_class), samples in self.samples.iteritems():
+                    for seconds in samples:
+                        f.write('%d\t%s\t%s\t%s\t%.3f\n' % (now, cmd, uri, component_class, seconds))
+            os.chmod(temp_filename, 0644)
+            os.rename(temp_filename, self.filename)
+        finally:
+            os.close(lock_fd)
+
+    def expected(self, cmd, uri, component_class=None, p=50):
+        """Returns the `p` percentile of the durations of `cmd` on `uri`, or
+        of `cmd` on components of the same class if there are none, or None.
+        """
+        samples = self.samples.get((cmd, uri, component_class)) or self.samples_of_uri.get((cmd, uri))
+        if not samples and component_class:
+            samples = self.samples_of_class.get((cmd, component_class))
+        return percentile(samples, p)
+
+    def expected_for_action(self, action, default=None, components=None):
+        """Returns the expected duration of `action`, falling back to the
+        durations of components of the same class in `components`.
+        """
+        expected = self.expected(action.cmd, action.uri, class_of(action.uri, components))
+        return default if expected is None else expected
+
+
+_duration_store = None
+
+
+def get_duration_store():
+    global _duration_store
+    if _duration_store is None:
+        _duration_store = DurationStore(os.path.join(yadtshell.settings.OUT_DIR, 'durations.tsv'))
+    return _duration_store
@@ -0,0 +1,119 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Execution journal of an action plan, for resuming an interrupted plan.
+
+The journal is a tab separated file next to the action plan. Its first line
+holds the checksum of the plan file, each further line the new state of an
+action (RUNNING when it is started, FINISHED when it succeeded and PENDING
+when it failed) and the key of the action. Each line is synced to disk
+before the action goes on, so the journal survives a crash of yadtshell
+or of the machine running it.
+"""
+
+from __future__ import absolute_import
+
+import hashlib
+import logging
+import os
+
+
+logger = logging.getLogger('journal')
+
+PLAN_CHECKSUM = 'plan'
+
+
+def action_keys(plan):
+    """Returns a dict mapping the id of each action of `plan` to its key,
+    which is the same when the plan is loaded again from its file.
+    """
+    return dict((id(action), '%i %s@%s' % (position, action.cmd, action.uri))
+                for position, action in enumerate(plan.list_actions))
+
+
+def checksum_of(filename):
+    with open(filename) as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+class ActionJournal(object):
+
+    def __init__(self, filename, plan_checksum):
+        self.filename = filename
+        self.plan_checksum = plan_checksum
+        self.fd = None
+
+    def _write(self, state, key):
+        os.write(self.fd, '%s\t%s\n' % (state, key))
+        os.fsync(self.fd)
+
+    def open(self, truncate=False):
+        """Opens the journal for appending, a truncated journal starts with
+        the checksum of the plan.
+        """
+        flags = os.O_WRONLY | os.O_APPEND | os.O_CREAT
+        if truncate:
+            flags |= os.O_TRUNC
+        try:
+            self.fd = os.open(self.filename, flags, 0644)
+            if truncate:
+                self._write(PLAN_CHECKSUM, self.plan_checksum)
+        except OSError, e:
+            logger.warning('cannot record progress to %s: %s' % (self.filename, e))
+            self.close()
+
+    def record(self, key, state):
+        if self.fd is None:
+            return
+        try:
+            self._write(state, key)
+        except OSError, e:
+            logger.warning('cannot record %s of %s to %s: %s' % (state, key, self.filename, e))
+
+    def replay(self):
+        """Returns a dict mapping the keys of the actions in the journal to
+        their last state, which is empty if the journal belongs to another plan.
+        """
+        states = {}
+        try:
+            with open(self.filename) as f:
+                lines = f.read().split('\n')
+        except IOError:
+            return states
+        header = lines[0].split('\t', 1)
+        if header != [PLAN_CHECKSUM, self.plan_checksum]:
+            logger.warning('%s does not belong to the current action plan, ignoring it' % self.filename)
+            return states
+        # the last line is empty, or was written partially by a crash
+        for line in lines[1:-1]:
+            state, key = line.split('\t', 1)
+            states[key] = state
+        return states
+
+    def close(self, result=None):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+        return result
+
+    def remove(self):
+        self.close()
+        try:
+            os.remove(self.filename)
+        except OSError:
+            pass
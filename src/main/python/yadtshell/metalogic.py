@@ -17,10 +17,12 @@
 #   along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import logging
-import yaml
+import math
 import fnmatch
 
 import yadtshell
+import yadtshell.durations
+from yadtshell.dependencies import DependencyIndex
 
 logger = logging.getLogger('metalogic')
 
@@ -86,8 +88,10 @@ def collect_parallel_tasks(g):
     yield(pt, last_indent)
 
 
-def metalogic(cmd, args, plan_post_handler=None):
-    components = yadtshell.util.restore_current_state()
+def metalogic(cmd, args, plan_post_handler=None, dependency_index=None):
+    if dependency_index is None:
+        dependency_index = DependencyIndex(yadtshell.util.restore_current_state())
+    components = dependency_index.components
     if not plan_post_handler:
         plan_post_handler = chop_minimal_related_chunks
 
@@ -113,21 +117,9 @@ def metalogic(cmd, args, plan_post_handler=None):
         logger.debug('touched component: %s' % c.uri)
 
     logger.debug('search recursivly for dependent components')
-    new_components = True
-    while new_components:
-        new_components = set()
-        for component in touched_components:
-            logger.debug('  processing %s' % component.uri)
-            for dependent_uri in getattr(component, key, []):
-                dependent = components[dependent_uri]
-                logger.debug('    checking %s' % dependent.uri)
-                if dependent in touched_components:
-                    logger.debug('    already found: %s' % dependent_uri)
-                    continue
-                if dependent.is_touched_also(component):
-                    new_components.add(dependent)
-        touched_components.update(new_components)
-        logger.debug('    new found: %s' % ', '.join(map(str, new_components)))
+    touched_uris = [uri for uri in touched_uris if uri in touched_components]
+    for uri in dependency_index.closure(touched_uris, key):
+        touched_components.add(uri)
 
     for component in touched_components:
         logger.debug('touched component: %s' % component.uri)
@@ -152,13 +144,42 @@ def metalogic(cmd, args, plan_post_handler=None):
     return plan_post_handler(dependencies)
 
 
-def merge_chunks(component_to_chunk, old, new):
-    if old == new:
-        return
-    logger.debug('    merging chunk %(old)s with chunk %(new)s' % locals())
-    for uri, old_chunk_nr in component_to_chunk.iteritems():
-        if old_chunk_nr == old:
-            component_to_chunk[uri] = new
+class DisjointSet(object):
+
+    """Disjoint sets of items, with path compression. Each set is labelled
+    with the smallest label of its items.
+    """
+
+    def __init__(self):
+        self.parent = {}
+        self.labels = {}
+
+    def __contains__(self, item):
+        return item in self.parent
+
+    def add(self, item, label):
+        if item not in self.parent:
+            self.parent[item] = item
+            self.labels[item] = label
+
+    def find(self, item):
+        root = item
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[item] != root:
+            self.parent[item], item = root, self.parent[item]
+        return root
+
+    def union(self, item, other):
+        root, other_root = self.find(item), self.find(other)
+        if root == other_root:
+            return
+        if self.labels[other_root] < self.labels[root]:
+            root, other_root = other_root, root
+        self.parent[other_root] = root
+
+    def label_of(self, item):
+        return self.labels[self.find(item)]
 
 
 def identity(x):
@@ -166,52 +187,70 @@ def identity(x):
 
 
 def chop_minimal_related_chunks(plan):
-    component_to_chunk = {}
+    """Splits `plan` into chunks of actions which are related by their
+    preconditions, preconditions on components without actions in `plan`
+    do not relate actions.
+    """
+    chunks = DisjointSet()
     for nr, action in enumerate(plan.actions):
-        cmd = action.cmd
-        uri = action.uri
-        logger.debug('uri found: %s' % uri)
-        if uri not in component_to_chunk:
-            component_to_chunk[uri] = nr + 1
-    logger.debug(yaml.dump(component_to_chunk))
+        chunks.add(action.uri, nr + 1)
 
     for action in plan.actions:
-        cmd = action.cmd
-        uri = action.uri
-        chunk_nr = component_to_chunk.get(uri, None)
-        logger.debug('uri: %(uri)s, chunk: %(chunk_nr)s' % locals())
-        preconds = action.preconditions
-        for precond in preconds:
-            puri = precond.uri
-            if puri in component_to_chunk:
-                chunk_nr = min(component_to_chunk[puri], chunk_nr)
-                logger.debug('    chunk member found: %(puri)s' % locals())
-        logger.debug('    new chunk nr: %s' % chunk_nr)
-        merge_chunks(component_to_chunk, component_to_chunk[uri], chunk_nr)
-        for precond in preconds:
-            puri = precond.uri
-            precond_chunk_nr = component_to_chunk.get(puri)
-            if not precond_chunk_nr:
-                logger.debug('        interesting, %s not in plan, assuming up' % puri)
-                continue
-            logger.debug('    precond: %(puri)s %(precond_chunk_nr)s' % locals())
-            merge_chunks(component_to_chunk, precond_chunk_nr, chunk_nr)
+        for precond in action.preconditions:
+            if precond.uri in chunks:
+                chunks.union(action.uri, precond.uri)
+            else:
+                logger.debug('        interesting, %s not in plan, assuming up' % precond.uri)
+
+    chunk_nrs = set(chunks.label_of(uri) for uri in chunks.parent)
+    chunk_actions = dict((chunk_nr, set()) for chunk_nr in chunk_nrs)
+    for action in plan.actions:
+        chunk_actions[chunks.label_of(action.uri)].add(action)
 
     chunk_plans = set()
-    for nr, chunk_nr in enumerate(set(component_to_chunk.values())):
-        logger.debug('collecting components in chunk %s' % chunk_nr)
-        chunk_actions = set()
-        for action in plan.actions:
-            if component_to_chunk[action.uri] == chunk_nr:
-                chunk_actions.add(action)
-        chunk_plan = yadtshell.actions.ActionPlan('chunk_%s' % nr, chunk_actions)
-        chunk_plans.add(chunk_plan)
+    for nr, chunk_nr in enumerate(chunk_nrs):
+        chunk_plans.add(yadtshell.actions.ActionPlan('chunk_%s' % nr, chunk_actions[chunk_nr]))
     if len(chunk_plans) > 1:
         logger.debug('%i independent chunks found' % len(chunk_plans))
 
     return yadtshell.actions.ActionPlan(plan.name, chunk_plans)
 
 
+def nr_workers_by_durations(plans_or_actions, durations, components=None):
+    """Returns the number of workers needed to finish `plans_or_actions` in
+    about the expected time of the longest one. More workers would not
+    finish them earlier.
+    """
+    expected = []
+    for plan_or_action in plans_or_actions:
+        if isinstance(plan_or_action, yadtshell.actions.ActionPlan):
+            actions = list(plan_or_action.list_actions)
+        else:
+            actions = [plan_or_action]
+        expected.append([durations.expected_for_action(action, components=components) for action in actions])
+    known = [duration for durations_of_item in expected for duration in durations_of_item
+             if duration is not None]
+    if not known:
+        return len(plans_or_actions)
+    default = yadtshell.durations.percentile(known, 50)
+    totals = [sum(default if duration is None else duration for duration in durations_of_item)
+              for durations_of_item in expected]
+    longest = max(totals)
+    if not longest:
+        return len(plans_or_actions)
+    return max(1, min(len(plans_or_actions), int(math.ceil(sum(totals) / longest))))
+
+
+def _components_for_durations():
+    """Returns the current state, for looking up the classes of components
+    without durations of their own, or None if there is none.
+    """
+    try:
+        return yadtshell.util.restore_current_state(must_be_fresh=False)
+    except IOError:
+        return None
+
+
 def apply_instructions(plan, instructions):
     logger = logging.getLogger('apply_instructions')
     logger.debug('-' * 20 + ' original plan ' + '-' * 20)
@@ -227,6 +266,15 @@ def apply_instructions(plan, instructions):
         subplans[sp[0]] = sp[1]
         subplans_ordered.append(sp[0])
 
+    if instructions == yadtshell.constants.WORKERS_BY_DURATIONS:
+        raise ValueError('%s is a number of workers of a wave, e.g. update=*_%s_0, use %s for adaptive parallelism'
+                         % (instructions, instructions, yadtshell.constants.ADAPTIVE_WORKERS))
+    if instructions == yadtshell.constants.ADAPTIVE_WORKERS:
+        for sp in subplans.values():
+            if not sp.nr_workers:
+                sp.nr_workers = yadtshell.constants.ADAPTIVE_WORKERS
+        return plan
+
     try:
         instructions = int(instructions)
         for sp in subplans.values():
@@ -260,6 +308,10 @@ def apply_instructions(plan, instructions):
                     break
                 if nr_workers in ['*', 'max']:
                     nr_workers = len(acs)
+                elif nr_workers == yadtshell.constants.WORKERS_BY_DURATIONS:
+                    nr_workers = nr_workers_by_durations(acs, yadtshell.durations.get_duration_store(),
+                                                         _components_for_durations())
+                    logger.info('using %i workers for %s, according to recorded durations' % (nr_workers, name))
                 nr_workers = int(nr_workers)
 
                 if nr_errors_tolerated.endswith('%'):
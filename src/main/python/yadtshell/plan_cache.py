@@ -0,0 +1,174 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Cache of the action plans of commands, so the plan of a command given
+again on an unchanged target (e.g. after a dry run) is not computed again.
+
+A cached plan is a copy of the dumped action plan. It is found by the
+fingerprint of the current state, the command, its uris, the options and
+target settings planning depends on and, for worker counts computed from
+them, the recorded durations of actions. The fingerprint covers the
+attributes of the components planning depends on and is stored with the
+state by each status. A state changed in place by the actions of a command
+has no fingerprint, its plans are not cached. Storing a plan removes the
+plans of other fingerprints.
+"""
+
+from __future__ import absolute_import
+
+import glob
+import hashlib
+import logging
+import os
+import re
+import shutil
+import tempfile
+from functools import wraps
+
+import yadtshell.constants
+import yadtshell.durations
+import yadtshell.settings
+import yadtshell.util
+
+
+logger = logging.getLogger('plan_cache')
+
+PLANNING_ATTRIBUTES = ['type', 'state', 'needs', 'needed_by', 'host_uri', 'revision',
+                       'next_artefacts', 'is_readonly', 'is_ignored', 'is_locked', 'lockstate',
+                       'reboot_required_after_next_update',
+                       'reboot_required_to_activate_latest_kernel']
+
+
+def _normalized(value):
+    if isinstance(value, (set, frozenset)):
+        return sorted(_normalized(item) for item in value)
+    if isinstance(value, dict):
+        return sorted((key, _normalized(item)) for key, item in value.iteritems())
+    if isinstance(value, (list, tuple)):
+        return [_normalized(item) for item in value]
+    return value
+
+
+def fingerprint_of(components):
+    """Returns a checksum of the planning attributes of `components`."""
+    checksum = hashlib.sha1()
+    for key in sorted(components.keys()):
+        component = components[key]
+        checksum.update(repr((key, type(component).__name__,
+                              [_normalized(getattr(component, attr, None)) for attr in PLANNING_ATTRIBUTES])))
+    return checksum.hexdigest()
+
+
+def uses_recorded_durations(parallel):
+    """Returns True if the PSPEC `parallel` computes worker counts from the
+    recorded durations of actions.
+    """
+    return yadtshell.constants.WORKERS_BY_DURATIONS in re.split(r'[\s=:_]', str(parallel or ''))
+
+
+def _durations_checksum():
+    samples = yadtshell.durations.get_duration_store().samples
+    return hashlib.sha1(repr(sorted((key, list(seconds)) for key, seconds in samples.iteritems()))).hexdigest()
+
+
+def _copy(source, target):
+    """Replaces `target` with a copy of `source`."""
+    fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(target), prefix='.plan')
+    os.close(fd)
+    try:
+        shutil.copyfile(source, temp_filename)
+        os.rename(temp_filename, target)
+    except (IOError, OSError):
+        os.remove(temp_filename)
+        raise
+
+
+class PlanCache(object):
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def key_for(self, fingerprint, flavor, uris, parallel):
+        options = (flavor, sorted(uris or []), parallel,
+                   bool(yadtshell.settings.reboot_disabled),
+                   bool(yadtshell.settings.ignore_unreachable_hosts),
+                   _normalized(yadtshell.settings.TARGET_SETTINGS),
+                   _durations_checksum() if uses_recorded_durations(parallel) else None)
+        return '%s-%s' % (fingerprint, hashlib.sha1(repr(options)).hexdigest())
+
+    def entry(self, key):
+        return os.path.join(self.directory, key + '.plan')
+
+    def restore(self, key, flavor):
+        """Restores the cached plan of `key` as the action plan of `flavor`,
+        returns False if there is none.
+        """
+        if not os.path.exists(self.entry(key)):
+            return False
+        try:
+            _copy(self.entry(key), os.path.join(yadtshell.settings.OUT_DIR, flavor + '-action.plan'))
+        except (IOError, OSError), e:
+            logger.debug('cannot restore cached plan %s: %s' % (key, e))
+            return False
+        return True
+
+    def store(self, key, flavor):
+        """Caches the action plan of `flavor` as the plan of `key`."""
+        fingerprint = key.split('-', 1)[0]
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            for entry in glob.glob(os.path.join(self.directory, '*.plan')):
+                if not os.path.basename(entry).startswith(fingerprint + '-'):
+                    os.remove(entry)
+            _copy(os.path.join(yadtshell.settings.OUT_DIR, flavor + '-action.plan'), self.entry(key))
+        except (IOError, OSError), e:
+            logger.debug('cannot cache plan %s: %s' % (key, e))
+
+
+def get_plan_cache():
+    return PlanCache(os.path.join(yadtshell.settings.OUT_DIR, 'plan-cache'))
+
+
+def cached_plan(flavor):
+    """Decorates a function dumping the action plan of `flavor` for the
+    uris given as its second argument and returning `flavor`. The function
+    is skipped if the plan for these uris is cached for the current state.
+    """
+    def cached_plan_of_function(function):
+        @wraps(function)
+        def restore_or_compute_plan(*args, **kwargs):
+            uris = args[1] if len(args) > 1 else None
+            key = None
+            if yadtshell.settings.TARGET_SETTINGS.get('plan_cache', True):
+                try:
+                    fingerprint = getattr(yadtshell.util.restore_current_state(), 'fingerprint', None)
+                except IOError:
+                    fingerprint = None
+                if fingerprint:
+                    cache = get_plan_cache()
+                    key = cache.key_for(fingerprint, flavor, uris, kwargs.get('parallel'))
+                    if cache.restore(key, flavor):
+                        logger.info('target unchanged, using the cached %s plan' % flavor)
+                        return flavor
+            result = function(*args, **kwargs)
+            if key and result == flavor:
+                cache.store(key, flavor)
+            return result
+        return restore_or_compute_plan
+    return cached_plan_of_function
@@ -0,0 +1,127 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Serialization of action plans as versioned JSON.
+
+A plan file is an object with the format name, its version and the plan:
+
+    {"format": "yadtshell-plan", "version": 1, "plan": PLAN}
+
+    PLAN:   {"name": ..., "workers": ..., "errors": ..., "actions": [PLAN or ACTION, ...]}
+    ACTION: {"cmd": ..., "uri": ..., "attr": ..., "value": ...,
+             "preconditions": [[uri, attr, value], ...], "args": [...], "kwargs": {...}}
+
+Keys of an action which hold their default (no attr, no preconditions, ...)
+are left out. Plan files written as YAML by former versions can still be
+read.
+"""
+
+from __future__ import absolute_import
+
+import json
+import logging
+
+try:
+    from yaml import CLoader as yaml_loader
+except ImportError:
+    from yaml import Loader as yaml_loader
+import yaml
+
+from yadtshell.actions import Action, ActionPlan, TargetState
+
+
+logger = logging.getLogger('plan_format')
+
+FORMAT_NAME = 'yadtshell-plan'
+FORMAT_VERSION = 1
+
+
+def _str(value):
+    """Returns `value` with its unicode strings, as read from JSON, encoded
+    to str like the strings of planned actions.
+    """
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [_str(item) for item in value]
+    if isinstance(value, dict):
+        return dict((_str(key), _str(item)) for key, item in value.iteritems())
+    return value
+
+
+def to_dict(plan_or_action):
+    if isinstance(plan_or_action, ActionPlan):
+        return {'name': plan_or_action.name,
+                'workers': plan_or_action.nr_workers,
+                'errors': plan_or_action.nr_errors_tolerated,
+                'actions': [to_dict(item) for item in plan_or_action.actions]}
+    action = plan_or_action
+    result = {'cmd': action.cmd, 'uri': action.uri}
+    if action.attr is not None:
+        result['attr'] = action.attr
+        result['value'] = action.target_value
+    if action.preconditions:
+        result['preconditions'] = sorted([precondition.uri, precondition.attr, precondition.target_value]
+                                         for precondition in action.preconditions)
+    if action.args:
+        result['args'] = list(action.args)
+    if action.kwargs:
+        result['kwargs'] = action.kwargs
+    if action.is_executed():
+        result['executed'] = True
+    return result
+
+
+def from_dict(data):
+    if 'actions' in data:
+        return ActionPlan(_str(data['name']),
+                          [from_dict(item) for item in data['actions']],
+                          nr_workers=_str(data.get('workers')),
+                          nr_errors_tolerated=data.get('errors', 0))
+    action = Action(_str(data['cmd']), _str(data['uri']), _str(data.get('attr')), _str(data.get('value')),
+                    preconditions=set(TargetState(*_str(precondition))
+                                      for precondition in data.get('preconditions', [])),
+                    args=_str(data.get('args')),
+                    kwargs=_str(data.get('kwargs')))
+    if data.get('executed'):
+        action.mark_executed()
+    return action
+
+
+def dump(plan, f):
+    json.dump({'format': FORMAT_NAME, 'version': FORMAT_VERSION, 'plan': to_dict(plan)},
+              f, separators=(',', ':'))
+
+
+def load(f):
+    """Returns the plan read from the file `f`, or None if it is empty."""
+    content = f.read()
+    if not content.strip():
+        return None
+    if not content.lstrip().startswith('{'):
+        logger.debug('reading plan of a former version written as YAML')
+        return yaml.load(content, Loader=yaml_loader)
+    data = json.loads(content)
+    if data.get('format') != FORMAT_NAME or data.get('version') != FORMAT_VERSION:
+        raise ValueError('unknown plan format %s version %s' % (data.get('format'), data.get('version')))
+    return from_dict(data['plan'])
+
+
+def export_yaml(plan, f):
+    """Writes `plan` as YAML, for reading by humans."""
+    yaml.dump(plan, f)
@@ -0,0 +1,129 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""When to probe a service again while it has not reached its target state.
+
+The first probe is done immediately, the next one after a short delay, and
+the following ones after exponentially growing, jittered delays until the
+maximum total wait of the service is reached. All values can be given as
+attributes of a service (class):
+
+- `status_first_probe_delay`: delay of the second probe
+- `status_probe_delay`: delay of the third probe, doubled for each further probe
+- `status_max_probe_delay`: upper bound of a single delay
+- `status_probe_jitter`: delays vary randomly by this fraction
+- `status_max_wait`: maximum total wait for the target state
+
+Services which only define the legacy `status_max_tries` wait as long as
+they did before, i.e. one second for each further try.
+"""
+
+from __future__ import absolute_import
+
+import logging
+import random
+
+
+logger = logging.getLogger('probe_policy')
+
+FIRST_PROBE_DELAY_DEFAULT = 0.2
+PROBE_DELAY_DEFAULT = 0.5
+MAX_PROBE_DELAY_DEFAULT = 10
+PROBE_JITTER_DEFAULT = 0.1
+MAX_WAIT_DEFAULT = 0
+LEGACY_STATUS_DELAY = 1
+
+
+class ProbePolicy(object):
+
+    def __init__(self,
+                 max_wait=MAX_WAIT_DEFAULT,
+                 first_delay=FIRST_PROBE_DELAY_DEFAULT,
+                 delay=PROBE_DELAY_DEFAULT,
+                 max_delay=MAX_PROBE_DELAY_DEFAULT,
+                 jitter=PROBE_JITTER_DEFAULT):
+        self.max_wait = max_wait
+        self.first_delay = first_delay
+        self.delay = delay
+        self.max_delay = max(max_delay, delay)
+        self.jitter = jitter
+
+    @classmethod
+    def of(cls, component):
+        max_wait = getattr(component, 'status_max_wait', None)
+        if max_wait is None:
+            max_tries = getattr(component, 'status_max_tries', 1)
+            max_wait = (max_tries - 1) * LEGACY_STATUS_DELAY
+        return cls(max_wait=max_wait,
+                   first_delay=getattr(component, 'status_first_probe_delay', FIRST_PROBE_DELAY_DEFAULT),
+                   delay=getattr(component, 'status_probe_delay', PROBE_DELAY_DEFAULT),
+                   max_delay=getattr(component, 'status_max_probe_delay', MAX_PROBE_DELAY_DEFAULT),
+                   jitter=getattr(component, 'status_probe_jitter', PROBE_JITTER_DEFAULT))
+
+    def _jittered(self, delay):
+        if not self.jitter:
+            return delay
+        return delay * random.uniform(1 - self.jitter, 1 + self.jitter)
+
+    def delays(self):
+        """Returns the delays before each probe, the first one is 0. The
+        delays add up to `max_wait`, the last one is shortened to probe
+        once more at the end of the maximum wait.
+        """
+        delays = [0]
+        remaining = self.max_wait
+        next_delay = self.first_delay
+        while remaining > 0:
+            delay = self._jittered(min(next_delay, self.max_delay))
+            if delay >= remaining:
+                delays.append(remaining)
+                break
+            delays.append(delay)
+            remaining -= delay
+            next_delay = self.delay if len(delays) == 2 else next_delay * 2
+        return delays
+
+
+class ProbeStatistics(object):
+
+    """Number of probes needed by each service for each state transition."""
+
+    def __init__(self):
+        self.transitions = {}
+
+    def record(self, uri, target_state, probes, waited, reached=True):
+        self.transitions.setdefault(uri, []).append((target_state, probes, waited, reached))
+
+    def log(self, result=None):
+        if not self.transitions:
+            return result
+        probes = 0
+        count = 0
+        for uri in sorted(self.transitions):
+            for target_state, nr_probes, waited, reached in self.transitions[uri]:
+                logger.debug('%s: %i probe(s) within %.1fs until %s %s' % (
+                    uri, nr_probes, waited, target_state, 'reached' if reached else 'not reached'))
+                probes += nr_probes
+                count += 1
+        slowest_uri, slowest = max(
+            ((uri, transition) for uri, transitions in self.transitions.iteritems()
+             for transition in transitions),
+            key=lambda uri_and_transition: uri_and_transition[1][1])
+        logger.info('%i state transition(s) needed %i probe(s), at most %i for %s to become %s' % (
+            count, probes, slowest[1], slowest_uri, slowest[0]))
+        return result
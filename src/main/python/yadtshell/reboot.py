@@ -20,6 +20,8 @@ import logging
 
 import yadtshell
 from yadtshell.actions import ActionPlan, Action, TargetState
+from yadtshell.dependencies import DependencyIndex
+from yadtshell.plan_cache import cached_plan
 from yadtshell.helper import expand_hosts, glob_hosts
 from yadtshell.update import get_all_adjacent_needed_hosts
 from yadtshell.metalogic import (metalogic,
@@ -34,6 +36,7 @@ logger = logging.getLogger('reboot')
 
 
 @log_exceptions(logger)
+@cached_plan('reboot')
 def reboot(protocol=None, uris=None, parallel=None, **kwargs):
     for uri in uris:
         if not uri.startswith("host://"):
@@ -46,7 +49,8 @@ def reboot(protocol=None, uris=None, parallel=None, **kwargs):
     host_uris = glob_hosts(components, host_uris)
 
     hosts_to_reboot = uris
-    stop_plan = create_plan_to_stop_all_services_on(hosts_to_reboot)
+    dependency_index = DependencyIndex(components)
+    stop_plan = create_plan_to_stop_all_services_on(hosts_to_reboot, dependency_index)
 
     all_stopped_services = set()
     for action in stop_plan.actions:
@@ -54,7 +58,8 @@ def reboot(protocol=None, uris=None, parallel=None, **kwargs):
 
     start_plan = create_plan_to_start_services_after_rebooting(all_stopped_services,
                                                                hosts_to_reboot,
-                                                               components)
+                                                               components,
+                                                               dependency_index)
 
     reboot_actions = set([create_reboot_action_for(components[host_uri]) for host_uri in hosts_to_reboot])
 
@@ -98,18 +103,20 @@ def create_reboot_action_for(host):
     return reboot_host_action
 
 
-def create_plan_to_stop_all_services_on(host_uris):
+def create_plan_to_stop_all_services_on(host_uris, dependency_index=None):
     return metalogic(
         yadtshell.settings.STOP,
         host_uris,
-        plan_post_handler=identity)
+        plan_post_handler=identity,
+        dependency_index=dependency_index)
 
 
-def create_plan_to_start_services_after_rebooting(services, rebooted_hosts, components):
+def create_plan_to_start_services_after_rebooting(services, rebooted_hosts, components, dependency_index=None):
     start_plan = metalogic(
         yadtshell.settings.START,
         services,
-        plan_post_handler=identity)
+        plan_post_handler=identity,
+        dependency_index=dependency_index)
 
     for start_action in start_plan.actions:
         if start_action.uri in services:
@@ -18,6 +18,7 @@
 
 from __future__ import (absolute_import, print_function)
 from logging import getLogger
+from urlparse import urlparse
 
 try:
     from StringIO import StringIO  # py2
@@ -27,14 +28,20 @@ except ImportError:
 from twisted.internet import defer, reactor
 from twisted.internet.protocol import Protocol
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, FileBodyProducer
+from twisted.web.client import Agent, FileBodyProducer, HTTPConnectionPool
 from twisted.web.http_headers import Headers
 
+from yadtshell.defer import FanOut
+
 
 logger = getLogger("rest_library")
 
 
 HTTP_CONNECT_TIMEOUT_IN_SECONDS = 30
+HTTP_MAX_CONNECTIONS_PER_HOST = 10
+
+_agent = None
+_request_fan_out = None
 
 
 class HTTP_METHOD(object):
@@ -43,10 +50,35 @@ class HTTP_METHOD(object):
     PUT = "PUT"
 
 
-def rest_call(url, http_method=HTTP_METHOD.GET, headers=Headers(), data=""):
+def get_agent():
+    """
+    Returns the agent shared by all rest calls. Its connections are kept
+    alive and reused, and closed when the reactor shuts down.
+    """
+    global _agent
+    if _agent is None:
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = HTTP_MAX_CONNECTIONS_PER_HOST
+        reactor.addSystemEventTrigger('before', 'shutdown', pool.closeCachedConnections)
+        _agent = Agent(reactor, None, connectTimeout=HTTP_CONNECT_TIMEOUT_IN_SECONDS, pool=pool)
+    return _agent
+
+
+def get_request_fan_out():
+    global _request_fan_out
+    if _request_fan_out is None:
+        _request_fan_out = FanOut('rest_fan_out',
+                                  max_running_per_group=HTTP_MAX_CONNECTIONS_PER_HOST,
+                                  group_fun=lambda url: urlparse(url).netloc)
+    return _request_fan_out
+
+
+def rest_call(url, http_method=HTTP_METHOD.GET, headers=None, data=""):
     """
     Returns a deferred that will callback with the response to a rest call
     or fire its err-back when a response code != 200 is received.
+    At most HTTP_MAX_CONNECTIONS_PER_HOST calls to the same host are
+    running at the same time, the others are waiting for a free connection.
 
     Required positional arguments:
     -------------------------------
@@ -66,23 +98,30 @@ def rest_call(url, http_method=HTTP_METHOD.GET, headers=Headers(), data=""):
         string with data to submit - no special treatment (e.G. no URL encoding!)
     """
 
+    if headers is None:
+        headers = Headers()
     headers.addRawHeader("Content-Type", "text/plain")
 
-    agent = Agent(reactor, None, connectTimeout=HTTP_CONNECT_TIMEOUT_IN_SECONDS)
+    return get_request_fan_out().submit(_request,
+                                        args=(url, http_method, headers, data),
+                                        key=url)
+
 
-    deferred = agent.request(http_method,
-                             url,
-                             headers,
-                             FileBodyProducer(StringIO(data)) if data else None)
+def _request(url, http_method, headers, data):
+    deferred = get_agent().request(http_method,
+                                   url,
+                                   headers,
+                                   FileBodyProducer(StringIO(data)) if data else None)
     deferred.addCallback(read_response)
     return deferred
 
 
 def read_response(response):
-    if response.code != 200:
-        return Failure(Exception("Non-OK response for URL: %s" % response))
     d = defer.Deferred()
+    # the body is read in any case, otherwise the connection cannot be reused
     response.deliverBody(BodyConsumer(d))
+    if response.code != 200:
+        d.addCallback(lambda _: Failure(Exception("Non-OK response for URL: %s" % response)))
     return d
 
 
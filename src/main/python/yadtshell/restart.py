@@ -19,6 +19,8 @@
 import logging
 
 from yadtshell.actions import ActionPlan
+from yadtshell.dependencies import DependencyIndex
+from yadtshell.plan_cache import cached_plan
 from yadtshell.helper import expand_hosts, glob_hosts
 from yadtshell.metalogic import metalogic, identity, apply_instructions, chop_minimal_related_chunks
 from yadtshell.settings import STOP, START, UP
@@ -28,6 +30,7 @@ logger = logging.getLogger('restart')
 
 
 @log_exceptions(logger)
+@cached_plan('restart')
 def restart(protocol=None, uris=None, parallel=None, **kwargs):
     logger.debug("uris: %s" % uris)
     logger.debug("parallel: %s" % parallel)
@@ -40,7 +43,8 @@ def restart(protocol=None, uris=None, parallel=None, **kwargs):
     logging.debug("service uris: %s" % service_uris)
 
     plan_all = []
-    stop_plan = metalogic(STOP, uris, plan_post_handler=identity)
+    dependency_index = DependencyIndex(components)
+    stop_plan = metalogic(STOP, uris, plan_post_handler=identity, dependency_index=dependency_index)
     stop_plan = chop_minimal_related_chunks(stop_plan)
     for chunk in stop_plan.actions:
         stops = ActionPlan("stop", chunk.actions)
@@ -54,7 +58,7 @@ def restart(protocol=None, uris=None, parallel=None, **kwargs):
                       if state == UP]
         start_uris = set(start_uris)
         logging.info("restarting %s" % ", ".join(start_uris))
-        starts = metalogic(START, start_uris, plan_post_handler=identity)
+        starts = metalogic(START, start_uris, plan_post_handler=identity, dependency_index=dependency_index)
 
         plan_all.append(ActionPlan("chunk", [stops, starts], nr_workers=1))
 
@@ -0,0 +1,107 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Priorities of the actions of a plan, for handing out ready actions on
+the critical path first.
+
+An action depends on another one if one of its preconditions is the target
+state of the other action. The priority of an action is the length of the
+longest chain of actions depending on it, including itself, where each
+action counts with its weight, e.g. its expected duration.
+"""
+
+from __future__ import absolute_import
+
+import logging
+
+import yadtshell.actions
+
+
+logger = logging.getLogger('scheduling')
+
+SCHEDULE_QUEUE = 'queue'
+SCHEDULE_CRITICAL_PATH = 'critical-path'
+
+
+def _count_one(action):
+    return 1
+
+
+def critical_path_lengths(actions, weight_fun=_count_one):
+    """Returns a dict mapping the id of each action to the weighted length
+    of the longest chain of actions depending on it.
+    """
+    producers = {}
+    for action in actions:
+        if action.attr:
+            producers.setdefault((action.uri, action.attr, action.target_value), []).append(action)
+
+    dependents = dict((id(action), []) for action in actions)
+    needed = dict((id(action), []) for action in actions)
+    for action in actions:
+        for precondition in action.preconditions:
+            for producer in producers.get(
+                    (precondition.uri, precondition.attr, precondition.target_value), []):
+                if producer is not action:
+                    dependents[id(producer)].append(action)
+                    needed[id(action)].append(producer)
+
+    # actions are handled after all actions depending on them
+    pending = dict((key, len(value)) for key, value in dependents.iteritems())
+    ready = [action for action in actions if not pending[id(action)]]
+    lengths = {}
+    while ready:
+        action = ready.pop()
+        lengths[id(action)] = weight_fun(action) + max(
+            [lengths[id(dependent)] for dependent in dependents[id(action)]] or [0])
+        for producer in needed[id(action)]:
+            pending[id(producer)] -= 1
+            if not pending[id(producer)]:
+                ready.append(producer)
+
+    for action in actions:
+        if id(action) not in lengths:
+            logger.debug('%s precedes a cycle of actions, using its own weight' % action.name)
+            lengths[id(action)] = weight_fun(action)
+    return lengths
+
+
+def critical_path_priorities(plan, weight_fun=_count_one):
+    """Returns a dict mapping the id of each action and of each (sub)plan of
+    `plan` to its priority, a plan has the highest priority of its actions.
+    """
+    priorities = critical_path_lengths(list(plan.list_actions), weight_fun)
+    for _, subplan in plan.list_subplans():
+        priorities[id(subplan)] = max(
+            [priorities[id(action)] for action in subplan.list_actions] or [0])
+    return priorities
+
+
+def create_priorities(plan, schedule, durations=None, components=None):
+    """Returns the priorities of the actions of `plan` for `schedule`, or
+    None for the queue order. With a DurationStore, actions are weighted
+    by their expected duration.
+    """
+    if schedule == SCHEDULE_CRITICAL_PATH and isinstance(plan, yadtshell.actions.ActionPlan):
+        if durations:
+            return critical_path_priorities(
+                plan, lambda action: durations.expected_for_action(action, default=1, components=components))
+        return critical_path_priorities(plan)
+    if schedule not in (SCHEDULE_QUEUE, SCHEDULE_CRITICAL_PATH):
+        logger.warning('unknown schedule %s, using %s' % (schedule, SCHEDULE_QUEUE))
+    return None
@@ -40,6 +40,7 @@ USER_INFO = get_user_info()
 OUTPUT_DIR = os.path.expanduser('~%s/.yadtshell/%s' % (USER_INFO['user'], socket.gethostname()))
 reboot_disabled = False
 ignore_unreachable_hosts = False
+incremental_status = False
 
 OUT_DIR = os.path.join(OUTPUT_DIR, 'tmp', os.getcwd().lstrip('/'))
 TODAY = None
@@ -0,0 +1,386 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Storage of the current state in an SQLite database.
+
+Each component is stored in a row of its own, keyed by its key and indexed
+by its type and host, so single components can be loaded without loading
+all others.
+References between components (e.g. `Host.defined_services`) are stored as
+the key of the referenced component and resolved when loading, so loaded
+components keep their identities.
+"""
+
+from __future__ import absolute_import
+
+import copy
+import logging
+import os
+import sqlite3
+import sys
+import tempfile
+
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+import yadtshell.components
+
+
+logger = logging.getLogger('state_store')
+
+FORMAT_VERSION = '1'
+# SQLite allows 999 parameters per query by default
+MAX_KEYS_PER_QUERY = 500
+
+SCHEMA = """
+CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE components (
+    key TEXT PRIMARY KEY,
+    canonical_key TEXT NOT NULL,
+    uri TEXT,
+    type TEXT,
+    host TEXT,
+    class TEXT,
+    state BLOB
+);
+CREATE INDEX components_by_type ON components (type);
+CREATE INDEX components_by_host ON components (host);
+"""
+
+
+class StateStore(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.connection = None
+
+    def connect(self):
+        if self.connection is None:
+            if not os.path.exists(self.filename):
+                raise IOError('no state stored at %s' % self.filename)
+            try:
+                self.connection = sqlite3.connect(self.filename)
+                self.connection.text_factory = str
+                format_version = self.get_meta('format_version')
+            except sqlite3.DatabaseError, e:
+                raise IOError('cannot read state stored at %s: %s' % (self.filename, e))
+            if format_version != FORMAT_VERSION:
+                raise IOError('unknown format %s of state stored at %s' % (format_version, self.filename))
+        return self.connection
+
+    def close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def get_meta(self, key):
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def write(self, components, meta=None):
+        """Replaces the stored state with `components`. The state is written
+        to a temporary file first, so readers never see a partial state.
+        """
+        keys_of_components = {}
+        for key, component in components.iteritems():
+            keys_of_components.setdefault(id(component), key)
+
+        def persistent_id(obj):
+            if isinstance(obj, yadtshell.components.Component):
+                return keys_of_components.get(id(obj))
+            return None
+
+        rows = []
+        for key, component in components.iteritems():
+            canonical_key = keys_of_components[id(component)]
+            if canonical_key != key:
+                rows.append((key, canonical_key, None, None, None, None, None))
+                continue
+            rows.append((key, key,
+                         getattr(component, 'uri', None),
+                         getattr(component, 'type', None),
+                         getattr(component, 'host', None),
+                         '%s.%s' % (type(component).__module__, type(component).__name__),
+                         sqlite3.Binary(_dumps(component.__dict__, persistent_id))))
+
+        fd, temp_filename = tempfile.mkstemp(dir=os.path.dirname(self.filename) or '.',
+                                             prefix='.current_state')
+        os.close(fd)
+        try:
+            connection = sqlite3.connect(temp_filename)
+            connection.executescript(SCHEMA)
+            all_meta = {'format_version': FORMAT_VERSION}
+            all_meta.update(meta or {})
+            connection.executemany('INSERT INTO meta VALUES (?, ?)', all_meta.items())
+            connection.executemany('INSERT INTO components VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+            connection.commit()
+            connection.close()
+            os.rename(temp_filename, self.filename)
+        except Exception:
+            os.remove(temp_filename)
+            raise
+        self.close()
+
+    def update_attributes(self, changes):
+        """Sets attributes of stored components in place, `changes` maps
+        keys to dicts of attribute names and values. Components which are
+        not stored are skipped.
+        """
+        connection = self.connect()
+        index = self.load_index()
+        changes_by_canonical_key = {}
+        for key, attributes in changes.iteritems():
+            if key in index:
+                changes_by_canonical_key.setdefault(index[key], {}).update(attributes)
+        rows = []
+        for key, _, state in self.load_rows(changes_by_canonical_key.keys()):
+            # references are kept as keys, without loading the referenced components
+            component_dict = _loads(state, _Reference)
+            component_dict.update(changes_by_canonical_key[key])
+            rows.append((sqlite3.Binary(_dumps(component_dict, _key_of_reference)), key))
+        with connection:
+            connection.executemany('UPDATE components SET state = ? WHERE key = ?', rows)
+            # the state is no longer the one the fingerprint was computed of
+            connection.execute("DELETE FROM meta WHERE key = 'fingerprint'")
+        self.close()
+
+    def load_index(self):
+        """Returns a dict mapping each key to the key the component is stored under."""
+        return dict(self.connect().execute('SELECT key, canonical_key FROM components'))
+
+    def load_rows(self, canonical_keys=None):
+        """Returns (key, class, state) of the given or of all stored components."""
+        connection = self.connect()
+        query = 'SELECT key, class, state FROM components WHERE key = canonical_key'
+        if canonical_keys is None:
+            return connection.execute(query).fetchall()
+        rows = []
+        for start in range(0, len(canonical_keys), MAX_KEYS_PER_QUERY):
+            keys = canonical_keys[start:start + MAX_KEYS_PER_QUERY]
+            rows.extend(connection.execute(
+                query + ' AND key IN (%s)' % ', '.join('?' * len(keys)), keys))
+        return rows
+
+    def find_keys(self, type=None, host=None):
+        query = 'SELECT key FROM components WHERE key = canonical_key'
+        arguments = []
+        if type is not None:
+            query += ' AND type = ?'
+            arguments.append(type)
+        if host is not None:
+            query += ' AND host = ?'
+            arguments.append(host)
+        return [row[0] for row in self.connect().execute(query, arguments)]
+
+
+def _dumps(obj, persistent_id):
+    f = StringIO()
+    pickler = pickle.Pickler(f, pickle.HIGHEST_PROTOCOL)
+    pickler.persistent_id = persistent_id
+    pickler.dump(obj)
+    return f.getvalue()
+
+
+def _loads(data, persistent_load):
+    unpickler = pickle.Unpickler(StringIO(str(data)))
+    unpickler.persistent_load = persistent_load
+    return unpickler.load()
+
+
+class _Reference(object):
+
+    def __init__(self, key):
+        self.key = key
+
+
+def _key_of_reference(obj):
+    if isinstance(obj, _Reference):
+        return obj.key
+    return None
+
+
+def _find_class(class_name):
+    module_name, _, name = class_name.rpartition('.')
+    __import__(module_name)
+    return getattr(sys.modules[module_name], name)
+
+
+_FULLY_LOADING_METHODS = ['pop', 'popitem', 'setdefault', 'update', 'copy', 'clear',
+                          '__eq__', '__ne__', '__repr__', '__str__']
+
+
+class StoredComponentDict(yadtshell.components.ComponentDict):
+
+    """A ComponentDict whose components are loaded from a StateStore when
+    they are accessed for the first time. Looking up keys does not load any
+    components, iterating over the values loads all of them at once.
+    """
+
+    def __init__(self, store):
+        yadtshell.components.ComponentDict.__init__(self)
+        self._store = store
+        self._index = store.load_index()
+        self._loaded = {}
+        self.fingerprint = store.get_meta('fingerprint')
+
+    def _load(self, canonical_keys=None):
+        if canonical_keys is None:
+            rows = list(self._store.load_rows())
+        else:
+            rows = list(self._store.load_rows(
+                [key for key in canonical_keys if key not in self._loaded]))
+        rows = [row for row in rows if row[0] not in self._loaded]
+        # create all instances before their states are loaded, so references
+        # between them can be resolved regardless of their order
+        for key, class_name, _ in rows:
+            component_class = _find_class(class_name)
+            self._loaded[key] = component_class.__new__(component_class)
+        for key, _, state in rows:
+            self._loaded[key].__dict__.update(_loads(state, self._get_referenced))
+
+    def _get_referenced(self, key):
+        if key not in self._loaded:
+            self._load([key])
+        return self._loaded[key]
+
+    def _get_loaded(self, key):
+        canonical_key = self._index[key]
+        if canonical_key not in self._loaded:
+            self._load([canonical_key])
+        component = self._loaded[canonical_key]
+        dict.__setitem__(self, key, component)
+        return component
+
+    def _load_all(self):
+        """Loads all components, this instance behaves like a plain
+        ComponentDict afterwards.
+        """
+        if self._index is None:
+            return
+        self._load()
+        for key in self._index:
+            if not dict.__contains__(self, key):
+                dict.__setitem__(self, key, self._loaded[self._index[key]])
+        self._index = None
+        self._loaded = None
+        self._store.close()
+
+    def find_keys(self, type=None, host=None):
+        """Returns the keys of the components of the given type and/or
+        host, without loading them.
+        """
+        if self._index is None:
+            return [key for key, component in self.iteritems()
+                    if (type is None or component.type == type) and
+                    (host is None or component.host == host)]
+        return [key for key in self._store.find_keys(type, host) if key in self._index]
+
+    def __contains__(self, key):
+        if self._index is None:
+            return dict.__contains__(self, key)
+        return key in self._index
+
+    has_key = __contains__
+
+    def __len__(self):
+        if self._index is None:
+            return dict.__len__(self)
+        return len(self._index)
+
+    def keys(self):
+        if self._index is None:
+            return dict.keys(self)
+        return self._index.keys()
+
+    def iterkeys(self):
+        return iter(self.keys())
+
+    __iter__ = iterkeys
+
+    def __getitem__(self, key):
+        if self._index is not None:
+            key = self._key_(key)
+            if key in self._index:
+                if dict.__contains__(self, key):
+                    return dict.__getitem__(self, key)
+                return self._get_loaded(key)
+        return yadtshell.components.ComponentDict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if self._index is not None and self._key_(key) in self._index:
+            return self[key]
+        return yadtshell.components.ComponentDict.get(self, key, default)
+
+    def __setitem__(self, key, value):
+        self._load_all()
+        return yadtshell.components.ComponentDict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        self._load_all()
+        return dict.__delitem__(self, key)
+
+    def values(self):
+        self._load_all()
+        return dict.values(self)
+
+    def items(self):
+        self._load_all()
+        return dict.items(self)
+
+    def itervalues(self):
+        self._load_all()
+        return dict.itervalues(self)
+
+    def iteritems(self):
+        self._load_all()
+        return dict.iteritems(self)
+
+    def __deepcopy__(self, memo):
+        self._load_all()
+        result = yadtshell.components.ComponentDict()
+        memo[id(self)] = result
+        for key, component in dict.iteritems(self):
+            dict.__setitem__(result, key, copy.deepcopy(component, memo))
+        result._add_when_missing_ = self._add_when_missing_
+        return result
+
+    def __reduce_ex__(self, protocol):
+        self._load_all()
+        return (yadtshell.components.ComponentDict, (),
+                {'_add_when_missing_': self._add_when_missing_}, None, dict.iteritems(self))
+
+
+def _fully_loading(name):
+    method = getattr(dict, name)
+
+    def fully_loading_method(self, *args, **kwargs):
+        self._load_all()
+        return method(self, *args, **kwargs)
+    fully_loading_method.__name__ = name
+    return fully_loading_method
+
+
+for _name in _FULLY_LOADING_METHODS:
+    setattr(StoredComponentDict, _name, _fully_loading(_name))
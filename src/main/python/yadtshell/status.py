@@ -18,16 +18,27 @@
 
 from __future__ import (absolute_import, print_function)
 
+import atexit
 import glob
+import gzip
+import hashlib
 import os
 import logging
 import sys
+import tarfile
+import threading
+import time
+import Queue
 import inspect
 import shlex
-import yaml
 import simplejson as json
 import re
 
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
 from twisted.internet import (defer, protocol, reactor)
 from twisted.internet.defer import succeed
 from twisted.python.failure import Failure
@@ -35,27 +46,19 @@ from twisted.python.failure import Failure
 
 from hostexpand.HostExpander import HostExpander
 import yadtshell
+import yadtshell.dependencies
 from yadtshell.rest_simple import rest_call
-from yadtshell.util import compute_dependency_scores, filter_missing_services
+from yadtshell.status_payload import decode_host_status, log_decode_statistics
+from yadtshell.util import filter_missing_services
 
 
 logger = logging.getLogger('status')
 
-try:
-    from yaml import CLoader as yaml_loader
-    logger.debug("using C implementation of yaml")
-except ImportError:
-    from yaml import Loader as yaml_loader
-    logger.debug("using default yaml")
-try:
-    import cPickle as pickle
-    logger.debug("using C implementation of pickle")
-except ImportError:
-    import pickle
-    logger.debug("using default pickle")
-
 local_service_collector = None
 
+# attributes of the yadt-status payload which change on every call
+VOLATILE_STATUS_KEYS = ('date', 'epoch', 'uptime', 'age_of_cached_structure')
+
 
 def status_cb(protocol=None):
     return status()
@@ -81,14 +84,106 @@ def handle_ignored_status(result_or_failure, component_name, components, pi):
         return p.deferred
 
 
-def query_status(component_name, components, pi=None):
-    short_hostname = re.sub("\\..*", "", component_name)
+_status_fan_out = None
+_ignored_status_of_target = None
+
+
+class IgnoredStatusOfTarget(object):
+
+    """Fetches the ignored hosts of the whole target with one request to the
+    broadcaster. Hosts outside of the target, or all hosts if the broadcaster
+    cannot answer the request, are looked up with one request per host.
+    """
+
+    def __init__(self, target_name, hostnames):
+        self.hostnames = set(short_hostname(hostname) for hostname in hostnames)
+        self.ignored_hosts = None
+        self.fetched = False
+        self.waiting = []
+        deferred = defer.maybeDeferred(
+            rest_call, "http://%s:%s/api/v1/targets/%s/status-ignored" % (
+                yadtshell.settings.ybc.host,
+                yadtshell.settings.ybc.port,
+                target_name))
+        deferred.addCallback(json.loads)
+        deferred.addCallbacks(self._fetched, self._not_available)
+
+    def _fetched(self, ignored_hosts):
+        self.ignored_hosts = ignored_hosts
+        self._notify_waiting()
+
+    def _not_available(self, failure):
+        logger.debug('cannot fetch ignored hosts of target, querying each host: %s' %
+                     failure.getErrorMessage())
+        self._notify_waiting()
+
+    def _notify_waiting(self):
+        self.fetched = True
+        waiting, self.waiting = self.waiting, []
+        for deferred in waiting:
+            deferred.callback(None)
+
+    def query(self, short_hostname):
+        deferred = defer.Deferred()
+        deferred.addCallback(self._lookup, short_hostname)
+        if self.fetched:
+            deferred.callback(None)
+        else:
+            self.waiting.append(deferred)
+        return deferred
+
+    def _lookup(self, ignored, short_hostname):
+        if self.ignored_hosts is None or short_hostname not in self.hostnames:
+            return query_ignored_status_of_host(short_hostname)
+        if short_hostname in self.ignored_hosts:
+            return self.ignored_hosts[short_hostname]
+        return Failure(Exception('%s is not ignored' % short_hostname))
+
 
-    d = rest_call("http://%s:%s/api/v1/hosts/%s/status-ignored" % (
+def short_hostname(hostname):
+    return re.sub("\\..*", "", hostname)
+
+
+def query_ignored_status_of_host(short_hostname):
+    return rest_call("http://%s:%s/api/v1/hosts/%s/status-ignored" % (
         yadtshell.settings.ybc.host,
         yadtshell.settings.ybc.port,
         short_hostname))
 
+
+def query_ignored_status(hostname):
+    if _ignored_status_of_target:
+        return _ignored_status_of_target.query(short_hostname(hostname))
+    return query_ignored_status_of_host(short_hostname(hostname))
+
+
+def get_status_fan_out():
+    """Returns the fan-out shared by all status queries of this process, its
+    limits are taken from the target settings.
+    """
+    global _status_fan_out
+    if _status_fan_out is None:
+        target_settings = yadtshell.settings.TARGET_SETTINGS
+        group_by = target_settings.get('status_group_by', yadtshell.constants.STATUS_GROUP_BY_DEFAULT)
+        _status_fan_out = yadtshell.defer.FanOut(
+            'status_fan_out',
+            max_running=target_settings.get('status_max_parallel',
+                                            yadtshell.constants.STATUS_MAX_PARALLEL_DEFAULT),
+            max_running_per_group=target_settings.get('status_max_parallel_per_group',
+                                                      yadtshell.constants.STATUS_MAX_PARALLEL_PER_GROUP_DEFAULT),
+            group_fun=lambda hostname: yadtshell.util.determine_host_group(hostname, group_by))
+    return _status_fan_out
+
+
+def query_status(component_name, components, pi=None, priority=0):
+    return get_status_fan_out().submit(_query_status,
+                                       args=(component_name, components, pi),
+                                       key=component_name,
+                                       priority=priority)
+
+
+def _query_status(component_name, components, pi=None):
+    d = query_ignored_status(component_name)
     d.addCallbacks(callback=handle_ignored_status, callbackArgs=[component_name, components, pi],
                    errback=handle_ignored_status, errbackArgs=[component_name, components, pi])
     return d
@@ -115,25 +210,161 @@ def handle_failing_status(failure, components, ignore_unreachable_hosts=False):
     return failure
 
 
+class StatusDumpWriter(object):
+
+    """Writes the status dumps of the hosts in a background thread, so a slow
+    log volume does not block the reactor.
+    """
+
+    def __init__(self, mode=yadtshell.constants.STATUS_DUMP_DEFAULT):
+        self.mode = mode
+        self.queue = Queue.Queue()
+        self.thread = None
+        self.archive = None
+        self.archive_lock = threading.Lock()
+
+    def write(self, file_path, host_data):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._run, name='status-dump-writer')
+            self.thread.daemon = True
+            self.thread.start()
+        self.queue.put((file_path, host_data))
+
+    def flush(self):
+        """Blocks until all queued dumps are written."""
+        self.queue.join()
+
+    def close(self):
+        self.flush()
+        with self.archive_lock:
+            if self.archive:
+                self.archive.close()
+                self.archive = None
+
+    def _run(self):
+        while True:
+            file_path, host_data = self.queue.get()
+            try:
+                self._write(file_path, host_data)
+            except Exception, e:
+                logger.warning('cannot write status dump %s: %s' % (file_path, e))
+            finally:
+                self.queue.task_done()
+
+    def _write(self, file_path, host_data):
+        if self.mode == yadtshell.constants.STATUS_DUMP_ARCHIVE:
+            with self.archive_lock:
+                if self.archive is None:
+                    self.archive = tarfile.open(
+                        "%s.status.tar.gz" % yadtshell.settings.log_file, 'w:gz')
+                info = tarfile.TarInfo(os.path.basename(file_path))
+                info.size = len(host_data)
+                info.mtime = time.time()
+                self.archive.addfile(info, StringIO(host_data))
+        elif self.mode == yadtshell.constants.STATUS_DUMP_GZIP:
+            status_file = gzip.open(file_path + '.gz', 'wb')
+            try:
+                status_file.write(host_data)
+            finally:
+                status_file.close()
+        else:
+            with open(file_path, "w") as status_file:
+                status_file.write(host_data)
+
+
+_status_dump_writer = None
+
+
+def get_status_dump_writer():
+    global _status_dump_writer
+    if _status_dump_writer is None:
+        _status_dump_writer = StatusDumpWriter(yadtshell.settings.TARGET_SETTINGS.get(
+            'status_dump', yadtshell.constants.STATUS_DUMP_DEFAULT))
+        atexit.register(_status_dump_writer.close)
+    return _status_dump_writer
+
+
+def flush_status_dumps(result=None):
+    if _status_dump_writer:
+        _status_dump_writer.flush()
+    return result
+
+
 def write_host_data_to_file(host, host_data):
     host = host.replace("host://", "")
     file_path = "%s.%s.status" % (yadtshell.settings.log_file, host)
     logger.debug("Status of %s is at %s" % (host, file_path))
-    with open(file_path, "w") as status_file:
-        status_file.write(host_data)
+    get_status_dump_writer().write(file_path, host_data)
 
 
-def create_host(protocol, components):
-    if isinstance(protocol, yadtshell.components.AbstractHost):
-        return protocol
-    write_host_data_to_file(protocol.component, protocol.data)
+def calculate_status_token(data):
+    """Returns a token which changes whenever the status payload of a host
+    changes, disregarding the `VOLATILE_STATUS_KEYS`.
+    """
+    stable_data = dict((key, value) for key, value in data.iteritems()
+                       if key not in VOLATILE_STATUS_KEYS)
+    return hashlib.md5(json.dumps(stable_data, sort_keys=True, default=str)).hexdigest()
+
+
+class PreviousStatus(object):
+
+    """The components of the last status run, grouped by host, so that the
+    components of unchanged hosts can be reused instead of being rebuilt.
+    """
+
+    def __init__(self, components):
+        self.hosts = {}
+        self.unreachable_hosts = set()
+        self.components_by_host = {}
+        for key, component in components.iteritems():
+            if isinstance(component, yadtshell.components.UnreachableHost):
+                self.unreachable_hosts.add(component.fqdn)
+            elif isinstance(component, yadtshell.components.Host):
+                self.hosts[key] = component
+            elif isinstance(component, (yadtshell.components.Service, yadtshell.components.Artefact)):
+                self.components_by_host.setdefault(component.host_uri, []).append((key, component))
+
+    def get_unchanged_host(self, uri, status_token):
+        host = self.hosts.get(uri)
+        if host is not None and getattr(host, 'status_token', None) == status_token:
+            return host
+        return None
+
+    def reuse_host(self, host, data, components):
+        for key in VOLATILE_STATUS_KEYS:
+            if key in data:
+                setattr(host, key, data[key])
+        host.logger = logging.getLogger(host.uri)
+        host.update_attributes_after_status()
+        host.status_reused = True
+        components[host.uri] = host
+
+        for key, component in self.components_by_host.get(host.uri, []):
+            component.needed_by = set()
+            if isinstance(component, yadtshell.components.Service):
+                settings = host.services.get(component.name) or {}
+                component.state = yadtshell.settings.STATE_DESCRIPTIONS.get(
+                    settings.get('state'), yadtshell.settings.UNKNOWN)
+            components[key] = component
+        return host
 
+
+def load_previous_status():
     try:
-        data = json.loads(protocol.data)
+        return PreviousStatus(yadtshell.util.restore_current_state(must_be_fresh=False))
     except Exception, e:
-        logger.debug('%s: %s, falling back to yaml parser' %
-                     (protocol.component, str(e)))
-        data = yaml.load(protocol.data, Loader=yaml_loader)
+        logger.debug('cannot restore previous status: %s' % e)
+        logger.info('no previous status found, thus querying all hosts completely')
+        return None
+
+
+def create_host(protocol, components, previous_status=None):
+    if isinstance(protocol, yadtshell.components.AbstractHost):
+        return protocol
+    payload = protocol.data
+    write_host_data_to_file(protocol.component, payload)
+
+    data = decode_host_status(protocol.component, payload)
 
     host = None
     # simple data (just status) for backwards compat. with old yadtclient
@@ -147,13 +378,21 @@ def create_host(protocol, components):
         host.state = yadtshell.settings.UNKNOWN
     elif data is None:
         logging.getLogger(protocol.component).warning('no data? strange...')
-    elif "fqdn" not in protocol.data:
+    elif not isinstance(data, dict) or "fqdn" not in data:
         logging.getLogger(protocol.component).warning(
             'no hostname? strange...')
     else:
         # note: this is actually the normal case
+        status_token = calculate_status_token(data)
         host = yadtshell.components.Host(data['fqdn'])
+        if previous_status:
+            unchanged_host = previous_status.get_unchanged_host(host.uri, status_token)
+            if unchanged_host:
+                logger.debug('%s did not change, reusing its previous status' % host.uri)
+                return previous_status.reuse_host(unchanged_host, data, components)
         host.set_attrs_from_data(data)
+        host.status_token = status_token
+        host.status_reused = False
     components[host.uri] = host
     return host
 
@@ -164,6 +403,8 @@ def initialize_services(host, components):
     """
     if yadtshell.util.not_up(host.state):
         return host
+    if getattr(host, 'status_reused', False):
+        return host
 
     host.defined_services = []
     for name, settings in host.services.items():
@@ -173,11 +414,7 @@ def initialize_services(host, components):
             logger.debug("No service name found, using default: 'Service'")
             service_class_name = "Service"
 
-        service_class = get_service_class_from_loaded_modules(
-            service_class_name)
-        if not service_class:
-            service_class = get_service_class_from_fallbacks(
-                host, service_class_name)
+        service_class = service_class_registry.get(host, service_class_name)
 
         service = None
         try:
@@ -194,17 +431,51 @@ def initialize_services(host, components):
     return host
 
 
+class ServiceClassRegistry(object):
+
+    """Maps class names to the classes of all loaded modules. Modules are
+    inspected once, modules loaded later on are inspected when a class is
+    looked up the next time.
+    """
+
+    def __init__(self):
+        self.classes = {}
+        self.inspected_modules = set()
+        self.module_count = 0
+
+    def _inspect_new_modules(self):
+        if len(sys.modules) == self.module_count:
+            return
+        for module_name in sys.modules.keys()[:]:
+            if module_name in self.inspected_modules:
+                continue
+            self.inspected_modules.add(module_name)
+            if module_name.startswith("six.moves"):
+                continue  # six.moves is horrible and inspecting it causes a crash
+            try:
+                for classname, service_class in inspect.getmembers(sys.modules[module_name], inspect.isclass):
+                    self.classes.setdefault(classname, service_class)
+            except:
+                pass
+        self.module_count = len(sys.modules)
+
+    def get_from_loaded_modules(self, service_class_name):
+        self._inspect_new_modules()
+        return self.classes.get(service_class_name)
+
+    def get(self, host, service_class_name):
+        service_class = self.get_from_loaded_modules(service_class_name)
+        if not service_class:
+            service_class = get_service_class_from_fallbacks(host, service_class_name)
+            self.classes[service_class_name] = service_class
+        return service_class
+
+
+service_class_registry = ServiceClassRegistry()
+
+
 def get_service_class_from_loaded_modules(service_class_name):
-    for module_name in sys.modules.keys()[:]:
-        if module_name.startswith("six.moves"):
-            continue  # six.moves is horrible and inspecting it causes a crash
-        try:
-            for classname, service_class in inspect.getmembers(sys.modules[module_name], inspect.isclass):
-                if classname == service_class_name:
-                    return service_class
-        except:
-            pass
-    return None
+    return service_class_registry.get_from_loaded_modules(service_class_name)
 
 
 def get_service_class_from_fallbacks(host, service_class_name):
@@ -255,6 +526,9 @@ def get_service_class_from_fallbacks(host, service_class_name):
 
 
 def initialize_artefacts(host, components):
+    if getattr(host, 'status_reused', False):
+        return host
+
     for name_version in host.current_artefacts:
         add_artefact(
             components, host, name_version, yadtshell.settings.CURRENT)
@@ -314,9 +588,13 @@ def status(hosts=None, include_artefacts=True, **kwargs):
     if type(hosts) is str:
         hosts = [hosts]
 
+    previous_status = None
+    if kwargs.get('incremental_status') or yadtshell.settings.incremental_status:
+        previous_status = load_previous_status()
+
     try:
         os.remove(
-            os.path.join(yadtshell.settings.OUT_DIR, 'current_state.components'))
+            os.path.join(yadtshell.settings.OUT_DIR, 'current_state.db'))
     except OSError:
         pass
 
@@ -341,6 +619,10 @@ def status(hosts=None, include_artefacts=True, **kwargs):
 
     components = yadtshell.components.ComponentDict()
 
+    global _ignored_status_of_target
+    _ignored_status_of_target = IgnoredStatusOfTarget(
+        yadtshell.settings.TARGET_SETTINGS.get('name'), hosts)
+
     def store_service_up(protocol):
         protocol.component.state = yadtshell.settings.UP
         return protocol
@@ -409,33 +691,8 @@ def status(hosts=None, include_artefacts=True, **kwargs):
     def build_unified_dependencies_tree(ignored):
         logger.debug('building unified dependencies tree')
 
-        components._add_when_missing_ = True
-        logger.debug('wiring components')
-        for component in components.values():
-            needs_with_resolved_version_alias = set([])
-            for needed in getattr(component, 'needs', []):
-                try:
-                    needed_component = components[needed]
-                    if not hasattr(needed_component, 'needed_by'):
-                        needed_component.needed_by = set()
-                    needed_component.needed_by.add(component.uri)
-                    needs_with_resolved_version_alias.add(needed_component.uri)
-                except (KeyError, AttributeError), e:
-                    logger.debug('needed: ' + needed)
-                    raise e
-
-            component.needs = needs_with_resolved_version_alias
-        components._add_when_missing_ = False
-
-        for component in components.values():
-            for dependent in getattr(component, 'needed_by', []):
-                try:
-                    dependent_component = components[dependent]
-                    dependent_component.needs.add(component.uri)
-                except KeyError, ke:
-                    logger.warning("unknown dependent key " + str(ke))
-
-        compute_dependency_scores(components)
+        yadtshell.dependencies.wire_dependencies(components)
+        yadtshell.dependencies.compute_dependency_scores(components)
 
     def store_status_locally(ignored, components):
         for component in components.values():
@@ -456,9 +713,7 @@ def status(hosts=None, include_artefacts=True, **kwargs):
         for f in component_files.values():
             f.close()
 
-        f = _open_component_file('current_state.components')
-        pickle.dump(components, f, pickle.HIGHEST_PROTOCOL)
-        f.close()
+        yadtshell.util.store_current_state(components)
 
         groups = []
         he = HostExpander()
@@ -520,9 +775,14 @@ def status(hosts=None, include_artefacts=True, **kwargs):
     pi = yadtshell.twisted.ProgressIndicator()
 
     def query_and_initialize_host(hostname):
-        deferred = query_status(hostname, components, pi)
+        # query hosts which were unreachable last time at the end, so they
+        # do not block the fan-out while running into the ssh timeout
+        if previous_status and hostname in previous_status.unreachable_hosts:
+            deferred = query_status(hostname, components, pi, priority=1)
+        else:
+            deferred = query_status(hostname, components, pi)
         deferred.addCallbacks(callback=create_host,
-                              callbackArgs=[components],
+                              callbackArgs=[components, previous_status],
                               errback=handle_failing_status,
                               errbackArgs=[components, kwargs.get("ignore_unreachable_hosts")])
 
@@ -537,11 +797,13 @@ def status(hosts=None, include_artefacts=True, **kwargs):
 
     dl = defer.DeferredList(deferreds)
     dl.addCallback(check_responses)
+    dl.addCallback(log_decode_statistics)
     dl.addCallback(notify_collector)
     dl.addCallback(build_unified_dependencies_tree)
     dl.addCallback(fetch_missing_hosts, components)
     dl.addCallback(fetch_missing_services_as_readonly, components)
     dl.addCallback(handle_readonly_service_states, components)
+    dl.addCallback(flush_status_dumps)
     dl.addCallback(store_status_locally, components)
     dl.addCallback(yadtshell.info, components=components)
     dl.addErrback(yadtshell.twisted.report_error,
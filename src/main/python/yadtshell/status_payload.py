@@ -0,0 +1,128 @@
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+#
+#   YADT - an Augmented Deployment Tool
+#   Copyright (C) 2010-2014  Immobilien Scout GmbH
+#
+#   This program is free software: you can redistribute it and/or modify
+#   it under the terms of the GNU General Public License as published by
+#   the Free Software Foundation, either version 3 of the License, or
+#   (at your option) any later version.
+#
+#   This program is distributed in the hope that it will be useful,
+#   but WITHOUT ANY WARRANTY; without even the implied warranty of
+#   MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#   GNU General Public License for more details.
+#
+#   You should have received a copy of the GNU General Public License
+#   along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""Decoding of the payload returned by yadt-status.
+
+Current minions answer with JSON, old minions still answer with YAML and
+very old ones with a plain state string. The format is detected from the
+first bytes of the payload, so JSON payloads never pay for the YAML parser.
+"""
+
+from __future__ import (absolute_import, print_function)
+
+import logging
+import time
+
+import simplejson as json
+import yaml
+
+import yadtshell
+
+try:
+    from yaml import CLoader as yaml_loader
+except ImportError:
+    from yaml import Loader as yaml_loader
+
+
+logger = logging.getLogger('status_payload')
+
+JSON = 'json'
+YAML = 'yaml'
+PLAIN = 'plain'
+
+# expected types of the host attributes read by Host.set_attrs_from_data
+HOST_SCHEMA = {
+    'fqdn': basestring,
+    'hostname': basestring,
+    'services': (dict, list),
+    'current_artefacts': list,
+    'next_artefacts': (dict, list),
+    'handled_artefacts': list,
+    'artefact_names_handled_by_yadt': list,
+    'lockstate': (dict, type(None)),
+}
+
+decode_statistics = {}
+
+
+def detect_format(payload):
+    stripped = payload.lstrip()
+    if stripped.startswith('{'):
+        return JSON
+    if stripped.rstrip() in (yadtshell.settings.DOWN, yadtshell.settings.UNKNOWN, ''):
+        return PLAIN
+    return YAML
+
+
+def decode(payload, format=None):
+    if format is None:
+        format = detect_format(payload)
+    if format == PLAIN:
+        return payload.strip() or None
+    if format == JSON:
+        return json.loads(payload)
+    return yaml.load(payload, Loader=yaml_loader)
+
+
+def normalize_host_data(data, hostname=None):
+    """Returns `data` with the attributes in the shape Host expects.
+    Attributes of an unexpected type are reported, but kept.
+    """
+    for key, expected_type in HOST_SCHEMA.iteritems():
+        if key in data and not isinstance(data[key], expected_type):
+            logger.warning('%s: unexpected type %s of status attribute %s' %
+                           (hostname, type(data[key]).__name__, key))
+    services = data.get('services')
+    if isinstance(services, list):
+        data['services'] = {}
+        for entry in services:
+            data['services'].update(entry)
+    return data
+
+
+def decode_host_status(hostname, payload):
+    """Decodes the status payload of `hostname` and records how long that took."""
+    started = time.time()
+    format = detect_format(payload)
+    try:
+        data = decode(payload, format)
+    except ValueError, e:
+        # flow style yaml also starts with a brace
+        logger.debug('%s: %s, falling back to yaml parser' % (hostname, str(e)))
+        format = YAML
+        data = decode(payload, format)
+    if isinstance(data, dict):
+        data = normalize_host_data(data, hostname)
+    decode_time = time.time() - started
+    decode_statistics[hostname] = (format, decode_time)
+    logger.debug('%s: decoded %s status of %i bytes in %.3f s' %
+                 (hostname, format, len(payload), decode_time))
+    return data
+
+
+def log_decode_statistics(result=None):
+    """Reports the hosts still answering with YAML. Passes `result` through
+    so it can be used as a callback.
+    """
+    yaml_hosts = sorted(hostname for hostname, (format, _) in decode_statistics.iteritems()
+                        if format == YAML)
+    if yaml_hosts:
+        yaml_time = sum(decode_statistics[hostname][1] for hostname in yaml_hosts)
+        logger.info('%i hosts answer with yaml status (%.3f s to decode), please upgrade: %s' %
+                    (len(yaml_hosts), yaml_time, ' '.join(yaml_hosts)))
+    return result
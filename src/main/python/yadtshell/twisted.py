@@ -41,6 +41,7 @@ class ProgressIndicator(object):
         self.rendered = ['|', '/', '-', '\\']
         self.histo_threshold = histo_threshold
         self.finished = set()
+        self.eta = None
         self.logger = logging.getLogger('progress')
 
     def update(self, observable, newvalue=None):
@@ -57,6 +58,16 @@ class ProgressIndicator(object):
                 self.progress[observable] = int(value) + 1
         self._update()
 
+    def set_eta(self, seconds):
+        """Sets the estimated seconds until all actions are finished, None if unknown."""
+        self.eta = seconds
+
+    def _render_eta(self):
+        if self.eta is None:
+            return ''
+        minutes, seconds = divmod(int(self.eta), 60)
+        return ' eta %d:%02d' % (minutes, seconds)
+
     def finish(self):
         if len(self.progress):
             self._overwrite_remaining_progress_with_blanks()
@@ -84,10 +95,11 @@ class ProgressIndicator(object):
     def _update(self):
         if sys.stderr.isatty():
             if len(self.observables) > self.histo_threshold:
-                sys.stderr.write('\r' + self.PROGRESS_LABEL + self._render_compressed() + '\r')
+                sys.stderr.write('\r' + self.PROGRESS_LABEL + self._render_compressed() + self._render_eta() + '\r')
             else:
                 rendered = [self._render_value(self.progress.get(o)) for o in self.observables]
-                sys.stderr.write('\r' + self.PROGRESS_LABEL + ''.join([str(o) for o in rendered]) + '\r')
+                sys.stderr.write('\r' + self.PROGRESS_LABEL + ''.join([str(o) for o in rendered]) +
+                                 self._render_eta() + '\r')
 
 
 class YadtProcessProtocol(protocol.ProcessProtocol):
@@ -100,7 +112,7 @@ class YadtProcessProtocol(protocol.ProcessProtocol):
             self.component = component
         self.cmd = cmd.encode('ascii')
         self.wait_for_io = wait_for_io
-        self.data = ""
+        self.chunks = []
         self.pi = pi
         if not log_prefix:
             log_prefix = '*YPP*'
@@ -115,11 +127,22 @@ class YadtProcessProtocol(protocol.ProcessProtocol):
         if self.pi:
             self.pi.update((self.cmd, self.component))
 
+    @property
+    def data(self):
+        """The output received so far. The chunks are joined only once,
+        when the output is read, to keep accumulating it linear.
+        """
+        if len(self.chunks) > 1:
+            self.chunks = [''.join(self.chunks)]
+        return self.chunks[0] if self.chunks else ''
+
     def outReceived(self, data):
-        for line in data.splitlines():
-            self.logger.log(self.out_log_level,
-                            '{0}: {1}'.format(self.component, line))
-        self.data = self.data + data
+        # an out_log_level of NOTSET means the output is not logged at all
+        if self.out_log_level and self.logger.isEnabledFor(self.out_log_level):
+            for line in data.splitlines():
+                self.logger.log(self.out_log_level,
+                                '{0}: {1}'.format(self.component, line))
+        self.chunks.append(data)
         if self.pi:
             self.pi.update((self.cmd, self.component))
 
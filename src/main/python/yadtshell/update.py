@@ -19,6 +19,7 @@
 import logging
 
 import yadtshell
+from yadtshell.plan_cache import cached_plan
 from yadtshell.util import log_exceptions
 
 logger = logging.getLogger('update')
@@ -38,8 +39,10 @@ def get_all_adjacent_needed_hosts(service_uri, components):
 
 
 @log_exceptions(logger)
+@cached_plan('update')
 def compare_versions(protocol=None, hosts=None, update_plan_post_handler=None, parallel=None, **kwargs):
     components = yadtshell.util.restore_current_state()
+    dependency_index = yadtshell.dependencies.DependencyIndex(components)
     if not update_plan_post_handler:
         update_plan_post_handler = yadtshell.metalogic.chop_minimal_related_chunks
 
@@ -97,7 +100,8 @@ def compare_versions(protocol=None, hosts=None, update_plan_post_handler=None, p
     logger.debug('diff: ' + ', '.join(diff))
 
     stop_plan = yadtshell.metalogic.metalogic(
-        yadtshell.settings.STOP, diff, plan_post_handler=yadtshell.metalogic.identity)
+        yadtshell.settings.STOP, diff, plan_post_handler=yadtshell.metalogic.identity,
+        dependency_index=dependency_index)
     stopped_services = set()
     for action in stop_plan.actions:
         stopped_services.add(action.uri)
@@ -115,7 +119,8 @@ def compare_versions(protocol=None, hosts=None, update_plan_post_handler=None, p
     all_handled_services = set([s.uri for s in components.values() if is_a_handled_service(s)])
 
     start_plan = yadtshell.metalogic.metalogic(
-        yadtshell.settings.START, all_handled_services, plan_post_handler=yadtshell.metalogic.identity)
+        yadtshell.settings.START, all_handled_services, plan_post_handler=yadtshell.metalogic.identity,
+        dependency_index=dependency_index)
 
     if not diff:
         yadtshell.util.dump_action_plan('update', start_plan)
@@ -164,9 +169,14 @@ def compare_versions(protocol=None, hosts=None, update_plan_post_handler=None, p
         if possible_prestart_chunk.is_not_empty:
             prestart_chunks.add(possible_prestart_chunk)
 
+    stopupdatestart = yadtshell.actions.ActionPlan('stopupdatestart', update_chunks)
+    if yadtshell.settings.TARGET_SETTINGS.get('update_max_parallel_per_group',
+                                              yadtshell.constants.UPDATE_MAX_PARALLEL_PER_GROUP_DEFAULT):
+        # all chunks may run at once, the action manager limits the host updates per group
+        stopupdatestart.nr_workers = max(1, len(update_chunks))
     plan = yadtshell.actions.ActionPlan(
         'update', [yadtshell.actions.ActionPlan('prestart', prestart_chunks),
-                   yadtshell.actions.ActionPlan('stopupdatestart', update_chunks)
+                   stopupdatestart
                    ], nr_workers=1)
     plan = yadtshell.metalogic.apply_instructions(plan, parallel)
     yadtshell.util.dump_action_plan('update', plan)
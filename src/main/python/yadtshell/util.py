@@ -29,9 +29,8 @@ from twisted.internet import defer, reactor
 
 import yadtshell.settings
 import yadtshell.components
-from yadtshell.constants import (STANDALONE_SERVICE_RANK,
-                                 MAX_ALLOWED_AGE_OF_STATE_IN_SECONDS)
-from yadtshell.service_validation import ServiceDefinitionValidator
+from yadtshell.constants import MAX_ALLOWED_AGE_OF_STATE_IN_SECONDS
+from yadtshell.dependencies import compute_dependency_scores, is_service_on_host  # NOQA
 
 logger = logging.getLogger('util')
 
@@ -48,6 +47,16 @@ def determine_loc_type(s):
     return {"host": s, "loc": s[0:3], "type": s[3:6], "loctype": s[0:6], "nr": s[6:8]}
 
 
+def determine_host_group(fqdn, group_by):
+    """Returns the group of a host, `group_by` is either "domain" or one of
+    the keys returned by `determine_loc_type`.
+    """
+    hostname, _, domain = fqdn.replace('host://', '').partition('.')
+    if group_by == 'domain':
+        return domain
+    return determine_loc_type(hostname)[group_by]
+
+
 def store(o, filename):
     with open(filename, "w") as f:
         pickle.dump(o, f, pickle.HIGHEST_PROTOCOL)
@@ -68,14 +77,18 @@ def restore2(filename):
 
 
 def dump_plan(flavor, plan):
+    from yadtshell import plan_format
     filename = flavor + '.plan'
     f = open(os.path.join(yadtshell.settings.OUT_DIR, filename), 'w')
     if not plan:
         logger.debug('%s plan is empty' % flavor)
     else:
         logger.debug('creating %s' % filename)
-        yaml.dump(plan, f)
+        plan_format.dump(plan, f)
     f.close()
+    if plan and yadtshell.settings.TARGET_SETTINGS.get('yaml_plan_export', False):
+        with open(os.path.join(yadtshell.settings.OUT_DIR, flavor + '.yaml'), 'w') as f:
+            plan_format.export_yaml(plan, f)
 
 
 def dump_action_plan(flavor, plan):
@@ -83,7 +96,27 @@ def dump_action_plan(flavor, plan):
 
 
 def current_state():
-    return os.path.join(yadtshell.settings.OUT_DIR, 'current_state.components')
+    return os.path.join(yadtshell.settings.OUT_DIR, 'current_state.db')
+
+
+def restore_state(filename):
+    # imported here, because yadtshell.components imports this module
+    from yadtshell.state_store import StateStore, StoredComponentDict
+    return StoredComponentDict(StateStore(filename))
+
+
+def store_current_state(components):
+    from yadtshell.state_store import StateStore
+    from yadtshell.plan_cache import fingerprint_of
+    StateStore(current_state()).write(components, meta={'fingerprint': fingerprint_of(components)})
+
+
+def store_current_state_changes(changes):
+    """Sets the attributes given by `changes`, a dict mapping uris to dicts
+    of attribute names and values, on the components of the current state.
+    """
+    from yadtshell.state_store import StateStore
+    StateStore(current_state()).update_attributes(changes)
 
 
 def get_age_of_current_state_in_seconds():
@@ -92,7 +125,7 @@ def get_age_of_current_state_in_seconds():
 
 
 def restore_current_state(must_be_fresh=True):
-    deserialized_state = restore(current_state())
+    deserialized_state = restore_state(current_state())
     if get_age_of_current_state_in_seconds() >= MAX_ALLOWED_AGE_OF_STATE_IN_SECONDS and must_be_fresh:
         raise IOError("Serialized state is too old")
     return deserialized_state
@@ -230,41 +263,34 @@ def stop_ssh_multiplexed(ignored, hosts=None):
     return dl
 
 
+def _deps_on_same_host(service, components, edges_attr):
+    found = []
+    seen = set()
+
+    def collect(component):
+        new_deps = [uri for uri in getattr(component, edges_attr, [])
+                    if is_service_on_host(uri, component.host) and uri not in seen]
+        found.extend(new_deps)
+        seen.update(new_deps)
+        for uri in new_deps:
+            collect(components[uri])
+
+    collect(service)
+    return found
+
+
 def inbound_deps_on_same_host(service, components):
-    inbound_services = [
-        s for s in service.needed_by if 'service://%s' % service.host in s]
-    for dependent_service in service.needed_by:
-        inbound_services.extend(
-            inbound_deps_on_same_host(components[dependent_service], components))
-    return inbound_services
+    """Returns the uris of the services on the same host needing `service`,
+    directly or transitively, without duplicates.
+    """
+    return _deps_on_same_host(service, components, 'needed_by')
 
 
 def outbound_deps_on_same_host(service, components):
-    needed_services = [
-        s for s in service.needs if 'service://%s' % service.host in s]
-    outbound_services = needed_services
-    for needed_service in [s for s in service.needs if 'service://%s' % service.host in s]:
-        outbound_services.extend(
-            outbound_deps_on_same_host(components[needed_service], components))
-    return outbound_services
-
-
-def compute_dependency_scores(components):
-    servicedefs = dict((component.uri, component)
-                       for component in components.values() if isinstance(component, yadtshell.components.Service))
-
-    #  we cannot compute the dependency scores if there is a service cycle
-    t = ServiceDefinitionValidator(servicedefs)
-    t.assert_no_cycles_present()
-
-    for service, servicedef in servicedefs.iteritems():
-        outbound_edges = len(
-            outbound_deps_on_same_host(servicedef, components))
-        inbound_edges = len(inbound_deps_on_same_host(servicedef, components))
-        if outbound_edges == inbound_edges == 0:
-            servicedef.dependency_score = STANDALONE_SERVICE_RANK
-        else:
-            servicedef.dependency_score = inbound_edges - outbound_edges
+    """Returns the uris of the services on the same host `service` needs,
+    directly or transitively, without duplicates.
+    """
+    return _deps_on_same_host(service, components, 'needs')
 
 
 def calculate_max_tries_for_interval_and_delay(interval, delay):
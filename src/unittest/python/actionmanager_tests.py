@@ -1,10 +1,16 @@
 # from twisted.trial.unittest import TestCase
+import os
+import shutil
+import tempfile
+import time
 from unittest import TestCase
 from mock import MagicMock, Mock, patch
+import twisted.internet.defer as defer
 
 import yadtshell
 
 from yadtshell.actionmanager import (ActionManager,
+                                     PreconditionQueue,
                                      _user_should_acknowledge_plan,
                                      remove_harmless_actions)
 
@@ -21,6 +27,43 @@ class ActionManagerTestBase(TestCase):
         self.am = ActionManager()
 
 
+class UpdateLimitTests(ActionManagerTestBase):
+
+    def setUp(self):
+        super(UpdateLimitTests, self).setUp()
+        self.am.components = yadtshell.components.ComponentDict()
+        self.am.update_limiter = yadtshell.defer.GroupLimiter(1)
+
+    def tearDown(self):
+        del yadtshell.components._attribute_listeners[:]
+
+    def create_chunk(self, *hostnames):
+        actions = [yadtshell.actions.Action('update', 'host://%s.acme.com' % hostname, 'state', 'uptodate')
+                   for hostname in hostnames]
+        return ActionManager.Task(Mock(return_value=defer.succeed(None)),
+                                  yadtshell.actions.ActionPlan('chunk', actions))
+
+    def test_should_count_host_updates_of_chunk_per_group(self):
+        self.assertEqual(self.am.update_demand(self.create_chunk('berweb01', 'berweb02', 'hamweb01').action),
+                         {'ber': 2, 'ham': 1})
+
+    def test_should_not_limit_plans_of_chunks(self):
+        plan = yadtshell.actions.ActionPlan('stopupdatestart', [self.create_chunk('berweb01').action])
+
+        self.assertEqual(self.am.update_demand(plan), None)
+
+    def test_should_hand_out_chunks_within_limit_per_group(self):
+        tasks = [self.create_chunk('berweb01'), self.create_chunk('berweb02'), self.create_chunk('hamweb01')]
+        queue = PreconditionQueue(tasks, self.am.components, None, self.am.update_limiter, self.am.update_demand)
+
+        first, second = queue.next_ready(), queue.next_ready()
+
+        self.assertEqual((first.task, second.task), (tasks[0], tasks[2]))
+        self.assertEqual(queue.next_ready(), yadtshell.defer.TASK_BLOCKED)
+        first.fun(plan=first.action, path=[])
+        self.assertEqual(queue.next_ready().task, tasks[1])
+
+
 class ActionManagerHelperFunctionsTest(ActionManagerTestBase):
 
     @patch('yadtshell.actionmanager.sys.stdout')
@@ -117,6 +160,231 @@ class ActionManagerHelperFunctionsTest(ActionManagerTestBase):
         self.assertEqual(result, task2)
 
 
+class PreconditionQueueTests(ActionManagerTestBase):
+
+    def setUp(self):
+        super(PreconditionQueueTests, self).setUp()
+        self.components = yadtshell.components.ComponentDict()
+        self.host = yadtshell.components.Host('foobar42')
+        for name in ['backend', 'frontend', 'proxy']:
+            service = yadtshell.components.Service(self.host, name, {})
+            service.state = yadtshell.settings.DOWN
+            self.components[service.uri] = service
+        self.am.components = self.components
+
+    def tearDown(self):
+        del yadtshell.components._attribute_listeners[:]
+
+    def create_task(self, cmd, name, *needed):
+        action = yadtshell.actions.Action(
+            cmd, 'service://foobar42/%s' % name, 'state', yadtshell.settings.UP,
+            preconditions=set([yadtshell.actions.TargetState(
+                'service://foobar42/%s' % other, 'state', yadtshell.settings.UP)
+                for other in needed]))
+        return ActionManager.Task(None, action)
+
+    def test_should_hand_out_tasks_without_preconditions_in_queue_order(self):
+        tasks = [self.create_task('start', 'proxy', 'frontend'),
+                 self.create_task('start', 'frontend'),
+                 self.create_task('start', 'backend')]
+        queue = PreconditionQueue(tasks, self.components)
+
+        self.assertEqual(self.am.next_with_preconditions(queue), tasks[1])
+        self.assertEqual(self.am.next_with_preconditions(queue), tasks[2])
+        self.assertEqual(self.am.next_with_preconditions(queue), None)
+        self.assertEqual(list(queue), [tasks[0]])
+
+    def test_should_hand_out_task_when_its_preconditions_are_met(self):
+        tasks = [self.create_task('start', 'proxy', 'frontend', 'backend')]
+        queue = PreconditionQueue(tasks, self.components)
+
+        self.components['service://foobar42/frontend'].state = yadtshell.settings.UP
+        self.assertEqual(queue.next_ready(), None)
+        self.components['service://foobar42/backend'].state = yadtshell.settings.UP
+
+        self.assertEqual(queue.next_ready(), tasks[0])
+        self.assertEqual(len(queue), 0)
+
+    def test_should_not_hand_out_task_when_precondition_is_unmet_again(self):
+        tasks = [self.create_task('start', 'proxy', 'frontend')]
+        queue = PreconditionQueue(tasks, self.components)
+
+        self.components['service://foobar42/frontend'].state = yadtshell.settings.UP
+        self.components['service://foobar42/frontend'].state = yadtshell.settings.DOWN
+
+        self.assertEqual(queue.next_ready(), None)
+
+    def test_should_ignore_changes_of_copied_components(self):
+        tasks = [self.create_task('start', 'proxy', 'frontend')]
+        queue = PreconditionQueue(tasks, self.components)
+        copied = yadtshell.components.Service(self.host, 'frontend', {})
+
+        copied.state = yadtshell.settings.UP
+
+        self.assertEqual(queue.next_ready(), None)
+
+    def test_should_skip_tasks_which_are_not_pending(self):
+        tasks = [self.create_task('start', 'frontend'),
+                 self.create_task('start', 'backend')]
+        queue = PreconditionQueue(tasks, self.components)
+        tasks[0].action.state = yadtshell.actions.State.RUNNING
+
+        self.assertEqual(queue.next_ready(), tasks[1])
+        tasks[0].action.state = yadtshell.actions.State.PENDING
+        self.assertEqual(queue.next_ready(), tasks[0])
+
+    def test_should_hand_out_ready_task_with_highest_priority_first(self):
+        tasks = [self.create_task('start', 'frontend'),
+                 self.create_task('start', 'backend'),
+                 self.create_task('start', 'proxy')]
+        priorities = {id(tasks[1].action): 3, id(tasks[2].action): 2}
+        queue = PreconditionQueue(tasks, self.components, priorities)
+
+        self.assertEqual([queue.next_ready() for _ in tasks], [tasks[1], tasks[2], tasks[0]])
+
+    def test_should_stop_listening_when_queue_is_empty(self):
+        queue = PreconditionQueue([self.create_task('start', 'proxy')], self.components)
+        self.assertEqual(len(yadtshell.components._attribute_listeners), 0)
+
+        queue = PreconditionQueue([self.create_task('start', 'proxy', 'frontend')], self.components)
+        self.assertEqual(len(yadtshell.components._attribute_listeners), 1)
+        self.components['service://foobar42/frontend'].state = yadtshell.settings.UP
+        queue.next_ready()
+
+        self.assertEqual(len(yadtshell.components._attribute_listeners), 0)
+
+
+class ActionManagerHandleOutputTests(ActionManagerTestBase):
+
+    def setUp(self):
+        super(ActionManagerHandleOutputTests, self).setUp()
+        self.am.pi = Mock()
+        self.service = Mock(spec=['uri', 'state', 'status_max_wait', 'status_probe_jitter'])
+        self.service.uri = 'service://foobar42/backend'
+        self.service.state = 'down'
+        self.service.status_max_wait = 10
+        self.service.status_probe_jitter = 0
+        self.probe_delays = []
+        self.probes_until_up = 3
+
+        def probe(component, delay=0, target_state=None):
+            self.probe_delays.append(delay)
+            if len(self.probe_delays) == self.probes_until_up:
+                component.state = 'up'
+            return defer.succeed(None)
+        self.am.probe = probe
+
+    def test_should_probe_with_backoff_until_target_state_is_reached(self):
+        self.am.handle_output(None, 'start', self.service, 'up')
+
+        self.assertEqual(self.probe_delays, [0, 0.2, 0.5])
+        self.assertEqual(self.am.probe_statistics.transitions,
+                         {'service://foobar42/backend': [('up', 3, 0.7, True)]})
+
+    def test_should_fail_when_max_wait_is_exceeded(self):
+        self.service.status_max_wait = 0.5
+        self.probes_until_up = 4
+        errors = []
+
+        self.am.handle_output(None, 'start', self.service, 'up').addErrback(errors.append)
+
+        self.assertEqual(self.probe_delays, [0, 0.2, 0.3])
+        self.assertTrue(errors[0].check(yadtshell.actions.ActionException))
+        self.assertEqual(self.am.probe_statistics.transitions,
+                         {'service://foobar42/backend': [('up', 3, 0.5, False)]})
+
+    def test_should_not_probe_when_target_state_is_reached(self):
+        self.service.state = 'up'
+
+        self.assertEqual(self.am.handle_output('result', 'start', self.service, 'up'), 'result')
+        self.assertEqual(self.probe_delays, [])
+
+
+class ActionManagerDurationTests(ActionManagerTestBase):
+
+    def setUp(self):
+        super(ActionManagerDurationTests, self).setUp()
+        self.am.durations = Mock()
+        self.am.pi = Mock()
+        self.start = yadtshell.actions.Action('start', 'service://foobar42/backend')
+        self.stop = yadtshell.actions.Action('stop', 'service://foobar42/frontend')
+
+    @patch('yadtshell.actionmanager.time.time', return_value=105)
+    def test_should_record_duration_of_action(self, _):
+        service = yadtshell.components.Service(yadtshell.components.Host('foobar42'), 'backend')
+
+        self.assertEqual(self.am.record_duration('result', self.start, service, 100), 'result')
+
+        self.am.durations.record.assert_called_with('start', 'service://foobar42/backend', 'Service', 5)
+
+    def test_should_estimate_remaining_time_of_running_actions(self):
+        self.am.expected_durations = {id(self.start): 30, id(self.stop): 10}
+        self.am.running_actions = 2
+
+        self.am.mark_action_as_finished(None, self.start)
+
+        self.am.pi.set_eta.assert_called_with(10)
+
+
+class ActionManagerResumeTests(ActionManagerTestBase):
+
+    def setUp(self):
+        super(ActionManagerResumeTests, self).setUp()
+        self.am.dryrun = False
+        self.am.journal = Mock()
+        host = yadtshell.components.Host('foobar42')
+        self.db = yadtshell.components.Service(host, 'db')
+        self.backend = yadtshell.components.Service(host, 'backend')
+        self.am.components = {self.db.uri: self.db, self.backend.uri: self.backend}
+        self.start_db = yadtshell.actions.Action('start', self.db.uri, 'state', 'up')
+        self.start_backend = yadtshell.actions.Action('start', self.backend.uri, 'state', 'up')
+        self.plan = yadtshell.actions.ActionPlan('start', [self.start_db, self.start_backend])
+        self.am.journal_keys = yadtshell.journal.action_keys(self.plan)
+
+    def test_should_journal_transitions_of_action(self):
+        self.am.journal_action(self.start_db, 'RUNNING')
+        self.am.journal_result(None, self.start_db)
+
+        self.assertEqual(self.am.journal.record.call_args_list,
+                         [((self.am.journal_keys[id(self.start_db)], 'RUNNING'),),
+                          ((self.am.journal_keys[id(self.start_db)], 'FINISHED'),)])
+
+    def test_should_skip_finished_actions(self):
+        self.am.resume_plan(None, self.plan, {'0 start@service://foobar42/db': 'FINISHED'})
+
+        self.assertEqual(self.start_db.state, 'FINISHED')
+        self.assertEqual(self.db.state, 'up')
+        self.assertEqual(self.start_backend.state, 'PENDING')
+
+    @patch('yadtshell.actionmanager.reactor')
+    @patch('yadtshell.defer.DeferredPool')
+    def test_should_not_handle_finished_actions(self, deferred_pool, _):
+        self.start_db.state = self.start_backend.state = 'FINISHED'
+
+        self.am.handle(self.plan)
+
+        self.assertFalse(deferred_pool.called)
+
+    def test_should_probe_running_actions(self):
+        def probe(component):
+            component.state = 'up'
+            return defer.succeed(None)
+        self.am.probe = probe
+
+        self.am.resume_plan(None, self.plan, {'1 start@service://foobar42/backend': 'RUNNING'})
+
+        self.assertEqual(self.start_backend.state, 'FINISHED')
+        self.am.journal.record.assert_called_with('1 start@service://foobar42/backend', 'FINISHED')
+
+    def test_should_execute_running_actions_again_when_target_state_is_not_reached(self):
+        self.am.probe = lambda component: defer.succeed(None)
+
+        self.am.resume_plan(None, self.plan, {'1 start@service://foobar42/backend': 'RUNNING'})
+
+        self.assertEqual(self.start_backend.state, 'PENDING')
+        self.assertFalse(self.am.journal.record.called)
+
+
 class ActionManagerHandleTests(ActionManagerTestBase):
 
     @patch('yadtshell.ActionManager.Task')
@@ -139,6 +407,8 @@ class ActionManagerHandleTests(ActionManagerTestBase):
     def test_should_instantiate_deferred_pool_according_to_plan(self,
                                                                 mock_deferred_pool,
                                                                 mock_task):
+        self.am.components = {}
+        mock_task.return_value.action.preconditions = []
         plan = MagicMock(spec=list)
         plan.actions = [Mock()]
         plan.nr_workers = 99
@@ -152,7 +422,22 @@ class ActionManagerHandleTests(ActionManagerTestBase):
             [mock_task.return_value],
             nr_errors_tolerated=2,
             nr_workers=1,
-            next_task_fun=self.am.next_with_preconditions)
+            next_task_fun=self.am.next_with_preconditions,
+            concurrency=None)
+
+
+    @patch('yadtshell.defer.DeferredPool')
+    def test_should_adapt_concurrency_of_plan_with_adaptive_workers(self, mock_deferred_pool):
+        self.am.components = {}
+        actions = [yadtshell.actions.Action('stop', 'host://foobar%d' % i) for i in range(3)]
+        plan = yadtshell.actions.ActionPlan('update', actions, nr_workers='adaptive', nr_errors_tolerated=1)
+
+        self.am.handle(plan)
+
+        kwargs = mock_deferred_pool.call_args[1]
+        self.assertEqual(kwargs['nr_workers'], 3)
+        self.assertEqual(kwargs['concurrency'].limit, 1)
+        self.assertEqual(kwargs['concurrency'].nr_errors_tolerated, 1)
 
 
 class ActionManagerActionTests(ActionManagerTestBase):
@@ -163,10 +448,12 @@ class ActionManagerActionTests(ActionManagerTestBase):
     def user_accepts_transaction(self):
         yadtshell.actionmanager.confirm_transaction_by_user = lambda: True
 
+    @patch('yadtshell.actionmanager.checksum_of')
+    @patch('yadtshell.actionmanager.ActionJournal')
     @patch('yadtshell.actionmanager.print', create=True)
     @patch('yadtshell.actionmanager.sys.stdout')
     @patch('yadtshell.twisted.stop_and_return')
-    @patch('yadtshell.actionmanager.yaml.load')
+    @patch('yadtshell.actionmanager.load_plan')
     @patch('yadtshell.actionmanager.open', create=True)
     @patch('yadtshell.util.restore_current_state')
     def test_should_abort_when_user_cancels(self,
@@ -175,7 +462,7 @@ class ActionManagerActionTests(ActionManagerTestBase):
                                             mock_load_action_plan,
                                             mock_stop_and_return,
                                             mock_stdout,
-                                            _):
+                                            *_):
         mock_stdout.isatty.return_value = True
         noop = Mock()
         noop.cmd = 'harmless'
@@ -189,10 +476,12 @@ class ActionManagerActionTests(ActionManagerTestBase):
         mock_stop_and_return.assert_called_with(
             yadtshell.commandline.EXIT_CODE_CANCELED_BY_USER)
 
+    @patch('yadtshell.actionmanager.checksum_of')
+    @patch('yadtshell.actionmanager.ActionJournal')
     @patch('yadtshell.actionmanager.print', create=True)
     @patch('yadtshell.actionmanager.sys.stdout')
     @patch('yadtshell.twisted.stop_and_return')
-    @patch('yadtshell.actionmanager.yaml.load')
+    @patch('yadtshell.actionmanager.load_plan')
     @patch('yadtshell.actionmanager.open', create=True)
     @patch('yadtshell.util.restore_current_state')
     def test_should_not_abort_when_user_confirms(self,
@@ -201,7 +490,7 @@ class ActionManagerActionTests(ActionManagerTestBase):
                                                  mock_load_action_plan,
                                                  mock_stop_and_return,
                                                  mock_stdout,
-                                                 _):
+                                                 *_):
         mock_stdout.isatty.return_value = True
         noop = Mock()
         noop.cmd = 'harmless'
@@ -213,3 +502,35 @@ class ActionManagerActionTests(ActionManagerTestBase):
         self.am.action('update')
 
         self.assertFalse(mock_stop_and_return.called)
+
+
+class ActionManagerResumeStateTests(ActionManagerTestBase):
+
+    def setUp(self):
+        super(ActionManagerResumeStateTests, self).setUp()
+        self.out_dir = yadtshell.settings.OUT_DIR
+        yadtshell.settings.OUT_DIR = tempfile.mkdtemp()
+        open(os.path.join(yadtshell.settings.OUT_DIR, 'update-action.plan'), 'w').close()
+        state_file = yadtshell.util.current_state()
+        open(state_file, 'w').close()
+        an_hour_ago = time.time() - 3600
+        os.utime(state_file, (an_hour_ago, an_hour_ago))
+
+    def tearDown(self):
+        shutil.rmtree(yadtshell.settings.OUT_DIR)
+        yadtshell.settings.OUT_DIR = self.out_dir
+
+    @patch('yadtshell.util.restore_state')
+    def test_should_resume_with_state_older_than_allowed(self, restore_state):
+        restore_state.return_value = {}
+
+        deferred = self.am.action('update', resume=True)
+
+        self.assertEqual(self.am.components, {})
+        self.assertTrue(deferred.called)
+
+    @patch('yadtshell.util.restore_state')
+    def test_should_refuse_state_older_than_allowed_without_resume(self, restore_state):
+        restore_state.return_value = {}
+
+        self.assertRaises(IOError, self.am.action, 'update')
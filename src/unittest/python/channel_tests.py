@@ -0,0 +1,126 @@
+import subprocess
+import unittest
+
+from mock import Mock, patch
+from twisted.internet.error import ProcessDone, ProcessTerminated
+import twisted.python.failure as failure
+
+import yadtshell
+from yadtshell.channel import (CommandChannel,
+                               ChannelPool,
+                               EXIT_CODE_PATTERN,
+                               READY_MARKER,
+                               SERVER_SCRIPT)
+
+
+class ChannelServerScriptTests(unittest.TestCase):
+
+    def run_server(self, shell, requests):
+        server = subprocess.Popen([shell, '-c', SERVER_SCRIPT], stdin=subprocess.PIPE,
+                                  stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        output, control = server.communicate(requests)
+        lines = control.splitlines()
+        self.assertEqual(lines[0], READY_MARKER)
+        exit_codes = dict(EXIT_CODE_PATTERN.match(line).groups() for line in lines
+                          if EXIT_CODE_PATTERN.match(line))
+        return output, exit_codes
+
+    def assert_exit_code_of_each_request_reported(self, shell):
+        output, exit_codes = self.run_server(shell, '0 sleep 0.1; exit 3\n1 echo "hello world"\n')
+
+        self.assertTrue('hello world' in output.splitlines())
+        self.assertEqual(exit_codes, {'0': '3', '1': '0'})
+
+    def test_should_report_exit_code_of_each_request_with_sh(self):
+        self.assert_exit_code_of_each_request_reported('sh')
+
+    def test_should_report_exit_code_of_each_request_with_bash(self):
+        self.assert_exit_code_of_each_request_reported('bash')
+
+    def test_should_report_exit_codes_after_output_without_newline(self):
+        output, exit_codes = self.run_server('sh', '0 printf running; echo failed >&2\n1 true\n')
+
+        self.assertEqual(exit_codes, {'0': '0', '1': '0'})
+        self.assertTrue('running' in output)
+        self.assertTrue('failed' in output)
+
+
+class CommandChannelTests(unittest.TestCase):
+
+    def setUp(self):
+        self.closed_fun = Mock()
+        self.channel = CommandChannel('foobar42.acme.com', self.closed_fun)
+        self.channel.transport = Mock()
+        self.protocols = [Mock(), Mock()]
+        self.channel.execute('ssh foobar42.acme.com "yadt-command foo"', 'yadt-command foo', self.protocols[0])
+        self.channel.execute('ssh foobar42.acme.com "yadt-command bar"', 'yadt-command bar', self.protocols[1])
+
+    def exit_code_of(self, protocol):
+        return protocol.finish.call_args[0][0].value.exitCode
+
+    def test_should_write_requests_with_ids(self):
+        self.assertEqual([call[0][0] for call in self.channel.transport.write.call_args_list],
+                         ['0 yadt-command foo\n', '1 yadt-command bar\n'])
+
+    def test_should_finish_protocols_of_answered_requests(self):
+        self.channel.outReceived('some output')
+        self.channel.errReceived('%s\nyadt-channel-exit 1 15' % READY_MARKER)
+        self.channel.errReceived('1\n')
+
+        self.assertFalse(self.protocols[0].finish.called)
+        self.assertEqual(self.exit_code_of(self.protocols[1]), 151)
+
+    def test_should_fail_pending_requests_when_ready_channel_ends(self):
+        self.channel.errReceived('%s\nyadt-channel-exit 0 0\n' % READY_MARKER)
+
+        self.channel.processEnded(failure.Failure(ProcessTerminated(exitCode=255)))
+
+        self.assertEqual(self.exit_code_of(self.protocols[0]), 0)
+        self.assertEqual(self.exit_code_of(self.protocols[1]), 255)
+        self.closed_fun.assert_called_with(self.channel)
+
+    @patch('yadtshell.command_batch.reactor')
+    def test_should_spawn_pending_requests_when_channel_was_never_ready(self, reactor):
+        self.channel.processEnded(failure.Failure(ProcessDone(0)))
+
+        self.assertEqual([call[0][0] for call in reactor.spawnProcess.call_args_list], self.protocols)
+        self.assertFalse(self.protocols[0].finish.called)
+
+
+class ChannelPoolTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ssh = yadtshell.settings.SSH
+        yadtshell.settings.SSH = 'ssh -q'
+        self.pool = ChannelPool()
+        self.component = Mock(fqdn='foobar42.acme.com')
+        self.cmdline = 'ssh -q foobar42.acme.com WHO="me" "yadt-command yadt-service-status foo" '
+
+    def tearDown(self):
+        yadtshell.settings.SSH = self.ssh
+
+    def connect_spawned_channels(self, reactor):
+        reactor.spawnProcess.side_effect = lambda channel, *args: setattr(channel, 'transport', Mock())
+
+    @patch('yadtshell.channel.reactor')
+    def test_should_open_one_channel_per_host(self, reactor):
+        self.connect_spawned_channels(reactor)
+        self.assertTrue(self.pool.add(self.component, self.cmdline, Mock()))
+        self.assertTrue(self.pool.add(self.component, self.cmdline, Mock()))
+
+        self.assertEqual(reactor.spawnProcess.call_count, 1)
+        self.assertEqual(reactor.spawnProcess.call_args[0][2],
+                         ['ssh', '-q', 'foobar42.acme.com', SERVER_SCRIPT])
+
+    @patch('yadtshell.channel.reactor')
+    def test_should_not_use_channel_of_unavailable_host(self, reactor):
+        self.connect_spawned_channels(reactor)
+        self.pool.add(self.component, self.cmdline, Mock())
+        channel = self.pool.channels['foobar42.acme.com']
+
+        self.pool.channel_closed(channel)
+
+        self.assertFalse(self.pool.add(self.component, self.cmdline, Mock()))
+
+    def test_should_not_use_channel_for_local_commands(self):
+        self.assertFalse(self.pool.add(self.component, 'yadt-service-status foo', Mock()))
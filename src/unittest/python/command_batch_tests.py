@@ -0,0 +1,103 @@
+import subprocess
+import unittest
+
+from mock import Mock, patch
+
+import yadtshell
+from yadtshell.command_batch import (CommandBatcher,
+                                     create_batch_script,
+                                     parse_batch_output)
+
+
+class CommandBatchScriptTests(unittest.TestCase):
+
+    def test_should_report_output_and_exit_code_of_each_command(self):
+        script = create_batch_script(['echo stopping foo; echo failed >&2; exit 151',
+                                      'printf stopped'])
+
+        output = subprocess.Popen(['sh', '-c', script], stdout=subprocess.PIPE).communicate()[0]
+
+        self.assertEqual(parse_batch_output(output),
+                         {0: {'out': 'stopping foo\n', 'err': 'failed\n', 'exit': 151},
+                          1: {'out': 'stopped\n', 'err': '', 'exit': 0}})
+
+    def test_should_ignore_other_output(self):
+        output = 'Warning: Permanently added host\nyadt-batch-exit 0 0\n'
+
+        self.assertEqual(parse_batch_output(output), {0: {'out': '', 'err': '', 'exit': 0}})
+
+
+class CommandBatcherTests(unittest.TestCase):
+
+    def setUp(self):
+        self.ssh = yadtshell.settings.SSH
+        yadtshell.settings.SSH = 'ssh -q'
+        self.batcher = CommandBatcher()
+        self.component = Mock(fqdn='foobar42.acme.com')
+
+    def tearDown(self):
+        yadtshell.settings.SSH = self.ssh
+
+    def cmdline(self, service):
+        return ('ssh -q foobar42.acme.com WHO="me" YADT_LOG_FILE="/tmp/%s.log"'
+                ' "yadt-command yadt-service-stop %s" ' % (service, service))
+
+    @patch('yadtshell.command_batch.reactor')
+    def test_should_spawn_single_command_unchanged(self, reactor):
+        protocol = Mock()
+
+        self.assertTrue(self.batcher.add(self.component, self.cmdline('foo'), protocol))
+        self.batcher.flush('foobar42.acme.com')
+
+        reactor.spawnProcess.assert_called_with(
+            protocol, 'ssh',
+            ['ssh', '-q', 'foobar42.acme.com', 'WHO=me', 'YADT_LOG_FILE=/tmp/foo.log',
+             'yadt-command yadt-service-stop foo'], None)
+
+    @patch('yadtshell.command_batch.reactor')
+    def test_should_spawn_commands_of_same_host_at_once(self, reactor):
+        self.batcher.add(self.component, self.cmdline('foo'), Mock())
+        self.batcher.add(self.component, self.cmdline('bar'), Mock())
+
+        reactor.callLater.assert_called_once_with(0.05, self.batcher.flush, 'foobar42.acme.com')
+        self.batcher.flush('foobar42.acme.com')
+
+        self.assertEqual(reactor.spawnProcess.call_count, 1)
+        cmdline = reactor.spawnProcess.call_args[0][2]
+        self.assertEqual(cmdline[:3], ['ssh', '-q', 'foobar42.acme.com'])
+        self.assertEqual(cmdline[3], create_batch_script(
+            ['WHO=me YADT_LOG_FILE=/tmp/foo.log yadt-command yadt-service-stop foo',
+             'WHO=me YADT_LOG_FILE=/tmp/bar.log yadt-command yadt-service-stop bar']))
+
+    def test_should_not_batch_local_commands(self):
+        self.assertFalse(self.batcher.add(self.component, 'yadt-service-stop foo', Mock()))
+
+    def test_should_finish_each_protocol_with_its_exit_code(self):
+        batch_protocol = Mock(data='yadt-batch-exit 1 151\nyadt-batch-exit 0 0\n', exitcode=0)
+        protocols = [Mock(), Mock(), Mock()]
+
+        self.batcher.finish(None, batch_protocol, protocols)
+
+        exit_codes = [protocol.finish.call_args[0][0].value.exitCode for protocol in protocols]
+        self.assertEqual(exit_codes, [0, 151, 1])
+
+    def test_should_fail_all_protocols_when_ssh_fails(self):
+        batch_protocol = Mock(data='', exitcode=255)
+        protocols = [Mock(), Mock()]
+
+        self.batcher.finish(None, batch_protocol, protocols)
+
+        exit_codes = [protocol.finish.call_args[0][0].value.exitCode for protocol in protocols]
+        self.assertEqual(exit_codes, [255, 255])
+
+    def test_should_pass_output_to_the_protocol_of_its_command(self):
+        batch_protocol = Mock(data='yadt-batch-out 0 stopped foo\nyadt-batch-exit 0 0\n'
+                                   'yadt-batch-err 1 failed\nyadt-batch-exit 1 1\n', exitcode=0)
+        protocols = [Mock(), Mock()]
+
+        self.batcher.finish(None, batch_protocol, protocols)
+
+        protocols[0].outReceived.assert_called_with('stopped foo\n')
+        self.assertFalse(protocols[0].errReceived.called)
+        protocols[1].errReceived.assert_called_with('failed\n')
+        self.assertFalse(protocols[1].outReceived.called)
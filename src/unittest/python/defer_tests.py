@@ -1,7 +1,15 @@
-from yadtshell.defer import DeferredPool
+from yadtshell.defer import (AdaptiveConcurrency,
+                             DeferredPool,
+                             FanOut,
+                             GroupLimiter,
+                             notify_state_change,
+                             IDLE_WORKER_POLL_SECONDS,
+                             TASK_BLOCKED)
 
 import unittest
+import yadtshell.defer
 from mock import patch, call, Mock
+from twisted.internet import defer, task
 
 
 class DeferredPoolTests(unittest.TestCase):
@@ -133,6 +141,18 @@ class DeferredPoolTests(unittest.TestCase):
         self.assertEqual(next_task, None)
         stop_workers.assert_called_with()
 
+    @patch('yadtshell.defer.DeferredPool.Worker.run')
+    @patch('yadtshell.defer.DeferredPool._stop_workers')
+    def test_next_task_should_not_stop_workers_when_tasks_are_blocked(self, stop_workers, _):
+        pool = DeferredPool('pool-name', queue=['some-stuff'])
+        pool.all_workers_idle = lambda: True
+        pool.next_task_fun = lambda _: TASK_BLOCKED
+
+        next_task = pool._next_task()
+
+        self.assertEqual(next_task, None)
+        self.assertFalse(stop_workers.called)
+
     @patch('yadtshell.defer.DeferredPool.Worker.run')
     def test_next_task_should_return_task_when_tasks_are_available(self, _):
         pool = DeferredPool('pool-name', queue=['some-stuff'])
@@ -141,3 +161,255 @@ class DeferredPoolTests(unittest.TestCase):
         next_task = pool._next_task()
 
         self.assertEqual(next_task, 'some-stuff')
+
+
+class DeferredPoolWakeUpTests(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.reactor_patcher = patch('yadtshell.defer.reactor', self.clock)
+        self.reactor_patcher.start()
+        self.started = []
+        self.ready = set()
+
+    def tearDown(self):
+        self.reactor_patcher.stop()
+        del yadtshell.defer._waiting_workers[:]
+
+    def create_task(self, name, deferred):
+        def fun(plan, path):
+            self.started.append(name)
+            return deferred
+        return Mock(fun=fun, action=name, path=[])
+
+    def next_ready_task(self, queue):
+        for t in queue:
+            if t.action in self.ready:
+                queue.remove(t)
+                return t
+        return None
+
+    def test_should_start_waiting_task_when_task_finishes(self):
+        first, second = defer.Deferred(), defer.Deferred()
+        self.ready.add('first')
+        pool = DeferredPool('pool-name', [self.create_task('first', first), self.create_task('second', second)],
+                            nr_workers=2, next_task_fun=self.next_ready_task)
+
+        self.ready.add('second')
+        first.callback(None)
+        self.clock.advance(0)
+
+        self.assertEqual(self.started, ['first', 'second'])
+        second.callback(None)
+        self.clock.advance(0)
+        self.assertTrue(pool.called)
+
+    def test_should_wake_up_waiting_worker_on_state_change(self):
+        first, second = defer.Deferred(), defer.Deferred()
+        self.ready.add('first')
+        DeferredPool('pool-name', [self.create_task('first', first), self.create_task('second', second)],
+                     nr_workers=2, next_task_fun=self.next_ready_task)
+
+        self.ready.add('second')
+        notify_state_change()
+        self.clock.advance(0)
+
+        self.assertEqual(self.started, ['first', 'second'])
+
+    def test_should_poll_when_state_change_is_not_notified(self):
+        first, second = defer.Deferred(), defer.Deferred()
+        self.ready.add('first')
+        DeferredPool('pool-name', [self.create_task('first', first), self.create_task('second', second)],
+                     nr_workers=2, next_task_fun=self.next_ready_task)
+
+        self.ready.add('second')
+        self.clock.advance(IDLE_WORKER_POLL_SECONDS - 1)
+        self.assertEqual(self.started, ['first'])
+        self.clock.advance(1)
+        self.clock.advance(0)
+
+        self.assertEqual(self.started, ['first', 'second'])
+
+
+    def test_should_grow_and_shrink_running_tasks_adaptively(self):
+        deferreds = dict((name, defer.Deferred()) for name in ['a', 'b', 'c', 'd', 'e'])
+        self.ready.update(deferreds)
+        concurrency = AdaptiveConcurrency(5, nr_errors_tolerated=2)
+        DeferredPool('pool-name', [self.create_task(name, deferreds[name]) for name in sorted(deferreds)],
+                     nr_workers=5, next_task_fun=self.next_ready_task, nr_errors_tolerated=2,
+                     concurrency=concurrency)
+
+        self.assertEqual(self.started, ['a'])
+        deferreds['a'].callback(None)
+        self.clock.advance(0)
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        deferreds['b'].errback(Exception('failed'))
+        self.clock.advance(0)
+        self.assertEqual(concurrency.limit, 1)
+        self.assertEqual(self.started, ['a', 'b', 'c'])
+        deferreds['c'].callback(None)
+        self.clock.advance(0)
+
+        self.assertEqual(self.started, ['a', 'b', 'c', 'd', 'e'])
+
+
+class AdaptiveConcurrencyTests(unittest.TestCase):
+
+    def test_should_not_exceed_max_limit(self):
+        concurrency = AdaptiveConcurrency(2, nr_errors_tolerated=10)
+
+        for _ in range(3):
+            concurrency.task_done(True)
+
+        self.assertEqual(concurrency.limit, 2)
+
+    def test_should_halve_limit_on_failure(self):
+        concurrency = AdaptiveConcurrency(100, nr_errors_tolerated=10)
+        for _ in range(7):
+            concurrency.task_done(True)
+
+        concurrency.task_done(False)
+
+        self.assertEqual(concurrency.limit, 4)
+
+    def test_should_not_grow_beyond_remaining_error_budget(self):
+        concurrency = AdaptiveConcurrency(100, nr_errors_tolerated=3)
+        for _ in range(30):
+            concurrency.task_done(True)
+        self.assertEqual(concurrency.limit, 4)
+
+        concurrency.task_done(False)
+        concurrency.task_done(False)
+        for _ in range(30):
+            concurrency.task_done(True)
+
+        self.assertEqual(concurrency.limit, 2)
+
+    def test_should_run_one_task_at_a_time_without_error_budget(self):
+        concurrency = AdaptiveConcurrency(100)
+
+        for _ in range(30):
+            concurrency.task_done(True)
+
+        self.assertEqual(concurrency.limit, 1)
+
+    def test_should_run_one_task_at_a_time_when_error_budget_is_exhausted(self):
+        concurrency = AdaptiveConcurrency(100, nr_errors_tolerated=1)
+        concurrency.task_done(False)
+        concurrency.task_done(False)
+
+        for _ in range(30):
+            concurrency.task_done(True)
+
+        self.assertEqual(concurrency.limit, 1)
+
+
+class GroupLimiterTests(unittest.TestCase):
+
+    def test_should_limit_running_units_per_group(self):
+        limiter = GroupLimiter(2)
+
+        self.assertTrue(limiter.acquire({'ber': 2}))
+        self.assertFalse(limiter.acquire({'ber': 1, 'ham': 1}))
+        self.assertTrue(limiter.acquire({'ham': 1}))
+
+    def test_should_admit_oversized_demand_of_idle_group(self):
+        limiter = GroupLimiter(2)
+
+        self.assertTrue(limiter.acquire({'ber': 3}))
+        self.assertFalse(limiter.acquire({'ber': 1}))
+
+    @patch('yadtshell.defer.notify_state_change')
+    def test_should_wake_up_workers_on_release(self, notify_state_change):
+        limiter = GroupLimiter(1)
+        limiter.acquire({'ber': 1})
+
+        limiter.release({'ber': 1})
+
+        self.assertTrue(limiter.acquire({'ber': 1}))
+        self.assertTrue(notify_state_change.called)
+
+
+class FanOutTests(unittest.TestCase):
+
+    def setUp(self):
+        self.calls = []
+
+    def pending_call(self, name):
+        deferred = defer.Deferred()
+        self.calls.append((name, deferred))
+        return deferred
+
+    def started(self):
+        return [name for name, _ in self.calls]
+
+    def test_should_start_calls_immediately_when_unlimited(self):
+        fan_out = FanOut('fan-out')
+
+        for name in ['a', 'b', 'c']:
+            fan_out.submit(self.pending_call, args=(name,))
+
+        self.assertEqual(self.started(), ['a', 'b', 'c'])
+
+    def test_should_not_exceed_max_running_calls(self):
+        fan_out = FanOut('fan-out', max_running=2)
+
+        for name in ['a', 'b', 'c']:
+            fan_out.submit(self.pending_call, args=(name,))
+
+        self.assertEqual(self.started(), ['a', 'b'])
+
+    def test_should_start_waiting_call_when_running_call_finishes(self):
+        fan_out = FanOut('fan-out', max_running=1)
+        first = fan_out.submit(self.pending_call, args=('a',))
+        second = fan_out.submit(self.pending_call, args=('b',))
+
+        self.calls[0][1].callback('result-a')
+
+        self.assertEqual(first.result, 'result-a')
+        self.assertEqual(self.started(), ['a', 'b'])
+        self.assertFalse(second.called)
+
+    def test_should_start_waiting_call_when_running_call_fails(self):
+        fan_out = FanOut('fan-out', max_running=1)
+        first = fan_out.submit(self.pending_call, args=('a',))
+        fan_out.submit(self.pending_call, args=('b',))
+        errors = []
+        first.addErrback(errors.append)
+
+        self.calls[0][1].errback(Exception('boom'))
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(self.started(), ['a', 'b'])
+
+    def test_should_start_calls_by_priority(self):
+        fan_out = FanOut('fan-out', max_running=1)
+        fan_out.submit(self.pending_call, args=('a',))
+        fan_out.submit(self.pending_call, args=('late',), priority=1)
+        fan_out.submit(self.pending_call, args=('early',))
+
+        self.calls[0][1].callback(None)
+        self.calls[1][1].callback(None)
+
+        self.assertEqual(self.started(), ['a', 'early', 'late'])
+
+    def test_should_limit_running_calls_per_group(self):
+        fan_out = FanOut('fan-out', max_running_per_group=1, group_fun=lambda key: key[0])
+
+        for name in ['a1', 'a2', 'b1']:
+            fan_out.submit(self.pending_call, args=(name,), key=name)
+
+        self.assertEqual(self.started(), ['a1', 'b1'])
+        self.calls[0][1].callback(None)
+        self.assertEqual(self.started(), ['a1', 'b1', 'a2'])
+
+    def test_should_start_many_synchronous_calls_behind_pending_call(self):
+        fan_out = FanOut('fan-out', max_running=1)
+        fan_out.submit(self.pending_call, args=('a',))
+        results = [fan_out.submit(defer.succeed, args=(index,)) for index in range(3000)]
+
+        self.calls[0][1].callback(None)
+
+        self.assertEqual([result.result for result in results], range(3000))
+        self.assertEqual((fan_out.running, fan_out.waiting), (0, []))
+
@@ -0,0 +1,169 @@
+import unittest
+
+import yadtshell
+from yadtshell.components import ComponentDict, Host, Service, MissingComponent
+from yadtshell.constants import STANDALONE_SERVICE_RANK
+from yadtshell.dependencies import (wire_dependencies,
+                                    compute_dependency_scores,
+                                    DependencyIndex)
+from yadtshell.util import inbound_deps_on_same_host, outbound_deps_on_same_host
+
+
+class DependencyWiringTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.TARGET_SETTINGS = {
+            'name': 'test', 'hosts': ['foobar42']}
+        self.components = ComponentDict()
+        self.host = Host('foobar42')
+        self.components[self.host.uri] = self.host
+
+    def add_service(self, name, needs=()):
+        service = Service(self.host, name, {'needs_services': list(needs)})
+        self.components[service.uri] = service
+        return service
+
+    def test_should_add_needed_by_to_needed_components(self):
+        backend = self.add_service('backend')
+        frontend = self.add_service('frontend', needs=['backend'])
+
+        wire_dependencies(self.components)
+
+        self.assertTrue('service://foobar42/backend' in frontend.needs)
+        self.assertTrue('service://foobar42/frontend' in backend.needed_by)
+        self.assertTrue('service://foobar42/frontend' in self.host.needed_by)
+
+    def test_should_add_missing_components(self):
+        frontend = self.add_service('frontend')
+        frontend.needs.add('service://otherhost/backend')
+
+        wire_dependencies(self.components)
+
+        missing = self.components['service://otherhost/backend']
+        self.assertTrue(isinstance(missing, MissingComponent))
+        self.assertEqual(missing.needed_by, set(['service://foobar42/frontend']))
+
+    def test_should_add_needs_for_declared_needed_by(self):
+        backend = self.add_service('backend')
+        frontend = self.add_service('frontend')
+        backend.needed_by.add(frontend.uri)
+
+        wire_dependencies(self.components)
+
+        self.assertTrue(backend.uri in frontend.needs)
+
+
+class DependencyClosureTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.TARGET_SETTINGS = {
+            'name': 'test', 'hosts': ['foobar42']}
+        self.components = ComponentDict()
+        self.host = Host('foobar42')
+        self.components[self.host.uri] = self.host
+        for name, needs in [('db', []),
+                            ('backend', ['db']),
+                            ('frontend', ['backend']),
+                            ('admin', ['backend', 'db']),
+                            ('cache', [])]:
+            service = Service(self.host, name, {'needs_services': needs})
+            self.components[service.uri] = service
+        wire_dependencies(self.components)
+        self.index = DependencyIndex(self.components)
+
+    def test_should_find_transitive_dependents(self):
+        self.assertEqual(self.index.closure(['service://foobar42/db'], 'needed_by'),
+                         set(['service://foobar42/db', 'service://foobar42/backend',
+                              'service://foobar42/frontend', 'service://foobar42/admin']))
+
+    def test_should_find_transitively_needed_components(self):
+        self.assertEqual(self.index.closure(['service://foobar42/frontend'], 'needs'),
+                         set(['service://foobar42/frontend', 'service://foobar42/backend',
+                              'service://foobar42/db', 'host://foobar42']))
+
+    def test_should_not_follow_dependents_which_are_not_touched(self):
+        backend = self.components['service://foobar42/backend']
+        backend.is_touched_also = lambda other: other.uri != 'service://foobar42/db'
+
+        self.assertEqual(self.index.closure(['service://foobar42/db'], 'needed_by'),
+                         set(['service://foobar42/db', 'service://foobar42/admin']))
+
+
+class DependencyScoreTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.TARGET_SETTINGS = {
+            'name': 'test', 'hosts': ['foobar42']}
+        self.components = ComponentDict()
+        self.host = Host('foobar42')
+
+    def add_diamonds(self, count):
+        """Adds `count` diamonds on top of each other: each top service
+        needs a left and a right service, which both need the next top service.
+        """
+        top = 'top0'
+        services = {top: []}
+        for i in range(count):
+            next_top = 'top%d' % (i + 1)
+            services[top] = ['left%d' % i, 'right%d' % i]
+            services['left%d' % i] = [next_top]
+            services['right%d' % i] = [next_top]
+            services[next_top] = []
+            top = next_top
+        for name, needs in services.items():
+            service = Service(self.host, name, {'needs_services': needs})
+            self.components[service.uri] = service
+        wire_dependencies(self.components)
+
+    def test_should_compute_same_scores_as_recursive_dependency_search(self):
+        self.add_diamonds(4)
+
+        compute_dependency_scores(self.components)
+
+        for service in self.components.values():
+            if isinstance(service, Service):
+                expected = (len(inbound_deps_on_same_host(service, self.components)) -
+                            len(outbound_deps_on_same_host(service, self.components)))
+                self.assertEqual(service.dependency_score, expected)
+
+    def test_should_count_each_service_of_many_diamonds_once(self):
+        self.add_diamonds(200)
+
+        compute_dependency_scores(self.components)
+
+        self.assertEqual(self.components['service://foobar42/top0'].dependency_score, -600)
+        self.assertEqual(self.components['service://foobar42/top200'].dependency_score, 600)
+        self.assertEqual(self.components['service://foobar42/left100'].dependency_score, 301 - 298)
+
+    def test_should_not_count_services_of_hosts_with_same_prefix(self):
+        backend = Service(Host('foobar4'), 'backend', {})
+        frontend = Service(self.host, 'frontend', {'needs_services': ['service://foobar4/backend']})
+        self.components[backend.uri] = backend
+        self.components[frontend.uri] = frontend
+        wire_dependencies(self.components)
+
+        compute_dependency_scores(self.components)
+
+        self.assertEqual(frontend.dependency_score, STANDALONE_SERVICE_RANK)
+
+    def test_should_score_host_with_thousand_services(self):
+        # every service needs the next one and every tenth service needs the
+        # next ten ones, so there are many paths to each service
+        for i in range(1000):
+            needs = ['s%d' % j for j in range(i + 1, min(i + 11 if i % 10 == 0 else i + 2, 1000))]
+            service = Service(self.host, 's%d' % i, {'needs_services': needs})
+            self.components[service.uri] = service
+        wire_dependencies(self.components)
+
+        compute_dependency_scores(self.components)
+
+        self.assertEqual(self.components['service://foobar42/s0'].dependency_score, -999)
+        self.assertEqual(self.components['service://foobar42/s999'].dependency_score, 999)
+
+    def test_should_raise_error_on_service_cycle(self):
+        for name, needs in [('foo', ['bar']), ('bar', ['baz']), ('baz', ['foo'])]:
+            service = Service(self.host, name, {'needs_services': needs})
+            self.components[service.uri] = service
+        wire_dependencies(self.components)
+
+        self.assertRaises(EnvironmentError, compute_dependency_scores, self.components)
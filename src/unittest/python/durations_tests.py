@@ -0,0 +1,121 @@
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import Mock, patch
+
+from yadtshell.actions import Action
+from yadtshell.durations import DurationStore, percentile
+
+
+class Tomcat(object):
+    pass
+
+
+class PercentileTests(unittest.TestCase):
+
+    def test_should_return_nearest_rank(self):
+        self.assertEqual(percentile([5, 1, 3, 2, 4], 50), 3)
+        self.assertEqual(percentile([5, 1, 3, 2, 4], 100), 5)
+        self.assertEqual(percentile([5, 1, 3, 2, 4], 0), 1)
+        self.assertEqual(percentile([], 50), None)
+
+
+class DurationStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.out_dir, 'durations.tsv')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_should_restore_recorded_durations(self):
+        DurationStore(self.filename).record('start', 'service://foobar42/backend', 'Service', 12.5)
+        DurationStore(self.filename).record('start', 'service://foobar42/backend', 'Service', 7.5)
+
+        store = DurationStore(self.filename)
+
+        self.assertEqual(store.expected('start', 'service://foobar42/backend', 'Service', p=100), 12.5)
+        self.assertEqual(store.expected('start', 'service://foobar42/backend', p=0), 7.5)
+
+    def test_should_fall_back_to_durations_of_same_class(self):
+        store = DurationStore(self.filename)
+        store.record('start', 'service://foobar42/backend', 'Tomcat', 30)
+
+        self.assertEqual(store.expected('start', 'service://foobar43/backend', 'Tomcat'), 30)
+        self.assertEqual(store.expected('start', 'service://foobar43/backend'), None)
+        self.assertEqual(store.expected('stop', 'service://foobar42/backend', 'Tomcat'), None)
+
+    def test_should_keep_latest_samples_only(self):
+        store = DurationStore(self.filename)
+        for seconds in range(30):
+            store.record('stop', 'service://foobar42/backend', 'Service', seconds)
+
+        self.assertEqual(len(store.samples[('stop', 'service://foobar42/backend', 'Service')]), 20)
+        self.assertEqual(store.expected('stop', 'service://foobar42/backend', p=0), 10)
+
+    @patch('yadtshell.durations.MAX_FILE_SIZE', 2000)
+    def test_should_compact_file_when_it_grows_too_large(self):
+        store = DurationStore(self.filename)
+        for seconds in range(100):
+            store.record('stop', 'service://foobar42/backend', 'Service', seconds)
+
+        with open(self.filename) as f:
+            self.assertTrue(len(f.readlines()) < 40)
+        self.assertEqual(DurationStore(self.filename).expected('stop', 'service://foobar42/backend', p=0),
+                         store.expected('stop', 'service://foobar42/backend', p=0))
+
+    @patch('yadtshell.durations.MAX_FILE_SIZE', 2000)
+    def test_should_not_compact_file_holding_latest_samples_only(self):
+        store = DurationStore(self.filename)
+        compactions = []
+        compact = store.compact
+        store.compact = lambda: compactions.append(compact())
+        for seconds in range(20):
+            for service in range(50):
+                store.record('stop', 'service://foobar42/backend%d' % service, 'Service', seconds)
+
+        self.assertEqual(compactions, [])
+
+    def test_should_append_to_file_replaced_while_waiting_for_lock(self):
+        DurationStore(self.filename).record('stop', 'service://foobar42/backend', 'Service', 1)
+        compacting_store = DurationStore(self.filename)
+        lock_fd = compacting_store._lock()
+        recording = threading.Thread(target=DurationStore(self.filename).record,
+                                     args=('start', 'service://foobar42/backend', 'Service', 2))
+        recording.start()
+        time.sleep(0.1)
+        replacement = self.filename + '.new'
+        with open(replacement, 'w') as f:
+            f.write('1\tstop\tservice://foobar42/backend\tService\t1.000\n')
+        os.rename(replacement, self.filename)
+        os.close(lock_fd)
+        recording.join()
+
+        self.assertEqual(DurationStore(self.filename).expected('start', 'service://foobar42/backend'), 2)
+
+    def test_should_ignore_partially_written_lines(self):
+        with open(self.filename, 'w') as f:
+            f.write('1\tstart\tservice://foobar42/backend\tService\t3.000\n1\tstart\tserv')
+
+        store = DurationStore(self.filename)
+
+        self.assertEqual(store.expected('start', 'service://foobar42/backend'), 3)
+
+    def test_should_fall_back_to_durations_of_same_class_for_action(self):
+        store = DurationStore(self.filename)
+        store.record('start', 'service://foobar42/backend', 'Tomcat', 30)
+        components = {'service://foobar43/backend': Tomcat()}
+
+        self.assertEqual(store.expected_for_action(Action('start', 'service://foobar43/backend'),
+                                                   components=components), 30)
+        self.assertEqual(store.expected_for_action(Action('start', 'service://foobar43/backend')), None)
+
+    def test_should_return_default_for_action_without_durations(self):
+        store = DurationStore(self.filename)
+
+        self.assertEqual(store.expected_for_action(Mock(cmd='start', uri='service://foobar42/backend'), 1), 1)
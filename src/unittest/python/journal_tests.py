@@ -0,0 +1,75 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from yadtshell.actions import Action, ActionPlan
+from yadtshell.journal import ActionJournal, action_keys
+
+
+class ActionKeysTests(unittest.TestCase):
+
+    def test_should_tell_apart_actions_on_the_same_component(self):
+        stop = Action('stop', 'service://foobar42/backend')
+        start = Action('start', 'service://foobar42/backend')
+        plan = ActionPlan('restart', [ActionPlan('stop', [stop]), start])
+
+        self.assertEqual(action_keys(plan), {id(stop): '0 stop@service://foobar42/backend',
+                                             id(start): '1 start@service://foobar42/backend'})
+
+
+class ActionJournalTests(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.out_dir, 'start-action.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_should_replay_last_state_of_each_action(self):
+        journal = ActionJournal(self.filename, 'abc')
+        journal.open(truncate=True)
+        journal.record('0 start@service://foobar42/db', 'RUNNING')
+        journal.record('1 start@service://foobar42/backend', 'RUNNING')
+        journal.record('0 start@service://foobar42/db', 'FINISHED')
+        journal.close()
+
+        self.assertEqual(ActionJournal(self.filename, 'abc').replay(),
+                         {'0 start@service://foobar42/db': 'FINISHED',
+                          '1 start@service://foobar42/backend': 'RUNNING'})
+
+    def test_should_ignore_journal_of_another_plan(self):
+        journal = ActionJournal(self.filename, 'abc')
+        journal.open(truncate=True)
+        journal.record('0 start@service://foobar42/db', 'FINISHED')
+        journal.close()
+
+        self.assertEqual(ActionJournal(self.filename, 'def').replay(), {})
+
+    def test_should_ignore_partially_written_line(self):
+        with open(self.filename, 'w') as f:
+            f.write('plan\tabc\nFINISHED\t0 start@service://foobar42/db\nFINI')
+
+        self.assertEqual(ActionJournal(self.filename, 'abc').replay(),
+                         {'0 start@service://foobar42/db': 'FINISHED'})
+
+    def test_should_append_when_resuming(self):
+        journal = ActionJournal(self.filename, 'abc')
+        journal.open(truncate=True)
+        journal.record('0 start@service://foobar42/db', 'FINISHED')
+        journal.close()
+
+        journal.open()
+        journal.record('1 start@service://foobar42/backend', 'FINISHED')
+        journal.remove()
+
+        self.assertFalse(os.path.exists(self.filename))
+
+    def test_should_not_record_when_journal_cannot_be_opened(self):
+        journal = ActionJournal(os.path.join(self.out_dir, 'missing', 'start-action.journal'), 'abc')
+        journal.open(truncate=True)
+
+        journal.record('0 start@service://foobar42/db', 'RUNNING')
+
+        self.assertEqual(journal.fd, None)
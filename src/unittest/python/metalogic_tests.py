@@ -1,8 +1,11 @@
 import unittest
-from mock import patch
+from mock import Mock, patch
 
-from yadtshell.metalogic import apply_instructions
-from yadtshell.actions import ActionPlan, Action
+from yadtshell.metalogic import (apply_instructions,
+                                 chop_minimal_related_chunks,
+                                 nr_workers_by_durations,
+                                 DisjointSet)
+from yadtshell.actions import ActionPlan, Action, TargetState
 
 
 class MetalogicTests(unittest.TestCase):
@@ -82,3 +85,86 @@ class MetalogicTests(unittest.TestCase):
         self.assertEqual(second_subplan.nr_errors_tolerated, '1')
         self.assertEqual(len(second_subplan.actions), 3)
         self.assertEqual(second_subplan.actions, actions[1:])
+
+    @patch('yadtshell.metalogic._components_for_durations')
+    @patch('yadtshell.durations.get_duration_store')
+    def test_apply_instructions_should_use_workers_according_to_durations(self, get_duration_store, _):
+        durations = {'service://foo/bar': 60, 'service://foo/baz': 20, 'service://foo/baf': 20}
+        get_duration_store.return_value.expected_for_action.side_effect = (
+            lambda action, components=None: durations.get(action.uri))
+        actions = [
+            Action('sudo service bar stop', 'service://foo/bar'),
+            Action('sudo service baz stop', 'service://foo/baz'),
+            Action('sudo service baf stop', 'service://foo/baf'),
+            Action('sudo service bam stop', 'service://foo/bam')
+        ]
+        original_plan = ActionPlan('test', actions)
+
+        actual_plan = apply_instructions(original_plan, 'test=*_auto_0')
+
+        self.assertEqual(actual_plan.actions[0].nr_workers, 2)
+
+    def test_apply_instructions_should_adapt_workers_of_all_subplans(self):
+        original_plan = ActionPlan('test', [ActionPlan('stop', [Action('stop', 'service://foo/bar')]),
+                                            ActionPlan('start', [Action('start', 'service://foo/bar')], nr_workers=1)])
+
+        actual_plan = apply_instructions(original_plan, 'adaptive')
+
+        self.assertEqual([subplan.nr_workers for subplan in actual_plan.actions], ['adaptive', 1])
+
+    def test_apply_instructions_should_refuse_workers_by_durations_without_wave(self):
+        self.assertRaises(ValueError, apply_instructions, ActionPlan('test', []), 'auto')
+
+
+class NrWorkersByDurationsTests(unittest.TestCase):
+
+    def test_should_use_all_workers_without_durations(self):
+        durations = Mock()
+        durations.expected_for_action.return_value = None
+
+        self.assertEqual(nr_workers_by_durations([Action('start', 'service://foo/bar')] * 3, durations), 3)
+
+    def test_should_sum_up_durations_of_plans(self):
+        durations = Mock()
+        durations.expected_for_action.return_value = 10
+        chunks = [ActionPlan('chunk_0', [Action('start', 'service://foo/bar'), Action('start', 'service://foo/baz')]),
+                  ActionPlan('chunk_1', [Action('start', 'service://foo/baf')]),
+                  ActionPlan('chunk_2', [Action('start', 'service://foo/bam')])]
+
+        self.assertEqual(nr_workers_by_durations(chunks, durations), 2)
+
+
+class DisjointSetTests(unittest.TestCase):
+
+    def test_should_label_set_with_smallest_label(self):
+        chunks = DisjointSet()
+        for label, item in enumerate(['a', 'b', 'c', 'd']):
+            chunks.add(item, label)
+
+        chunks.union('d', 'c')
+        chunks.union('c', 'a')
+
+        self.assertEqual([chunks.label_of(item) for item in 'abcd'], [0, 1, 0, 0])
+        self.assertEqual(chunks.find('d'), 'a')
+
+
+class ChopMinimalRelatedChunksTests(unittest.TestCase):
+
+    def start(self, name, *needed):
+        return Action('start', 'service://foo/%s' % name, 'state', 'up',
+                      preconditions=set([TargetState('service://foo/%s' % other, 'state', 'up')
+                                         for other in needed]))
+
+    def test_should_chunk_actions_related_by_preconditions(self):
+        plan = ActionPlan('start', [self.start('bar', 'baz'),
+                                    self.start('baf', 'elsewhere'),
+                                    self.start('bam', 'baf', 'bat'),
+                                    self.start('baz'),
+                                    self.start('bat')])
+
+        chunked_plan = chop_minimal_related_chunks(plan)
+
+        self.assertEqual(sorted([action.uri for action in chunk.actions] for chunk in chunked_plan.actions),
+                         [['service://foo/baf', 'service://foo/bam', 'service://foo/bat'],
+                          ['service://foo/bar', 'service://foo/baz']])
+        self.assertEqual(sorted(chunk.name for chunk in chunked_plan.actions), ['chunk_0', 'chunk_1'])
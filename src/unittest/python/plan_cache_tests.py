@@ -0,0 +1,132 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import Mock, patch
+
+import yadtshell
+from yadtshell.components import ComponentDict, Host, Service
+from yadtshell.plan_cache import PlanCache, cached_plan, fingerprint_of
+
+
+class FingerprintTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.TARGET_SETTINGS = {
+            'name': 'test', 'hosts': ['foobar42']}
+        self.components = ComponentDict()
+        host = Host('foobar42')
+        self.service = Service(host, 'backend', {'needs_services': ['db']})
+        self.components[host.uri] = host
+        self.components[self.service.uri] = self.service
+
+    def test_should_not_depend_on_attributes_unused_by_planning(self):
+        fingerprint = fingerprint_of(self.components)
+
+        self.service.uptime = 42
+
+        self.assertEqual(fingerprint_of(self.components), fingerprint)
+
+    def test_should_depend_on_state_of_components(self):
+        fingerprint = fingerprint_of(self.components)
+
+        self.service.state = 'down'
+
+        self.assertNotEqual(fingerprint_of(self.components), fingerprint)
+
+
+class PlanCacheTests(unittest.TestCase):
+
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp()
+        self.original_out_dir = yadtshell.settings.OUT_DIR
+        yadtshell.settings.OUT_DIR = self.out_dir
+        yadtshell.settings.TARGET_SETTINGS = {
+            'name': 'test', 'hosts': ['foobar42']}
+        self.cache = PlanCache(os.path.join(self.out_dir, 'plan-cache'))
+
+    def tearDown(self):
+        yadtshell.settings.OUT_DIR = self.original_out_dir
+        shutil.rmtree(self.out_dir)
+
+    def write_plan(self, content):
+        with open(os.path.join(self.out_dir, 'update-action.plan'), 'w') as f:
+            f.write(content)
+
+    def read_plan(self):
+        with open(os.path.join(self.out_dir, 'update-action.plan')) as f:
+            return f.read()
+
+    def test_should_restore_stored_plan(self):
+        key = self.cache.key_for('abc', 'update', ['host://foobar42'], 'max')
+        self.write_plan('the plan')
+        self.cache.store(key, 'update')
+        self.write_plan('another plan')
+
+        self.assertTrue(self.cache.restore(key, 'update'))
+        self.assertEqual(self.read_plan(), 'the plan')
+
+    def test_should_not_restore_plan_of_other_uris_or_options(self):
+        self.write_plan('the plan')
+        self.cache.store(self.cache.key_for('abc', 'update', ['host://foobar42'], 'max'), 'update')
+
+        self.assertFalse(self.cache.restore(self.cache.key_for('abc', 'update', ['host://foobar43'], 'max'), 'update'))
+        self.assertFalse(self.cache.restore(self.cache.key_for('abc', 'update', ['host://foobar42'], 1), 'update'))
+
+    def test_should_not_restore_plan_of_other_target_settings(self):
+        self.write_plan('the plan')
+        self.cache.store(self.cache.key_for('abc', 'update', None, None), 'update')
+
+        yadtshell.settings.TARGET_SETTINGS['update_max_parallel_per_group'] = 2
+
+        self.assertFalse(self.cache.restore(self.cache.key_for('abc', 'update', None, None), 'update'))
+
+    @patch('yadtshell.durations.get_duration_store')
+    def test_should_not_restore_plan_using_durations_recorded_since(self, get_duration_store):
+        get_duration_store.return_value.samples = {('stop', 'service://foobar42/backend', 'Service'): [10]}
+        self.write_plan('the plan')
+        key = self.cache.key_for('abc', 'update', None, 'update=*_auto_0')
+        self.cache.store(key, 'update')
+
+        get_duration_store.return_value.samples = {('stop', 'service://foobar42/backend', 'Service'): [10, 20]}
+
+        self.assertFalse(self.cache.restore(self.cache.key_for('abc', 'update', None, 'update=*_auto_0'), 'update'))
+
+    def test_should_remove_plans_of_other_fingerprints(self):
+        old_key = self.cache.key_for('abc', 'update', None, None)
+        self.write_plan('the plan')
+        self.cache.store(old_key, 'update')
+
+        self.cache.store(self.cache.key_for('def', 'update', None, None), 'update')
+
+        self.assertFalse(self.cache.restore(old_key, 'update'))
+
+    @patch('yadtshell.util.restore_current_state')
+    def test_should_skip_planning_when_plan_is_cached(self, restore_current_state):
+        restore_current_state.return_value = Mock(fingerprint='abc')
+
+        def plan(protocol, uris, parallel=None):
+            self.write_plan('the plan of %s' % uris)
+            return 'update'
+        plan_fun = Mock(side_effect=plan)
+        plan_fun.__name__ = 'plan'
+        cached_plan_fun = cached_plan('update')(plan_fun)
+
+        self.assertEqual(cached_plan_fun(None, ['host://foobar42'], parallel=1), 'update')
+        self.write_plan('another plan')
+        self.assertEqual(cached_plan_fun(None, ['host://foobar42'], parallel=1), 'update')
+
+        self.assertEqual(plan_fun.call_count, 1)
+        self.assertEqual(self.read_plan(), "the plan of ['host://foobar42']")
+
+    @patch('yadtshell.util.restore_current_state')
+    def test_should_not_cache_plans_of_state_without_fingerprint(self, restore_current_state):
+        restore_current_state.return_value = Mock(fingerprint=None)
+        plan_fun = Mock(return_value='update')
+        plan_fun.__name__ = 'plan'
+
+        cached_plan('update')(plan_fun)(None, ['host://foobar42'])
+        cached_plan('update')(plan_fun)(None, ['host://foobar42'])
+
+        self.assertEqual(plan_fun.call_count, 2)
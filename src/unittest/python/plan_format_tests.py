@@ -0,0 +1,57 @@
+import unittest
+
+from StringIO import StringIO
+
+import yaml
+
+from yadtshell.actions import Action, ActionPlan, TargetState
+from yadtshell.plan_format import dump, load
+
+
+class PlanFormatTests(unittest.TestCase):
+
+    def setUp(self):
+        stop = Action('stop', 'service://foobar42/backend', 'state', 'down',
+                      preconditions=set([TargetState('service://foobar42/frontend', 'state', 'down')]))
+        update = Action('update', 'host://foobar42', 'state', 'uptodate',
+                        preconditions=set([TargetState('service://foobar42/backend', 'state', 'down'),
+                                           TargetState('service://foobar42/frontend', 'state', 'down')]),
+                        kwargs={'upgrade_packages': True, 'reboot_required': False})
+        lock = Action('lock', 'host://foobar42', args=['--force'])
+        self.plan = ActionPlan('update', [ActionPlan('stop', set([stop]), nr_workers=2, nr_errors_tolerated=1),
+                                          ActionPlan('update', [update, lock], nr_workers='adaptive')])
+
+    def assert_same_plan(self, plan, other):
+        self.assertEqual(str(plan), str(other))
+        self.assertEqual(list(plan.list_actions), list(other.list_actions))
+
+    def round_trip(self, plan):
+        f = StringIO()
+        dump(plan, f)
+        return load(StringIO(f.getvalue()))
+
+    def test_should_restore_plan(self):
+        plan = self.round_trip(self.plan)
+
+        self.assert_same_plan(plan, self.plan)
+        self.assertEqual(list(plan.list_actions), list(self.plan.list_actions))
+        self.assertEqual([subplan.nr_workers for _, subplan in plan.list_subplans()], [None, 2, 'adaptive'])
+        self.assertEqual(plan.actions[0].nr_errors_tolerated, 1)
+        self.assertEqual(plan.actions[1].actions[1].args, ['--force'])
+
+    def test_should_restore_strings_as_str(self):
+        action = next(self.round_trip(self.plan).list_actions)
+
+        self.assertEqual(type(action.uri), str)
+        self.assertEqual(type(next(iter(action.preconditions)).uri), str)
+
+    def test_should_read_empty_plan(self):
+        self.assertEqual(load(StringIO('')), None)
+
+    def test_should_read_plan_written_as_yaml(self):
+        plan = load(StringIO(yaml.dump(self.plan)))
+
+        self.assert_same_plan(plan, self.plan)
+
+    def test_should_reject_unknown_version(self):
+        self.assertRaises(ValueError, load, StringIO('{"format": "yadtshell-plan", "version": 99, "plan": {}}'))
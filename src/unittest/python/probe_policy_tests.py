@@ -0,0 +1,65 @@
+import unittest
+
+from mock import Mock, patch
+
+from yadtshell.probe_policy import ProbePolicy, ProbeStatistics
+
+
+class ProbePolicyTests(unittest.TestCase):
+
+    def test_should_probe_once_without_max_wait(self):
+        self.assertEqual(ProbePolicy().delays(), [0])
+
+    def test_should_back_off_exponentially_up_to_max_delay(self):
+        policy = ProbePolicy(max_wait=20, first_delay=0.2, delay=0.5, max_delay=4, jitter=0)
+
+        self.assertEqual([round(delay, 6) for delay in policy.delays()], [0, 0.2, 0.5, 1, 2, 4, 4, 4, 4, 0.3])
+
+    def test_should_probe_at_end_of_max_wait(self):
+        policy = ProbePolicy(max_wait=1, first_delay=0.2, delay=0.5, jitter=0)
+
+        delays = policy.delays()
+
+        self.assertEqual([round(delay, 6) for delay in delays], [0, 0.2, 0.5, 0.3])
+        self.assertAlmostEqual(sum(delays), 1)
+
+    def test_should_jitter_delays(self):
+        policy = ProbePolicy(max_wait=100, first_delay=1, delay=1, max_delay=1, jitter=0.5)
+
+        delays = policy.delays()
+
+        self.assertTrue(all(0.5 <= delay <= 1.5 for delay in delays[1:-1]))
+        self.assertNotEqual(len(set(delays)), 2)
+        self.assertAlmostEqual(sum(delays), 100)
+
+    def test_should_wait_as_long_as_legacy_status_max_tries(self):
+        service = Mock(spec=['status_max_tries'])
+        service.status_max_tries = 11
+
+        self.assertEqual(ProbePolicy.of(service).max_wait, 10)
+
+    def test_should_prefer_status_max_wait(self):
+        service = Mock(spec=['status_max_tries', 'status_max_wait', 'status_probe_delay'])
+        service.status_max_tries = 11
+        service.status_max_wait = 60
+        service.status_probe_delay = 2
+
+        policy = ProbePolicy.of(service)
+
+        self.assertEqual(policy.max_wait, 60)
+        self.assertEqual(policy.delay, 2)
+
+
+class ProbeStatisticsTests(unittest.TestCase):
+
+    @patch('yadtshell.probe_policy.logger')
+    def test_should_report_transition_needing_most_probes(self, logger):
+        statistics = ProbeStatistics()
+        statistics.record('service://foobar42/backend', 'up', 1, 0)
+        statistics.record('service://foobar42/frontend', 'up', 4, 1.7)
+        statistics.record('service://foobar42/frontend', 'down', 2, 0.2, reached=False)
+
+        self.assertEqual(statistics.log('result'), 'result')
+
+        logger.info.assert_called_with(
+            '3 state transition(s) needed 7 probe(s), at most 4 for service://foobar42/frontend to become up')
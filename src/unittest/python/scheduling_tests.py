@@ -0,0 +1,71 @@
+import unittest
+
+from mock import patch
+
+from yadtshell.actions import Action, ActionPlan, TargetState
+from yadtshell.scheduling import (critical_path_lengths,
+                                  critical_path_priorities,
+                                  create_priorities)
+
+
+def start(name, *needed):
+    return Action('start', 'service://foobar42/%s' % name, 'state', 'up',
+                  preconditions=set([TargetState('service://foobar42/%s' % other, 'state', 'up')
+                                     for other in needed]))
+
+
+class CriticalPathTests(unittest.TestCase):
+
+    def setUp(self):
+        # a chain of three services and a single service
+        self.db = start('db')
+        self.backend = start('backend', 'db')
+        self.frontend = start('frontend', 'backend')
+        self.cache = start('cache')
+        self.actions = [self.backend, self.cache, self.db, self.frontend]
+
+    def test_should_count_longest_chain_of_dependent_actions(self):
+        lengths = critical_path_lengths(self.actions)
+
+        self.assertEqual(lengths[id(self.db)], 3)
+        self.assertEqual(lengths[id(self.backend)], 2)
+        self.assertEqual(lengths[id(self.frontend)], 1)
+        self.assertEqual(lengths[id(self.cache)], 1)
+
+    def test_should_weight_chains(self):
+        durations = {'service://foobar42/cache': 60, 'service://foobar42/db': 10}
+
+        lengths = critical_path_lengths(self.actions, lambda action: durations.get(action.uri, 1))
+
+        self.assertEqual(lengths[id(self.db)], 12)
+        self.assertEqual(lengths[id(self.cache)], 60)
+
+    def test_should_survive_cycles(self):
+        first = start('first', 'second')
+        second = start('second', 'first')
+
+        lengths = critical_path_lengths([first, second])
+
+        self.assertEqual(lengths, {id(first): 1, id(second): 1})
+
+    def test_should_give_plan_the_highest_priority_of_its_actions(self):
+        subplan = ActionPlan('backend', [self.db, self.backend])
+        plan = ActionPlan('start', [subplan, self.frontend, self.cache])
+
+        priorities = critical_path_priorities(plan)
+
+        self.assertEqual(priorities[id(subplan)], 3)
+        self.assertEqual(priorities[id(plan)], 3)
+        self.assertEqual(priorities[id(self.cache)], 1)
+
+    def test_should_not_prioritize_when_scheduling_by_queue(self):
+        plan = ActionPlan('start', self.actions)
+
+        self.assertEqual(create_priorities(plan, 'queue'), None)
+
+    @patch('yadtshell.scheduling.logger')
+    def test_should_warn_about_unknown_schedule(self, logger):
+        plan = ActionPlan('start', self.actions)
+
+        self.assertEqual(create_priorities(plan, 'fastest'), None)
+        self.assertTrue(logger.warning.called)
@@ -0,0 +1,117 @@
+import copy
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+import yadtshell
+from yadtshell.components import ComponentDict, Host, Service, Artefact
+from yadtshell.state_store import StateStore, StoredComponentDict
+
+
+class StateStoreTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.TARGET_SETTINGS = {
+            'name': 'test', 'hosts': ['foobar42']}
+        self.out_dir = tempfile.mkdtemp()
+        self.store = StateStore(os.path.join(self.out_dir, 'current_state.db'))
+
+        self.components = ComponentDict()
+        host = Host('foobar42.acme.com')
+        host.logger = None
+        service = Service(host, 'backend', {'needs_artefacts': ['backend']})
+        host.defined_services = [service]
+        artefact = Artefact(host, 'backend', '1.0', yadtshell.settings.CURRENT)
+        self.components[host.uri] = host
+        self.components[service.uri] = service
+        self.components[artefact.uri] = artefact
+        self.components[artefact.revision_uri] = artefact
+        self.store.write(self.components)
+
+    def tearDown(self):
+        shutil.rmtree(self.out_dir)
+
+    def test_should_restore_all_keys(self):
+        components = StoredComponentDict(self.store)
+
+        self.assertEqual(sorted(components.keys()), sorted(self.components.keys()))
+        self.assertTrue('service://foobar42/backend' in components)
+        self.assertFalse('service://foobar42/frontend' in components)
+
+    def test_should_restore_attributes_of_component(self):
+        components = StoredComponentDict(self.store)
+
+        service = components['service://foobar42/backend']
+
+        self.assertTrue(isinstance(service, Service))
+        self.assertEqual(service.needs, self.components['service://foobar42/backend'].needs)
+
+    def test_should_only_load_requested_component(self):
+        components = StoredComponentDict(self.store)
+
+        with patch.object(self.store, 'load_rows', wraps=self.store.load_rows) as load_rows:
+            components['service://foobar42/backend']
+
+        load_rows.assert_called_once_with(['service://foobar42/backend'])
+
+    def test_should_keep_identity_of_referenced_and_aliased_components(self):
+        components = StoredComponentDict(self.store)
+
+        host = components['host://foobar42']
+        artefact = components['artefact://foobar42/backend/1.0']
+
+        self.assertTrue(host.defined_services[0] is components['service://foobar42/backend'])
+        self.assertTrue(artefact is components['artefact://foobar42/backend/current'])
+
+    def test_should_load_all_components_when_iterating_values(self):
+        components = StoredComponentDict(self.store)
+
+        self.assertEqual(len(components.values()), 4)
+        self.assertEqual(sorted(components.keys()), sorted(self.components.keys()))
+
+    def test_should_find_keys_by_type_and_host(self):
+        components = StoredComponentDict(self.store)
+
+        self.assertEqual(components.find_keys(type=yadtshell.settings.SERVICE, host='foobar42'),
+                         ['service://foobar42/backend'])
+
+    def test_should_copy_and_pickle_as_component_dict(self):
+        components = StoredComponentDict(self.store)
+
+        copied = copy.deepcopy(components)
+        pickled = pickle.loads(pickle.dumps(components, pickle.HIGHEST_PROTOCOL))
+
+        for result in [copied, pickled]:
+            self.assertEqual(type(result), ComponentDict)
+            self.assertEqual(sorted(result.keys()), sorted(self.components.keys()))
+            self.assertTrue(result['host://foobar42'].defined_services[0] is
+                            result['service://foobar42/backend'])
+
+    def test_should_raise_io_error_when_no_state_is_stored(self):
+        store = StateStore(os.path.join(self.out_dir, 'missing.db'))
+
+        self.assertRaises(IOError, StoredComponentDict, store)
+        self.assertFalse(os.path.exists(os.path.join(self.out_dir, 'missing.db')))
+
+    def test_should_update_attributes_of_stored_components_in_place(self):
+        self.store.update_attributes({'service://foobar42/backend': {'state': 'up'},
+                                      'service://foobar42/unknown': {'state': 'up'}})
+
+        components = StoredComponentDict(self.store)
+        service = components['service://foobar42/backend']
+        self.assertEqual(service.state, 'up')
+        self.assertEqual(service.needs, self.components['service://foobar42/backend'].needs)
+        self.assertTrue(components['host://foobar42'].defined_services[0] is service)
+        self.assertFalse('service://foobar42/unknown' in components)
+
+    def test_should_drop_fingerprint_when_updating_attributes(self):
+        self.store.write(self.components, meta={'fingerprint': 'abc'})
+        self.assertEqual(StoredComponentDict(self.store).fingerprint, 'abc')
+
+        self.store.update_attributes({'service://foobar42/backend': {'state': 'up'}})
+
+        self.assertEqual(StoredComponentDict(self.store).fingerprint, None)
@@ -0,0 +1,81 @@
+import unittest
+
+from mock import patch
+
+from yadtshell.status_payload import (JSON, YAML, PLAIN,
+                                      detect_format,
+                                      decode_host_status,
+                                      decode_statistics,
+                                      log_decode_statistics)
+
+
+JSON_STATUS = """
+{
+  "hostname": "foobar42",
+  "fqdn": "foobar42.acme.com",
+  "services": [{"foo": {"state": "up"}}, {"bar": {"state": "down"}}],
+  "current_artefacts": ["foo/1.0"]
+}
+"""
+
+YAML_STATUS = """
+hostname: foobar42
+fqdn: foobar42.acme.com
+services:
+- foo:
+    state: up
+current_artefacts:
+- foo/1.0
+"""
+
+
+class StatusPayloadTests(unittest.TestCase):
+
+    def setUp(self):
+        decode_statistics.clear()
+
+    def test_should_detect_format_from_first_bytes(self):
+        self.assertEqual(detect_format(JSON_STATUS), JSON)
+        self.assertEqual(detect_format(YAML_STATUS), YAML)
+        self.assertEqual(detect_format('down\n'), PLAIN)
+        self.assertEqual(detect_format(''), PLAIN)
+
+    @patch('yadtshell.status_payload.yaml')
+    def test_should_decode_json_without_yaml_parser(self, yaml):
+        data = decode_host_status('foobar42', JSON_STATUS)
+
+        self.assertEqual(data['fqdn'], 'foobar42.acme.com')
+        self.assertFalse(yaml.load.called)
+        self.assertEqual(decode_statistics['foobar42'][0], JSON)
+
+    def test_should_decode_yaml(self):
+        data = decode_host_status('foobar42', YAML_STATUS)
+
+        self.assertEqual(data['current_artefacts'], ['foo/1.0'])
+        self.assertEqual(decode_statistics['foobar42'][0], YAML)
+
+    def test_should_fall_back_to_yaml_for_flow_style_yaml(self):
+        data = decode_host_status('foobar42', '{fqdn: foobar42.acme.com}')
+
+        self.assertEqual(data, {'fqdn': 'foobar42.acme.com'})
+        self.assertEqual(decode_statistics['foobar42'][0], YAML)
+
+    def test_should_convert_list_of_services_to_dict(self):
+        data = decode_host_status('foobar42', JSON_STATUS)
+
+        self.assertEqual(data['services'], {'foo': {'state': 'up'}, 'bar': {'state': 'down'}})
+
+    def test_should_decode_plain_state(self):
+        self.assertEqual(decode_host_status('foobar42', 'down\n'), 'down')
+        self.assertEqual(decode_host_status('foobar42', ''), None)
+
+    @patch('yadtshell.status_payload.logger')
+    def test_should_report_hosts_answering_with_yaml(self, logger):
+        decode_host_status('foobar42', YAML_STATUS)
+        decode_host_status('foobar43', JSON_STATUS)
+
+        self.assertEqual(log_decode_statistics('result'), 'result')
+
+        message = logger.info.call_args[0][0]
+        self.assertTrue('1 hosts answer with yaml status' in message)
+        self.assertTrue(message.endswith('please upgrade: foobar42'))
@@ -1,4 +1,9 @@
+import gzip
 import logging
+import os
+import shutil
+import tarfile
+import tempfile
 import unittest
 
 from mock import Mock, patch, call, MagicMock
@@ -139,6 +144,13 @@ class StatusTests(unittest.TestCase):
             call('foobar42', {}, pi.return_value),
             call('foobar43', {}, pi.return_value)])
 
+    @patch('yadtshell._status._query_status')
+    def test_query_status_should_use_shared_fan_out(self, query_status):
+        yadtshell._status.query_status('foobar42', {}, None)
+
+        query_status.assert_called_with('foobar42', {}, None)
+        self.assertTrue(yadtshell._status.get_status_fan_out() is yadtshell._status.get_status_fan_out())
+
     @patch('yadtshell._status.os.environ')
     @patch('yadtshell._status.reactor.spawnProcess')
     @patch('yadtshell.twisted.YadtProcessProtocol')
@@ -266,6 +278,29 @@ some_attribute: some-value
         result_class = yadtshell._status.get_service_class_from_loaded_modules("MyCustomService")
         self.assertEqual(result_class.__name__, "MyCustomService")
 
+    @patch('yadtshell._status.inspect.getmembers')
+    def test_should_inspect_loaded_modules_only_once(self, getmembers):
+        getmembers.return_value = [('MyCustomService', MyCustomService)]
+        registry = yadtshell._status.ServiceClassRegistry()
+
+        registry.get_from_loaded_modules('MyCustomService')
+        calls = getmembers.call_count
+        registry.get_from_loaded_modules('MyCustomService')
+
+        self.assertEqual(getmembers.call_count, calls)
+
+    @patch('yadtshell._status.get_service_class_from_fallbacks')
+    def test_should_remember_service_class_found_by_fallbacks(self, fallbacks):
+        fallbacks.return_value = MyCustomService
+        registry = yadtshell._status.ServiceClassRegistry()
+        myhost = yadtshell.components.Host("foo.bar.com")
+
+        registry.get(myhost, 'some.module.MyCustomService')
+        result_class = registry.get(myhost, 'some.module.MyCustomService')
+
+        self.assertEqual(result_class, MyCustomService)
+        fallbacks.assert_called_once_with(myhost, 'some.module.MyCustomService')
+
     def test_get_service_class_from_fallback_1(self):
         myhost = yadtshell.components.Host("foo.bar.com")
         result_class = yadtshell._status.get_service_class_from_fallbacks(myhost, "yadtshell.components.Component")
@@ -312,6 +347,126 @@ services:
         yadtshell.status("myhost")
 
 
+class IncrementalStatusTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.TARGET_SETTINGS = {'name': 'test', 'hosts': ['foobar42']}
+        self.data = {"fqdn": "foobar42.acme.com",
+                     "next_artefacts": {},
+                     "current_artefacts": ["foo/1"],
+                     "services": {"bar": {"state": "up"}},
+                     "uptime": "up 1 day"}
+
+    def create_previous_status(self):
+        components = yadtshell.components.ComponentDict()
+        host = yadtshell.components.Host('foobar42.acme.com')
+        host.set_attrs_from_data(self.data)
+        host.status_token = yadtshell._status.calculate_status_token(self.data)
+        host.logger = None
+        components[host.uri] = host
+        yadtshell._status.initialize_services(host, components)
+        yadtshell._status.initialize_artefacts(host, components)
+        return yadtshell._status.PreviousStatus(components), components
+
+    def create_protocol(self, data):
+        protocol = Mock()
+        protocol.component = 'foobar42.acme.com'
+        protocol.data = yadtshell._status.json.dumps(data)
+        return protocol
+
+    def test_status_token_should_ignore_volatile_keys(self):
+        changed_data = dict(self.data, uptime="up 2 days", epoch=42)
+
+        self.assertEqual(yadtshell._status.calculate_status_token(self.data),
+                         yadtshell._status.calculate_status_token(changed_data))
+
+    def test_status_token_should_change_when_services_change(self):
+        changed_data = dict(self.data, services={"bar": {"state": "down"}})
+
+        self.assertNotEqual(yadtshell._status.calculate_status_token(self.data),
+                            yadtshell._status.calculate_status_token(changed_data))
+
+    @patch("yadtshell._status.write_host_data_to_file")
+    def test_should_reuse_components_of_unchanged_host(self, _):
+        previous_status, previous_components = self.create_previous_status()
+        previous_components['service://foobar42/bar'].needed_by.add('service://other/baz')
+        components = yadtshell.components.ComponentDict()
+
+        host = yadtshell._status.create_host(
+            self.create_protocol(dict(self.data, uptime="up 2 days")), components, previous_status)
+
+        self.assertTrue(host is previous_components['host://foobar42'])
+        self.assertTrue(host.status_reused)
+        self.assertEqual(host.uptime, "up 2 days")
+        self.assertEqual(set(components.keys()), set(previous_components.keys()))
+        self.assertEqual(components['service://foobar42/bar'].needed_by, set())
+
+    @patch("yadtshell._status.write_host_data_to_file")
+    def test_should_not_rebuild_services_of_reused_host(self, _):
+        previous_status, previous_components = self.create_previous_status()
+        components = yadtshell.components.ComponentDict()
+        host = yadtshell._status.create_host(self.create_protocol(self.data), components, previous_status)
+
+        yadtshell._status.initialize_services(host, components)
+
+        self.assertTrue(components['service://foobar42/bar'] is previous_components['service://foobar42/bar'])
+
+    @patch("yadtshell._status.write_host_data_to_file")
+    def test_should_rebuild_changed_host(self, _):
+        previous_status, previous_components = self.create_previous_status()
+        components = yadtshell.components.ComponentDict()
+        changed_data = dict(self.data, current_artefacts=["foo/2"])
+
+        host = yadtshell._status.create_host(self.create_protocol(changed_data), components, previous_status)
+
+        self.assertFalse(host is previous_components['host://foobar42'])
+        self.assertFalse(host.status_reused)
+        self.assertEqual(components.keys(), ['host://foobar42'])
+
+
+class IgnoredStatusOfTargetTests(unittest.TestCase):
+
+    def setUp(self):
+        yadtshell.settings.ybc = Mock(host='ybc', port=8081)
+
+    def query(self, ignored_status, hostname):
+        results = []
+        ignored_status.query(hostname).addBoth(results.append)
+        return results[0]
+
+    @patch("yadtshell._status.rest_call")
+    def test_should_fetch_ignored_hosts_of_target_once(self, rest_call):
+        rest_call.return_value = defer.succeed('{"foo": "maintenance"}')
+
+        ignored_status = yadtshell._status.IgnoredStatusOfTarget('target', ['foo.domain', 'bar.domain'])
+
+        self.assertEqual(self.query(ignored_status, 'foo'), 'maintenance')
+        self.assertTrue(isinstance(self.query(ignored_status, 'bar'), Failure))
+        rest_call.assert_called_once_with('http://ybc:8081/api/v1/targets/target/status-ignored')
+
+    @patch("yadtshell._status.rest_call")
+    def test_should_query_host_when_ignored_hosts_of_target_are_not_available(self, rest_call):
+        rest_call.side_effect = [defer.fail(Exception('404')), defer.succeed('ignored')]
+
+        ignored_status = yadtshell._status.IgnoredStatusOfTarget('target', ['foo.domain'])
+
+        self.assertEqual(self.query(ignored_status, 'foo'), 'ignored')
+        rest_call.assert_called_with('http://ybc:8081/api/v1/hosts/foo/status-ignored')
+
+    @patch("yadtshell._status.rest_call")
+    def test_should_answer_queries_after_ignored_hosts_of_target_arrived(self, rest_call):
+        response = defer.Deferred()
+        rest_call.return_value = response
+        ignored_status = yadtshell._status.IgnoredStatusOfTarget('target', ['foo.domain'])
+        results = []
+
+        ignored_status.query('foo').addBoth(results.append)
+        self.assertEqual(results, [])
+        response.callback('{"foo": "maintenance"}')
+
+        self.assertEqual(results, ['maintenance'])
+
+
 class HostStatusToFileTests(unittest.TestCase):
 
     @patch("yadtshell._status.open", create=True)
@@ -321,6 +476,7 @@ class HostStatusToFileTests(unittest.TestCase):
         fake_file = mock_open.return_value.__enter__.return_value
 
         write_host_data_to_file("somehost", "{'key': 'value',\n}")
+        yadtshell._status.flush_status_dumps()
 
         mock_open.assert_called_with('/tmp/yadtshell-logs/yadtshell.log.somehost.status', 'w')
         fake_file.write.assert_called_with("{'key': 'value',\n}")
@@ -332,6 +488,48 @@ class HostStatusToFileTests(unittest.TestCase):
         fake_file = mock_open.return_value.__enter__.return_value
 
         write_host_data_to_file("host://somehost", "{'key': 'value',\n}")
+        yadtshell._status.flush_status_dumps()
 
         mock_open.assert_called_with('/tmp/yadtshell-logs/yadtshell.log.somehost.status', 'w')
         fake_file.write.assert_called_with("{'key': 'value',\n}")
+
+
+class StatusDumpWriterTests(unittest.TestCase):
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        yadtshell.settings.log_file = os.path.join(self.log_dir, 'yadtshell.log')
+
+    def tearDown(self):
+        shutil.rmtree(self.log_dir)
+
+    def test_should_write_dump_files(self):
+        writer = yadtshell._status.StatusDumpWriter('files')
+
+        writer.write(yadtshell.settings.log_file + '.foo.status', 'foo-status')
+        writer.flush()
+
+        with open(yadtshell.settings.log_file + '.foo.status') as status_file:
+            self.assertEqual(status_file.read(), 'foo-status')
+
+    def test_should_write_gzipped_dump_files(self):
+        writer = yadtshell._status.StatusDumpWriter('gzip')
+
+        writer.write(yadtshell.settings.log_file + '.foo.status', 'foo-status')
+        writer.flush()
+
+        status_file = gzip.open(yadtshell.settings.log_file + '.foo.status.gz')
+        self.assertEqual(status_file.read(), 'foo-status')
+        status_file.close()
+
+    def test_should_write_all_dumps_into_one_archive(self):
+        writer = yadtshell._status.StatusDumpWriter('archive')
+
+        writer.write(yadtshell.settings.log_file + '.foo.status', 'foo-status')
+        writer.write(yadtshell.settings.log_file + '.bar.status', 'bar-status')
+        writer.close()
+
+        archive = tarfile.open(yadtshell.settings.log_file + '.status.tar.gz')
+        self.assertEqual(sorted(archive.getnames()), ['yadtshell.log.bar.status', 'yadtshell.log.foo.status'])
+        self.assertEqual(archive.extractfile('yadtshell.log.foo.status').read(), 'foo-status')
+        archive.close()
@@ -1,8 +1,10 @@
 # from twisted.trial
+import logging
 import unittest
-from mock import Mock
+from mock import Mock, patch
 
-from yadtshell.twisted import (YadtProcessProtocol,
+from yadtshell.twisted import (ProgressIndicator,
+                               YadtProcessProtocol,
                                _determine_issued_command,
                                report_error)
 
@@ -49,7 +51,7 @@ class TwistedTests(unittest.TestCase):
 
     def test_out_received_should_append_data(self):
         mock_process_protocol = Mock(YadtProcessProtocol)
-        mock_process_protocol.data = 'some-data-'
+        mock_process_protocol.chunks = ['some-data-']
         mock_process_protocol.component = 'component'
         mock_process_protocol.out_log_level = 'info'
         mock_process_protocol.pi = None
@@ -58,13 +60,31 @@ class TwistedTests(unittest.TestCase):
 
         YadtProcessProtocol.outReceived(mock_process_protocol, '-more-data')
 
-        self.assertEqual(mock_process_protocol.data, 'some-data--more-data')
+        self.assertEqual(mock_process_protocol.chunks, ['some-data-', '-more-data'])
+
+    def test_data_should_join_received_chunks(self):
+        process_protocol = YadtProcessProtocol('component', 'command')
+
+        process_protocol.outReceived('some-data-')
+        process_protocol.outReceived('-more-data')
+
+        self.assertEqual(process_protocol.data, 'some-data--more-data')
+        self.assertEqual(process_protocol.chunks, ['some-data--more-data'])
+
+    def test_out_received_should_not_log_lines_when_log_level_is_notset(self):
+        process_protocol = YadtProcessProtocol('component', 'command', out_log_level=logging.NOTSET)
+        process_protocol.logger = Mock()
+
+        process_protocol.outReceived('line 1\nline 2\n')
+
+        self.assertFalse(process_protocol.logger.log.called)
+        self.assertEqual(process_protocol.data, 'line 1\nline 2\n')
 
     def test_stdout_should_update_progress_indicator_with_command_and_component(self):
         mock_progress_indicator = Mock()
 
         mock_process_protocol = Mock(YadtProcessProtocol)
-        mock_process_protocol.data = ''
+        mock_process_protocol.chunks = []
         mock_process_protocol.cmd = 'command'
         mock_process_protocol.component = 'component'
         mock_process_protocol.out_log_level = 'info'
@@ -91,3 +111,18 @@ class TwistedTests(unittest.TestCase):
         YadtProcessProtocol.errReceived(mock_process_protocol, 'data')
 
         mock_progress_indicator.update.assert_called_with(('command', 'component'))
+
+
+class ProgressIndicatorTests(unittest.TestCase):
+
+    @patch('yadtshell.twisted.sys')
+    def test_should_render_eta_when_known(self, sys):
+        sys.stderr.isatty.return_value = True
+        pi = ProgressIndicator()
+
+        pi.update(('start', 'service://foobar42/backend'))
+        self.assertFalse('eta' in sys.stderr.write.call_args[0][0])
+        pi.set_eta(65.3)
+        pi.update(('start', 'service://foobar42/backend'))
+
+        self.assertTrue(sys.stderr.write.call_args[0][0].endswith(' eta 1:05\r'))
@@ -13,6 +13,7 @@ from yadtshell.util import (inbound_deps_on_same_host,
                             get_age_of_current_state_in_seconds,
                             filter_missing_services,
                             first_error_line,
+                            determine_host_group,
                             log_exceptions)
 from yadtshell.constants import STANDALONE_SERVICE_RANK
 from yadtshell.components import (Host,
@@ -95,14 +96,26 @@ class MissingServiceTests(unittest.TestCase):
         self.assertEquals(missing_services, [])
 
 
+class HostGroupTests(unittest.TestCase):
+
+    def test_should_group_by_location(self):
+        self.assertEqual(determine_host_group('berweb01.acme.com', 'loc'), 'ber')
+
+    def test_should_group_by_location_and_type_of_host_uri(self):
+        self.assertEqual(determine_host_group('host://berweb01', 'loctype'), 'berweb')
+
+    def test_should_group_by_domain(self):
+        self.assertEqual(determine_host_group('berweb01.dc1.acme.com', 'domain'), 'dc1.acme.com')
+
+
 class ServiceOrderingTests(unittest.TestCase):
 
     def setUp(self):
         yadtshell.settings.TARGET_SETTINGS = {
             'name': 'test', 'hosts': ['foobar42']}
         self.components = yadtshell.components.ComponentDict()
-        myhost = Host('foo.bar.com')
-        self.otherhost = Host('foo.boing')
+        myhost = Host('foobar42.bar.com')
+        self.otherhost = Host('otherhost.boing')
         self.bar_service = Service(myhost, 'barservice', {})
         self.baz_service = Service(myhost, 'bazservice', {})
         self.ack_service = Service(myhost, 'ackservice', {})
@@ -146,6 +159,13 @@ class ServiceOrderingTests(unittest.TestCase):
         self.assertEqual(outbound_deps_on_same_host(self.bar_service, self.components), [
                          'service://foobar42/bazservice', 'service://foobar42/ackservice'])
 
+    def test_should_return_each_outbound_dep_once(self):
+        self.bar_service.needs = ['service://foobar42/bazservice', 'service://foobar42/ackservice']
+        self.baz_service.needs = ['service://foobar42/ackservice']
+
+        self.assertEqual(outbound_deps_on_same_host(self.bar_service, self.components), [
+                         'service://foobar42/bazservice', 'service://foobar42/ackservice'])
+
     def test_should_label_standalone_services(self):
         compute_dependency_scores(self.components)
         self.assertEqual(
@@ -247,26 +267,26 @@ class CurrentStateTests(unittest.TestCase):
 
         self.assertEqual(get_mtime_of_current_state(), 42)
 
-        mtime_function.assert_called_with('/out/dir/current_state.components')
+        mtime_function.assert_called_with('/out/dir/current_state.db')
 
     @patch('yadtshell.util.get_age_of_current_state_in_seconds')
-    @patch('yadtshell.util.restore')
+    @patch('yadtshell.util.restore_state')
     def test_should_restore_current_state(self, restore_function, age_of_state):
         age_of_state.return_value = 0
 
         restore_current_state()
 
-        restore_function.assert_called_with('/out/dir/current_state.components')
+        restore_function.assert_called_with('/out/dir/current_state.db')
 
     @patch('yadtshell.util.get_age_of_current_state_in_seconds')
-    @patch('yadtshell.util.restore')
+    @patch('yadtshell.util.restore_state')
     def test_should_raise_when_restored_state_is_too_old_and_must_be_fresh(self, _, age_of_state):
         age_of_state.return_value = 1337  # the limit is 600 for 10 minutes
 
         self.assertRaises(IOError, restore_current_state, must_be_fresh=True)
 
     @patch('yadtshell.util.get_age_of_current_state_in_seconds')
-    @patch('yadtshell.util.restore')
+    @patch('yadtshell.util.restore_state')
     def test_should_not_raise_when_restored_state_is_too_old_and_must_not_be_fresh(self, _, age_of_state):
         age_of_state.return_value = 1337  # the limit is 600 for 10 minutes
 